@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Measure throughput of parsing debian control files with many package paragraphs.
+
+Run as python benchmarks/control_parsing.py [number-of-paragraphs]
+"""
+import sys
+import zlib
+from cStringIO import StringIO
+from random import Random
+from time import time
+
+from citools.debian.control import ControlFile, Dependency, tokenize_paragraph, get_grammar, build_paragraph_grammar, iter_paragraphs, DependencyGraph
+
+SOURCE_PARAGRAPH = """\
+Source: centrum-python-metapackage
+Section: python
+Priority: optional
+Maintainer: John Doe <john@doe.com>
+Build-Depends: cdbs (>= 0.4.41), debhelper (>= 5.0.37.2), python-dev, python-support (>= 0.3), python-setuptools
+Standards-Version: 3.7.2"""
+
+def get_control_file(count, seed=42):
+    random = Random(seed)
+    paragraphs = [SOURCE_PARAGRAPH]
+    for i in xrange(count):
+        depends = []
+        for j in xrange(random.randint(1, 8)):
+            # only earlier packages are depended on, so that packages can be ordered
+            name = 'centrum-python-package%d-aaa' % random.randint(0, max(i - 1, 0))
+            version = '%d.%d.%d' % (random.randint(0, 9), random.randint(0, 40), random.randint(0, 400))
+            if random.randint(0, 3):
+                depends.append('%s (%s %s)' % (name, random.choice(['=', '>=', '<<', '>>']), version))
+            else:
+                depends.append('%s-%s' % (name, version))
+        paragraphs.append('\n'.join([
+            '# package %d' % i,
+            'Package: centrum-python-package%d-aaa' % i,
+            'Architecture: all',
+            'Provides: centrum-python-package%d-aaa-%d.0.0' % (i, random.randint(0, 9)),
+            'Depends: %s,' % ', '.join(depends[:4]),
+            ' %s' % (' | '.join(depends[4:]) or 'python'),
+            'Description: package %d' % i,
+            ' with longer description',
+            ' on more lines',
+        ]))
+    return '\n\n'.join(paragraphs)
+
+def measure(name, function, source, count):
+    start = time()
+    result = function(source)
+    duration = time() - start
+    print "%-30s %8.3fs %12.0f paragraphs/s" % (name, duration, count / duration)
+    return result
+
+def main(argv):
+    if argv:
+        count = int(argv[0])
+    else:
+        count = 5000
+
+    source = get_control_file(count)
+    paragraphs = source.split('\n\n')
+    grammar = get_grammar(build_paragraph_grammar)
+
+    measure("paragraph tokenizer", lambda s: [tokenize_paragraph(p) for p in paragraphs], source, count)
+    measure("paragraph grammar", lambda s: [grammar.parseString(p, True) for p in paragraphs], source, count)
+    control_file = measure("ControlFile", ControlFile, source, count)
+    measure("dump", lambda s: control_file.dump(), source, count)
+    measure("get_dependencies", lambda s: list(control_file.get_dependencies()), source, count)
+    measure("replace_provides", lambda s: control_file.replace_provides(control_file.get_provides()), source, count)
+    upgrades = [Dependency(package.name, '99.0.0') for package in control_file.get_packages()]
+    measure("replace_dependencies", lambda s: control_file.replace_dependencies(upgrades), source, count)
+    measure("build order", lambda s: DependencyGraph([control_file]).get_build_order(), source, count)
+
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    compressed = compressor.compress(source) + compressor.flush()
+    measure("iter_paragraphs (gzip)", lambda s: sum(1 for p in iter_paragraphs(StringIO(s))), compressed, count)
+    measure("iter_paragraphs (filtered)", lambda s: list(iter_paragraphs(StringIO(s), package_names=['centrum-python-package1-aaa'])), compressed, count)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Measure throughput of parsing git describe outputs into VERSION tuples
+and of selecting the highest ones.
+
+Run as python benchmarks/version_parsing.py [number-of-strings]
+"""
+import sys
+from random import Random
+from time import time
+
+from citools.version import compute_version, compute_versions, get_highest_tag, get_highest_versions
+
+def get_describe_strings(count, seed=42):
+    random = Random(seed)
+    strings = []
+    for i in xrange(count):
+        version = '.'.join([str(random.randint(0, 40)) for j in xrange(random.randint(2, 4))])
+        if random.randint(0, 3):
+            suffix = '-%d-g%07x' % (random.randint(1, 500), random.randint(0, 16**7-1))
+        else:
+            suffix = ''
+        strings.append('project-%s%s' % (version, suffix))
+    return strings
+
+def measure(name, function, strings):
+    start = time()
+    function(strings)
+    duration = time() - start
+    print "%-30s %8.3fs %12.0f strings/s" % (name, duration, len(strings) / duration)
+
+def main(argv):
+    if argv:
+        count = int(argv[0])
+    else:
+        count = 100000
+
+    strings = get_describe_strings(count)
+
+    measure("compute_version (per call)", lambda s: [compute_version(i) for i in s], strings)
+    measure("compute_versions (batch)", compute_versions, strings)
+    measure("get_highest_tag", get_highest_tag, strings)
+
+    versions = compute_versions(strings)
+    measure("highest version", lambda v: get_highest_versions(v, use_numpy=False), versions)
+    measure("top 10 versions", lambda v: get_highest_versions(v, count=10, use_numpy=False), versions)
+    try:
+        import numpy
+    except ImportError:
+        print "numpy not installed, skipping vectorized selection"
+    else:
+        measure("highest version (numpy)", lambda v: get_highest_versions(v, use_numpy=True), versions)
+        measure("top 10 versions (numpy)", lambda v: get_highest_versions(v, count=10, use_numpy=True), versions)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
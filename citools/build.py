@@ -12,7 +12,7 @@ import time
 from datetime import datetime
 from shutil import copytree
 
-from citools.git import fetch_repository
+from citools.git import fetch_locked_repository, unlock_file
 from citools.version import retrieve_current_branch, get_git_last_hash
 
 logger = logging.getLogger(__name__)
@@ -27,10 +27,14 @@ def copy_images(repositories, static_dir):
             branch = repository['branch']
         else:
             branch = retrieve_current_branch(repository_directory=os.curdir, fix_environment=True)
-        dir = fetch_repository(repository['url'], workdir=os.curdir, branch=branch)
-        package_static_dir = os.path.join(dir, repository['package_name'], 'static')
-        if os.path.exists(package_static_dir):
-            copytree(package_static_dir, os.path.join(static_dir, repository['package_name']))
+        dir, lock = fetch_locked_repository(repository['url'], workdir=os.curdir, branch=branch)
+        try:
+            package_static_dir = os.path.join(dir, repository['package_name'], 'static')
+            if os.path.exists(package_static_dir):
+                copytree(package_static_dir, os.path.join(static_dir, repository['package_name']))
+        finally:
+            if lock is not None:
+                unlock_file(lock)
     
 class CopyDependencyImages(config):
 
@@ -10,8 +10,8 @@ from distutils.core import Command
 
 from citools.build import ReplaceTemplateFiles, RenameTemplateFiles
 from citools.debian.control import ControlFile, Dependency
-from citools.git import fetch_repository
-from citools.version import get_git_describe, compute_version, compute_meta_version, get_git_head_hash, retrieve_current_branch
+from citools.git import fetch_locked_repository, unlock_file
+from citools.version import get_git_version, compute_meta_version, get_git_head_hash, retrieve_current_branch
 
 
 __all__ = (
@@ -45,7 +45,7 @@ class BuildDebianPackage(Command):
 
 def get_new_dependencies(dir, accepted_tag_pattern=None, branch="master"):
     
-    version = compute_version(get_git_describe(repository_directory=dir, fix_environment=True, accepted_tag_pattern=accepted_tag_pattern))
+    version = get_git_version(repository_directory=dir, fix_environment=True, accepted_tag_pattern=accepted_tag_pattern)[1]
     control = os.path.join(dir, 'debian', 'control')
 
     version = ".".join(map(str, version))
@@ -74,13 +74,18 @@ def fetch_new_dependencies(repository, workdir=None):
             branch = retrieve_current_branch(repository_directory=workdir, fix_environment=True)
         else:
             branch = retrieve_current_branch()
-    repo = fetch_repository(
-        repository=repository['url'], branch=branch
+    # only debian/ is needed from working tree, rest is computed from history
+    repo, lock = fetch_locked_repository(
+        repository=repository['url'], branch=branch, history_only=True, checkout_paths=['debian']
     )
     #FIXME: This should not be hardcoded
     project_pattern = "%s-[0-9]*" % repository['package_name']
     
-    deps = get_new_dependencies(repo, accepted_tag_pattern=project_pattern, branch=branch)
+    try:
+        deps = get_new_dependencies(repo, accepted_tag_pattern=project_pattern, branch=branch)
+    finally:
+        if lock is not None:
+            unlock_file(lock)
 
     return deps
 
@@ -214,7 +219,7 @@ def get_package_path(package_name, module_name, current_version=None):
     if not current_version:
         #FIXME: not to hardcode
         format = "%s-[0-9]*" % module_name
-        current_version = '.'.join(map(str, compute_version(get_git_describe(accepted_tag_pattern=format))))
+        current_version = '.'.join(map(str, get_git_version(accepted_tag_pattern=format)[1]))
     package_name = u"%(name)s_%(version)s_%(arch)s.deb" % {
         'name' : package_name,
         'version' : current_version,
@@ -2,55 +2,187 @@ from pyparsing import (
         ParserElement, LineEnd, CharsNotIn, Group, Word,
         alphanums, Literal, Combine, ZeroOrMore, nums,
         Optional, delimitedList, restOfLine,
-        Or, _ustr, MatchFirst
+        oneOf, _ustr, MatchFirst, Regex
 )
+from collections import deque
 from itertools import chain
+from threading import Lock
+import bz2
+import re
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 
 DEPENDENCY_DELIMITERS = PROVIDES_DELIMITERS = [',']
 DEPENDENCY_INTERLIMITERS = ['|']
 
+# newlines are significant in control files
+GRAMMAR_WHITESPACE_CHARS = ' \t\r'
+
+_grammars = {}
+_grammars_lock = Lock()
+
+def get_grammar(builder, *args):
+    """
+    Return grammar built by builder(*args), building it only once for given arguments.
+    Grammars are built with GRAMMAR_WHITESPACE_CHARS as default whitespace; as that is
+    pyparsing-wide setting, grammars are built by one thread at a time.
+    """
+    key = (builder,) + args
+    if key not in _grammars:
+        _grammars_lock.acquire()
+        try:
+            if key not in _grammars:
+                default_whitespace_chars = ParserElement.DEFAULT_WHITE_CHARS
+                ParserElement.setDefaultWhitespaceChars(GRAMMAR_WHITESPACE_CHARS)
+                try:
+                    _grammars[key] = builder(*args)
+                finally:
+                    ParserElement.setDefaultWhitespaceChars(default_whitespace_chars)
+        finally:
+            _grammars_lock.release()
+    return _grammars[key]
+
+def build_paragraph_grammar():
+    EOL = LineEnd().suppress()
+    comment = Literal('#') + Optional( restOfLine ) + EOL
+    string = CharsNotIn("\n")
+    line = Group(
+        Word(alphanums + '-')('key') + Literal(':').suppress() + Optional(Combine(string + ZeroOrMore(EOL + Literal(' ') + string)))("value") + EOL
+    )
+    # comments are whole lines only; ignore() would take '#' starting a value for one too
+    group = ZeroOrMore(comment.suppress() | line)
+    return group
+
+FIELD_PATTERN = re.compile(r"^ *(?P<key>[0-9A-Za-z-]+) *:(?P<value>.*)$")
+
+def tokenize_paragraph(source):
+    """
+    Split paragraph into list of (key, value) tuples, joining continuation lines
+    the same way paragraph grammar does. As in Debian control files, only lines
+    starting with '#' are comments; '#' anywhere else is part of the value.
+
+    Only plain paragraphs are handled here; for anything unusual (tabs, carriage returns,
+    blank or malformed lines) None is returned and paragraph is left to the grammar.
+    """
+    if '\t' in source or '\r' in source:
+        return None
+
+    items = []
+    continued = False
+    lines = source.split('\n')
+    for number, line in enumerate(lines):
+        if not line:
+            if ''.join(lines[number+1:]):
+                return None
+            break
+        elif line[0] == ' ' and continued:
+            if len(line) == 1:
+                return None
+            # leading space is kept as words separator
+            items[-1][1].append(line)
+        elif line[0] == '#':
+            continued = False
+        else:
+            match = FIELD_PATTERN.match(line)
+            if not match:
+                return None
+            value = match.group('value').lstrip(' ')
+            items.append((match.group('key'), [value]))
+            continued = bool(value)
+
+    return [(key, ''.join(parts)) for key, parts in items]
+
+def parse_paragraph_items(source):
+    """ Return list of (key, value) tuples of paragraph """
+    items = tokenize_paragraph(source)
+    if items is None:
+        items = [(row.key, row.value) for row in get_grammar(build_paragraph_grammar).parseString(source, True)]
+    return items
+
+def build_version_grammar():
+    """ Version as in Debian policy, [epoch:]upstream[-revision], or substitution variable """
+    return Word(nums + '$', alphanums + '.+~-:${}')('version')
+
+def build_versioned_package_grammar(get_package, version):
+    # name may carry architecture qualifier, like python:any
+    package_name = Word(alphanums + '.+-${}:')('name')
+    sign = oneOf('<< >> <= >= = < >')('sign')
+    # architecture list ([amd64 !i386]) and build profiles (<!nocheck>) are kept as they are
+    restriction = Regex(r"\[[^\]\n]*\]") | Regex(r"<[^>\n]*>")
+    # optional version part is tried after the name, so name is never parsed twice
+    return (
+        package_name +
+        Optional(
+            Literal('(').suppress() +
+            Optional(sign)('sign') +
+            version +
+            Literal(')').suppress()
+        ) +
+        Group(ZeroOrMore(restriction))('restrictions')
+    ).setParseAction(lambda x: get_package(x.name, x.sign, x.version, ' '.join(x.restrictions)))
+
+def build_provides_grammar(delimiter):
+    provider = build_versioned_package_grammar(get_provider, build_version_grammar())
+    return Optional(delimitedList(provider, delimiter))
+
+def build_depends_grammar(delimiters):
+    dependency = build_versioned_package_grammar(get_dependency, build_version_grammar())
+
+    delim = MatchFirst([])
+    for i in delimiters:
+        delim = delim | Literal(i)
+
+    dlName = _ustr(dependency)+" ["+_ustr(delim)+" "+_ustr(dependency)+"]..."
+    return Optional((dependency + ZeroOrMore(delim + dependency)).setName(dlName))
+
 class ControlFileParagraph(dict):
+    """
+    Paragraph of control file. Fields with parse_<field> hook are kept as raw text
+    until they are accessed for the first time; fields never accessed are dumped verbatim.
+    """
+
     def __init__(self, source):
         self.provides_delimiters = self.dependency_delimiters = DEPENDENCY_DELIMITERS
         self.dependency_interlimiters = DEPENDENCY_INTERLIMITERS
 
         self._keys = []
+        self._unparsed = set()
         self._parse(source)
         
         super(ControlFileParagraph, self).__init__()
 
     def _parse_items(self, source):
-        ParserElement.setDefaultWhitespaceChars(' \t\r')
-        EOL = LineEnd().suppress()
-        comment = Literal('#') + Optional( restOfLine ) + EOL
-        string = CharsNotIn("\n")
-        line = Group(
-            Word(alphanums + '-')('key') + Literal(':').suppress() + Optional(Combine(string + ZeroOrMore(EOL + Literal(' ') + string)))("value") + EOL
-        )
-        group = ZeroOrMore(line)
-        group.ignore(comment)
-        return group.parseString(source, True)
+        return parse_paragraph_items(source)
 
     def _att_key(self, key):
         return key.lower().replace('-', '_')
 
     def _parse(self, source):
-        for row in self._parse_items(source):
-            key, value = row.key, row.value
+        for key, value in self._parse_items(source):
             att_key = self._att_key(key)
-            if hasattr(self, 'parse_%s' % att_key):
-                value = getattr(self, 'parse_%s' % att_key)(value)
-
             self[key] = value
+            if hasattr(self, 'parse_%s' % att_key):
+                self._unparsed.add(att_key)
 
     def dump(self):
         out = []
         for key in self._keys:
             att_key = self._att_key(key)
-            value = self[att_key]
-            if hasattr(self, 'dump_%s' % att_key):
-                value = getattr(self, 'dump_%s' % att_key)(value)
+            if att_key in self._unparsed:
+                # never accessed, thus never changed
+                value = super(ControlFileParagraph, self).__getitem__(att_key)
+            else:
+                value = self[att_key]
+                if hasattr(self, 'dump_%s' % att_key):
+                    value = getattr(self, 'dump_%s' % att_key)(value)
 
             out.append('%s: %s' % (key, value))
         return '\n'.join(out)
@@ -64,10 +196,71 @@ class ControlFileParagraph(dict):
 
     def __getitem__(self, name):
         att_key = self._att_key(name)
-        return super(ControlFileParagraph, self).__getitem__(att_key)
+        value = super(ControlFileParagraph, self).__getitem__(att_key)
+        if att_key in self._unparsed:
+            value = getattr(self, 'parse_%s' % att_key)(value)
+            super(ControlFileParagraph, self).__setitem__(att_key, value)
+            self._unparsed.discard(att_key)
+        return value
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def itervalues(self):
+        for key in self.keys():
+            yield self[key]
+
+    def iteritems(self):
+        for key in self.keys():
+            yield (key, self[key])
+
+    def _parse_all(self):
+        for key in list(self._unparsed):
+            self[key]
+
+    def copy(self):
+        return dict(self.items())
+
+    def pop(self, name, *default):
+        att_key = self._att_key(name)
+        if att_key in self:
+            # parse first, so that parsed value is returned
+            self[att_key]
+            self._keys = [key for key in self._keys if self._att_key(key) != att_key]
+        return super(ControlFileParagraph, self).pop(att_key, *default)
+
+    def popitem(self):
+        if not self:
+            raise KeyError('popitem(): dictionary is empty')
+        key = self.keys()[0]
+        return (key, self.pop(key))
+
+    def setdefault(self, name, default=None):
+        if self._att_key(name) not in self:
+            self[name] = default
+        return self[name]
+
+    def __eq__(self, other):
+        self._parse_all()
+        if isinstance(other, ControlFileParagraph):
+            other._parse_all()
+        return super(ControlFileParagraph, self).__eq__(other)
+
+    def __ne__(self, other):
+        return not self == other
 
     def __setitem__(self, name, value):
         att_key = self._att_key(name)
+        self._unparsed.discard(att_key)
         if att_key in self:
             super(ControlFileParagraph, self).__setitem__(att_key, value)
         else:
@@ -75,20 +268,37 @@ class ControlFileParagraph(dict):
             super(ControlFileParagraph, self).__setitem__(att_key, value)
 
 class Dependency(object):
-    def __init__(self, name, version='', sign=''):
+    def __init__(self, name, version='', sign='', restrictions=''):
         self.name, self.version, self.sign = name, version, sign
+        # architecture and build profile restrictions, as written after version
+        self.restrictions = restrictions
 
     def __str__(self):
         if self.sign:
-            return '%s (%s %s)' % (self.name, self.sign, self.version)
+            out = '%s (%s %s)' % (self.name, self.sign, self.version)
+        elif self.version:
+            out = '%s-%s' % (self.name, self.version)
         else:
-            if self.version:
-                return '%s-%s' % (self.name, self.version)
-        return self.name
+            out = self.name
+        if self.restrictions:
+            out = '%s %s' % (out, self.restrictions)
+        return out
 
     def __repr__(self):
         return '<Dependency(%r, %r, %r)>' % (self.name, self.version, self.sign)
 
+    def __eq__(self, other):
+        if not isinstance(other, Dependency):
+            return NotImplemented
+        return (self.__class__, self.name, self.version, self.sign, self.restrictions) == \
+            (other.__class__, other.name, other.version, other.sign, other.restrictions)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
     def is_versioned(self):
         return bool(self.version and not self.sign)
 
@@ -96,7 +306,7 @@ class Provider(Dependency):
     def __repr__(self):
         return '<Provider(%r, %r, %r)>' % (self.name, self.version, self.sign)
 
-def get_versioned_package(name, klass, sign='', version=''):
+def get_versioned_package(name, klass, sign='', version='', restrictions=''):
     if version and not sign:
         sign = '='
 
@@ -107,66 +317,63 @@ def get_versioned_package(name, klass, sign='', version=''):
             if version_candidate[0] == '-':
                 version = version_candidate[1:]
                 name = package_name
-    return klass(name, version, sign)
+    return klass(name, version, sign, restrictions)
 
-def get_dependency(name, sign='', version=''):
-    return get_versioned_package(name=name, klass=Dependency, sign=sign, version=version)
+def get_dependency(name, sign='', version='', restrictions=''):
+    return get_versioned_package(name=name, klass=Dependency, sign=sign, version=version, restrictions=restrictions)
 
-def get_provider(name, sign='', version=''):
-    return get_versioned_package(name=name, klass=Provider, sign=sign, version=version)
+def get_provider(name, sign='', version='', restrictions=''):
+    return get_versioned_package(name=name, klass=Provider, sign=sign, version=version, restrictions=restrictions)
 
 class SourceParagraph(ControlFileParagraph):
     pass
 
 class PackageParagraph(ControlFileParagraph):
+    def __init__(self, source):
+        # field -> {name : [Dependency or Provider, ...]}
+        self._relation_indexes = {}
+        super(PackageParagraph, self).__init__(source)
+
+    def get_relation_index(self, field):
+        """
+        Return {name : [Dependency or Provider, ...]} for relations in given field (depends or provides).
+
+        Index is built on first use and kept until the field is assigned or removed; when
+        relations are replaced or renamed inside the list, call invalidate_relation_index.
+        """
+        field = self._att_key(field)
+        if field not in self._relation_indexes:
+            index = {}
+            for relation in self.get(field, []):
+                if isinstance(relation, Dependency):
+                    index.setdefault(relation.name, []).append(relation)
+            self._relation_indexes[field] = index
+        return self._relation_indexes[field]
+
+    def invalidate_relation_index(self, field=None):
+        """ Forget index of given field (of all fields if not given) """
+        if field is None:
+            self._relation_indexes.clear()
+        else:
+            self._relation_indexes.pop(self._att_key(field), None)
+
+    def __setitem__(self, name, value):
+        self.invalidate_relation_index(name)
+        super(PackageParagraph, self).__setitem__(name, value)
+
+    def pop(self, name, *default):
+        self.invalidate_relation_index(name)
+        return super(PackageParagraph, self).pop(name, *default)
+
     def parse_package(self, value):
         return get_dependency(value)
 
     def parse_provides(self, value):
-        package_name = Word(alphanums + '.-${}:')('name')
-        version = Word(nums + '.-')('version')
-        sign = Or(map(Literal, ('>', '<', '>=', '<=', '=',)))('sign')
-        provider = (
-                (
-                    package_name +
-                    Literal('(').suppress() +
-                    Optional(sign)('sign') +
-                    version +
-                    Literal(')').suppress()
-                ) | (
-                    package_name
-                )
-            ).setParseAction(lambda x: get_provider(x.name, x.sign, x.version))
-        providers = Optional(delimitedList(provider, ','))
-        return providers.parseString(value, True).asList()
+        return get_grammar(build_provides_grammar, ',').parseString(value, True).asList()
 
     def parse_depends(self, value):
-        package_name = Word(alphanums + '.-${}:')('name')
-        version = Combine(
-            Word(nums + '.-') + Optional(Literal('~') + Word(alphanums + '+'))
-        )('version')
-
-        sign = Or(map(Literal, ('>', '<', '>=', '<=', '=',)))('sign')
-        dependency = (
-                (
-                    package_name +
-                    Literal('(').suppress() +
-                    Optional(sign)('sign') +
-                    version +
-                    Literal(')').suppress()
-                ) | (
-                    package_name
-                )
-            ).setParseAction(lambda x: get_dependency(x.name, x.sign, x.version))
-
-        delim = MatchFirst([])
-        for i in self.dependency_delimiters + self.dependency_interlimiters:
-            delim = delim | Literal(i)
-            
-        dlName = _ustr(dependency)+" ["+_ustr(delim)+" "+_ustr(dependency)+"]..."
-        dependencies = Optional((dependency + ZeroOrMore(delim + dependency)).setName(dlName))
-
-        return dependencies.parseString(value, True).asList()
+        delimiters = tuple(self.dependency_delimiters + self.dependency_interlimiters)
+        return get_grammar(build_depends_grammar, delimiters).parseString(value, True).asList()
 
     def dump_depends(self, value):
         out = ''
@@ -181,13 +388,114 @@ class PackageParagraph(ControlFileParagraph):
         return out
 
     def dump_provides(self, value):
-        out = ''
-        for v in value:
-            if v in self.provides_delimiters:
-                out += '%s ' % v
-            else:
-                out += str(v)
-        return out
+        # delimiters are not kept by provides grammar, but may be given in value
+        return ('%s ' % self.provides_delimiters[0]).join([str(v) for v in value if v not in self.provides_delimiters])
+
+STREAM_READ_SIZE = 64 * 1024
+
+COMPRESSION_MAGIC = [
+    ('\x1f\x8b', 'gzip'),
+    ('BZh', 'bz2'),
+    ('\xfd7zXZ\x00', 'xz'),
+]
+
+PACKAGE_FIELD_PATTERN = re.compile(r"^Package *:[ \t]*(?P<name>\S+)", re.MULTILINE | re.IGNORECASE)
+
+def get_decompressor(compression):
+    if compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == 'bz2':
+        return bz2.BZ2Decompressor()
+    elif compression == 'xz':
+        if lzma is None:
+            raise ValueError("lzma module is not installed, cannot read xz compressed stream")
+        return lzma.LZMADecompressor()
+    else:
+        raise ValueError("Unknown compression %s" % compression)
+
+def iter_stream_chunks(stream, compression=None, read_size=STREAM_READ_SIZE):
+    """
+    Yield decompressed content of stream, reading read_size bytes at a time.
+    Compression (gzip, bz2 or xz) is detected from magic bytes unless given.
+    """
+    data = stream.read(read_size)
+
+    if compression is None:
+        for magic, name in COMPRESSION_MAGIC:
+            if data.startswith(magic):
+                compression = name
+                break
+        else:
+            while data:
+                yield data
+                data = stream.read(read_size)
+            return
+
+    decompressor = get_decompressor(compression)
+    while data:
+        try:
+            chunk = decompressor.decompress(data)
+        except EOFError:
+            # previous stream ended exactly at the end of read data, another one follows
+            decompressor = get_decompressor(compression)
+            continue
+
+        if chunk:
+            yield chunk
+
+        # concatenated streams (multi-member gzip, parallel bzip2, ...)
+        data = decompressor.unused_data
+        if data:
+            decompressor = get_decompressor(compression)
+        else:
+            data = stream.read(read_size)
+
+    if hasattr(decompressor, 'flush'):
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+def iter_paragraph_sources(stream, compression=None, read_size=STREAM_READ_SIZE):
+    """ Yield source of every paragraph in stream, without its surrounding blank lines """
+    buffer = ''
+    for chunk in iter_stream_chunks(stream, compression=compression, read_size=read_size):
+        paragraphs = (buffer + chunk).split('\n\n')
+        buffer = paragraphs.pop()
+        for paragraph in paragraphs:
+            paragraph = paragraph.strip('\n')
+            if paragraph:
+                yield paragraph
+
+    buffer = buffer.strip('\n')
+    if buffer:
+        yield buffer
+
+def iter_paragraphs(source, package_names=None, paragraph_class=PackageParagraph, compression=None):
+    """
+    Yield paragraphs of control file or apt Packages/Sources index one by one, so that
+    even big indexes are never held in memory. Source is file name or file object,
+    possibly gzip, bz2 or xz compressed (see iter_stream_chunks).
+
+    If package_names are given, only paragraphs with those Package fields are parsed and yielded.
+    """
+    if package_names is not None:
+        package_names = set(package_names)
+
+    if isinstance(source, basestring):
+        stream = open(source, 'rb')
+    else:
+        stream = source
+
+    try:
+        for paragraph in iter_paragraph_sources(stream, compression=compression):
+            if package_names is not None:
+                match = PACKAGE_FIELD_PATTERN.search(paragraph)
+                if not match or match.group('name') not in package_names:
+                    continue
+            yield paragraph_class(paragraph)
+    finally:
+        if stream is not source:
+            stream.close()
 
 class ControlFile(object):
     DEFAULT_SOURCE_PARAGRAPH = """Section: python
@@ -263,23 +571,31 @@ Depends: python (>= 2.5.0)
                 ))
         return True
 
-    def replace_dependencies(self, deps_from_repositories):
-        new_versions = dict((p.name, p.version) for p in deps_from_repositories)
-        for p in self.get_dependencies():
-            if p.name in new_versions:
+    def _replace_relation_versions(self, field, deps_from_repositories):
+        new_versions = {}
+        for p in deps_from_repositories:
+            new_versions[p.name] = p.version
+
+        for package in self.packages:
+            # only relations with new versions are visited, through name index of package;
+            # for bulk updates, walking the (smaller) index is cheaper than asking it for every name
+            index = package.get_relation_index(field)
+            if len(new_versions) < len(index):
+                relations = [p for name in new_versions for p in index.get(name, [])]
+            else:
+                relations = [p for name, named in index.iteritems() if name in new_versions for p in named]
+
+            for p in relations:
                 self._pname = p.name
                 new_version = new_versions[p.name]
                 self.check_downgrade(p.version, new_version)
                 p.version = new_version
 
+    def replace_dependencies(self, deps_from_repositories):
+        self._replace_relation_versions('depends', deps_from_repositories)
+
     def replace_provides(self, deps_from_repositories):
-        new_versions = dict((p.name, p.version) for p in deps_from_repositories)
-        for p in self.get_provides():
-            if p.name in new_versions:
-                self._pname = p.name
-                new_version = new_versions[p.name]
-                self.check_downgrade(p.version, new_version)
-                p.version = new_version
+        self._replace_relation_versions('provides', deps_from_repositories)
 
     def replace_versioned_packages(self, version, old_version='0.0.0.0'):
         self.replace_versioned_dependencies(version, old_version)
@@ -309,3 +625,115 @@ Depends: python (>= 2.5.0)
             fout.write(out)
             fout.close()
         return out
+
+class DependencyGraph(object):
+    """
+    Dependencies between binary packages of many control files (i.e. meta package
+    and all its dependency repositories).
+
+    Only dependencies on packages in graph are considered, either by their name or by name
+    they provide; all alternatives (foo | bar) present in graph are taken as dependencies.
+
+    Edges are computed once and kept until control file is added; call invalidate()
+    when relations of packages in graph are changed.
+    """
+
+    def __init__(self, control_files=None):
+        super(DependencyGraph, self).__init__()
+        self.packages = {}
+        self.names = []
+        self._edges = None
+        self._dependents = None
+        for control_file in control_files or []:
+            self.add_control_file(control_file)
+
+    def add_control_file(self, control_file):
+        for paragraph in control_file.packages:
+            name = paragraph['package'].name
+            if name in self.packages:
+                raise ValueError("Package %s present in more control files" % name)
+            self.packages[name] = paragraph
+            self.names.append(name)
+        self.invalidate()
+
+    def invalidate(self):
+        """ Forget computed edges, so they are computed again on next use """
+        self._edges = None
+        self._dependents = None
+
+    def get_edges(self):
+        """ Return {package name : [names of packages it depends on]}, in order of dependencies """
+        if self._edges is None:
+            self._edges = self._compute_edges()
+        return self._edges
+
+    def _compute_edges(self):
+        providers = {}
+        for name in self.names:
+            providers.setdefault(name, []).append(name)
+            for provider in self.packages[name].get_relation_index('provides'):
+                providers.setdefault(provider, []).append(name)
+
+        edges = {}
+        for name in self.names:
+            dependencies = []
+            seen = set([name])
+            for dependency in self.packages[name].get('depends', []):
+                if not isinstance(dependency, Dependency):
+                    continue
+                for provider in providers.get(dependency.name, []):
+                    if provider not in seen:
+                        seen.add(provider)
+                        dependencies.append(provider)
+            edges[name] = dependencies
+        return edges
+
+    def get_dependents(self):
+        """ Return {package name : [names of packages depending on it directly]}, in order packages were added """
+        if self._dependents is None:
+            edges = self.get_edges()
+            dependents = dict((name, []) for name in self.names)
+            for name in self.names:
+                for dependency in edges[name]:
+                    dependents[dependency].append(name)
+            self._dependents = dependents
+        return self._dependents
+
+    def get_build_order(self):
+        """
+        Return package names ordered so that every package comes after all its dependencies;
+        independent packages are kept in order they were added. Raise ValueError on cycle.
+        """
+        edges = self.get_edges()
+        dependents = self.get_dependents()
+        missing = dict((name, len(edges[name])) for name in self.names)
+
+        ready = deque([name for name in self.names if not missing[name]])
+        order = []
+        while ready:
+            name = ready.popleft()
+            order.append(name)
+            for dependent in dependents[name]:
+                missing[dependent] -= 1
+                if not missing[dependent]:
+                    ready.append(dependent)
+
+        if len(order) != len(self.names):
+            raise ValueError("Dependency cycle between packages %s" % ', '.join(
+                [name for name in self.names if missing[name]]))
+        return order
+
+    def get_reverse_dependents(self, name):
+        """ Return names of all packages depending on package name, directly or indirectly, nearest first """
+        dependents = self.get_dependents()
+
+        result = []
+        seen = set([name])
+        queue = deque([name])
+        while queue:
+            for dependent in dependents.get(queue.popleft(), []):
+                if dependent not in seen:
+                    seen.add(dependent)
+                    result.append(dependent)
+                    queue.append(dependent)
+        return result
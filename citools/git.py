@@ -1,221 +1,1551 @@
 from ConfigParser import SafeConfigParser
 from datetime import datetime
+try:
+    from fcntl import flock, LOCK_EX, LOCK_SH, LOCK_NB, LOCK_UN
+except ImportError:
+    flock = None
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 from distutils.core import Command
-from distutils.errors import DistutilsOptionError
-from locale import resetlocale, setlocale, LC_ALL
+from distutils.errors import DistutilsOptionError, DistutilsExecError
 from subprocess import CalledProcessError
-from tempfile import mkdtemp
+from shutil import rmtree
+from tempfile import mkdtemp, mkstemp, TemporaryFile
+from time import time
+from urlparse import urlsplit
 import os
 import re
-from subprocess import check_call, PIPE, Popen
+from subprocess import PIPE, Popen
+from threading import Lock
 import logging
 import traceback
 
+from citools.pool import map_in_threads
+
 log = logging.getLogger("citools.git")
 
 
-USED_GIT_PARSING_LOCALE = "en_US"
+# dates for filter_parse_date are read as --date=raw (epoch and offset) so that no locale is involved;
+# custom filters get --date=local they were written for
+GIT_DATE_FORMAT = "--date=raw"
+LOCAL_GIT_DATE_FORMAT = "--date=local"
+
+# pretty format placeholders following --date
+GIT_DATE_PROPERTIES = ["%ad", "%cd"]
+
+MONTHS = dict([(month, number + 1) for number, month in enumerate(
+    ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"])])
+DAYS_OF_WEEK = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+RAW_DATE_PATTERN = re.compile(r"^(?P<timestamp>-?\d+)(?:\ (?P<timezone>[+-]\d{4}))?$")
+LOCAL_DATE_PATTERN = re.compile(r"^(?P<dow>\w+)\ {1}(?P<month>\w+)\ {1}(?P<day>\d{1,2})\ {1}(?P<hour>\d{1,2})\:{1}(?P<minute>\d{1,2})\:{1}(?P<second>\d{1,2})\ {1}(?P<year>\d+).*$", re.UNICODE)
+
+GIT_IDENTITY_PATTERN = re.compile(r"^(?P<name>.*?) ?<(?P<email>[^>]*)> (?P<timestamp>-?\d+)(?: (?P<timezone>[+-]\d{4}))?$")
+
+# guards read-modify-write of repository cache file when fetching in threads
+_repository_cache_lock = Lock()
+
+class GitRunner(object):
+    """
+    Run git commands for given repository.
+
+    Repository is passed to every git process via its own cwd/environment,
+    so process-wide os.environ is never touched and runner can be used from many threads.
+    """
+
+    def __init__(self, repository_directory=None, git_dir=None):
+        super(GitRunner, self).__init__()
+        self.repository_directory = repository_directory and os.path.abspath(repository_directory)
+
+        if not git_dir and repository_directory:
+            git_dir = os.path.join(repository_directory, '.git')
+        self.git_dir = git_dir and os.path.abspath(git_dir)
+
+    def get_environment(self, env=None):
+        if not self.git_dir and not env:
+            return None
+        environment = dict(os.environ)
+        if self.git_dir:
+            environment['GIT_DIR'] = self.git_dir
+        environment.update(env or {})
+        return environment
+
+    def popen(self, args, env=None, **kwargs):
+        """ Start git with given arguments and return Popen object """
+        kwargs.setdefault('stdout', PIPE)
+        kwargs.setdefault('stderr', PIPE)
+        return Popen(["git"] + list(args), cwd=self.repository_directory, env=self.get_environment(env), **kwargs)
+
+    def run(self, args, env=None, input=None):
+        """ Run git with given arguments and return (returncode, stdout, stderr) """
+        if input is not None:
+            proc = self.popen(args, env=env, stdin=PIPE)
+        else:
+            proc = self.popen(args, env=env)
+        stdout, stderr = proc.communicate(input)
+        return (proc.returncode, stdout, stderr)
+
+    def check_output(self, args, env=None, input=None):
+        """ Run git with given arguments and return its output; raise CalledProcessError on failure """
+        returncode, stdout, stderr = self.run(args, env=env, input=input)
+        if returncode != 0:
+            log.error("git %s failed: stdout: %s stderr: %s" % (' '.join(args), stdout, stderr))
+            raise CalledProcessError(returncode, ["git"] + list(args))
+        return stdout
+
+    check_call = check_output
+
+def get_git_runner(fix_environment=False, repository_directory=None):
+    """
+    Return GitRunner for repository_directory if fix_environment is set,
+    or runner for current directory (or $GIT_DIR) otherwise
+    """
+    if fix_environment:
+        if not repository_directory:
+            raise ValueError(u"Cannot fix environment when repository directory not given")
+        return GitRunner(repository_directory=repository_directory)
+    return GitRunner()
+
+class GitSession(object):
+    """
+    Long-lived git cat-file --batch process answering object and ref queries for one repository.
+
+    Any revision expression git understands (HEAD, branch or tag name, abbreviated hash, ...)
+    can be asked, all over one pipe, so hot loops do not pay for spawning git on every query.
+    Session may be shared between threads; call close() when done.
+    """
+
+    MINIMAL_ABBREV_LENGTH = 7
+
+    def __init__(self, runner=None):
+        super(GitSession, self).__init__()
+        self.runner = runner or GitRunner()
+        self.lock = Lock()
+        self.process = None
+        self._mailmap = None
+        self._abbrev_length = None
+
+    def _query(self, rev):
+        if '\n' in rev:
+            raise ValueError("Invalid revision %r" % rev)
+
+        self.lock.acquire()
+        try:
+            if self.process is None:
+                self.process = self.runner.popen(["cat-file", "--batch"], stdin=PIPE, stderr=open(os.devnull, 'w'), bufsize=-1)
+            self.process.stdin.write(rev + "\n")
+            self.process.stdin.flush()
+            header = self.process.stdout.readline()
+            if not header:
+                self.process = None
+                raise ValueError("git cat-file --batch terminated unexpectedly")
+
+            parts = header.split()
+            if len(parts) != 3:
+                # "<rev> missing" or "<rev> ambiguous"
+                return None
+
+            sha, type, size = parts
+            content = self.process.stdout.read(int(size))
+            self.process.stdout.read(1)
+            return (sha, type, content)
+        finally:
+            self.lock.release()
+
+    def read_object(self, rev):
+        """ Return (hash, type, content) of object rev is pointing to """
+        result = self._query(rev)
+        if result is None:
+            raise ValueError("Cannot resolve %s" % rev)
+        return result
+
+    def resolve(self, rev):
+        """ Return full hash of rev, like git rev-parse does """
+        return self.read_object(rev)[0]
+
+    def exists(self, rev):
+        return self._query(rev) is not None
+
+    def get_abbrev_length(self):
+        """
+        Return minimal length of abbreviated hash, as git log %h would use it: core.abbrev
+        or length git scales by number of objects. Asked once, through rev-parse --short.
+        """
+        if self._abbrev_length is None:
+            returncode, stdout, stderr = self.runner.run(["rev-parse", "--short", "HEAD"])
+            if returncode == 0 and stdout.strip():
+                self._abbrev_length = len(stdout.strip())
+            else:
+                self._abbrev_length = self.MINIMAL_ABBREV_LENGTH
+        return self._abbrev_length
+
+    def abbreviate(self, sha):
+        """ Return shortest unambiguous prefix of sha, at least get_abbrev_length() long """
+        for length in range(self.get_abbrev_length(), len(sha)):
+            result = self._query(sha[:length])
+            if result is not None and result[0] == sha:
+                return sha[:length]
+        return sha
+
+    def read_commit(self, rev):
+        """
+        Return dictionary with parsed commit rev is pointing to (annotated tags are peeled).
+
+        Identities are raw bytes as stored in commit; encoding is commit's declared encoding or None.
+        """
+        sha, type, content = self.read_object(rev)
+        while type == 'tag':
+            sha, type, content = self.read_object(content.split("\n", 1)[0].split(" ", 1)[1])
+        if type != 'commit':
+            raise ValueError("%s is not a commit, but %s" % (rev, type))
+
+        headers, message = (content.split("\n\n", 1) + [''])[:2]
+        commit = {
+            'hash' : sha,
+            'parents' : [],
+            'encoding' : None,
+            'message' : message,
+        }
+
+        for line in headers.splitlines():
+            if line.startswith(" "):
+                # continuation of multiline header, like gpgsig
+                continue
+            key, value = (line.split(" ", 1) + [''])[:2]
+            if key == 'tree':
+                commit['tree'] = value
+            elif key == 'parent':
+                commit['parents'].append(value)
+            elif key == 'encoding':
+                commit['encoding'] = value
+            elif key in ('author', 'committer'):
+                prefix = {'author' : 'author', 'committer' : 'commiter'}[key]
+                match = GIT_IDENTITY_PATTERN.match(value)
+                if not match:
+                    raise ValueError("Cannot parse %s line of commit %s: %s" % (key, sha, value))
+                commit.update({
+                    '%s_name' % prefix : match.group('name'),
+                    '%s_email' % prefix : match.group('email'),
+                    '%s_timestamp' % prefix : int(match.group('timestamp')),
+                    '%s_timezone' % prefix : match.group('timezone'),
+                })
+
+        # subject is first paragraph of message folded into one line, as git log %s does
+        subject = []
+        for line in message.lstrip("\n").splitlines():
+            if not line.strip():
+                break
+            subject.append(line.strip())
+        commit['subject'] = " ".join(subject)
+
+        return commit
+
+    def has_mailmap(self):
+        """ Return True if author/commiter names shall be translated using .mailmap """
+        if self._mailmap is None:
+            returncode, stdout, stderr = self.runner.run(["config", "--get-regexp", "^mailmap\\."])
+            self._mailmap = bool(stdout.strip()) or self.exists("HEAD:.mailmap") or \
+                os.path.exists(os.path.join(self.runner.repository_directory or os.curdir, ".mailmap"))
+        return self._mailmap
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.process is not None:
+                self.process.stdin.close()
+                self.process.wait()
+                self.process = None
+        finally:
+            self.lock.release()
+
+HEX_HASH_PATTERN = re.compile(r"^[0-9a-f]{40}$")
+PSEUDO_REF_PATTERN = re.compile(r"^[A-Z_]+$")
+REF_NAME_PATTERN = re.compile(r"^[\w./-]+$")
+
+SYMBOLIC_REF_MAX_DEPTH = 5
+PER_WORKTREE_REF_PREFIXES = ("refs/bisect/", "refs/worktree/", "refs/rewritten/")
+
+def read_git_file(path):
+    """ Return stripped content of small file in git directory, or None when not there """
+    try:
+        f = open(path)
+    except IOError:
+        return None
+    try:
+        return f.read().strip()
+    finally:
+        f.close()
+
+def find_git_dir(directory):
+    """
+    Return git directory of working tree in (or above) directory,
+    following .git files of worktrees and submodules; None if there is none
+    """
+    directory = os.path.abspath(directory)
+    while True:
+        dot_git = os.path.join(directory, '.git')
+        if os.path.isdir(dot_git):
+            return dot_git
+        elif os.path.isfile(dot_git):
+            content = read_git_file(dot_git)
+            if not content or not content.startswith("gitdir:"):
+                return None
+            return os.path.normpath(os.path.join(directory, content[len("gitdir:"):].strip()))
+
+        parent = os.path.dirname(directory)
+        if parent == directory:
+            return None
+        directory = parent
+
+def get_common_dir(git_dir):
+    """ Return directory with refs shared by all worktrees of git_dir (git_dir itself if not a worktree) """
+    common_dir = read_git_file(os.path.join(git_dir, 'commondir'))
+    if common_dir:
+        return os.path.normpath(os.path.join(git_dir, common_dir))
+    return git_dir
+
+class RefReader(object):
+    """
+    Resolve HEAD, branches and tags straight from git directory (loose refs and packed-refs),
+    without spawning git.
+
+    Only plain ref names are handled; for anything else (revision expressions, abbreviated hashes,
+    missing refs, unknown ref storage) None is returned and caller is expected to ask git.
+    """
+
+    def __init__(self, git_dir):
+        super(RefReader, self).__init__()
+        self.git_dir = git_dir
+        self.common_dir = get_common_dir(git_dir)
+        self._packed_refs = None
+
+    def get_ref_directory(self, name):
+        if name.startswith("refs/") and not name.startswith(PER_WORKTREE_REF_PREFIXES):
+            return self.common_dir
+        return self.git_dir
+
+    def get_packed_refs(self):
+        if self._packed_refs is None:
+            self._packed_refs = {}
+            try:
+                f = open(os.path.join(self.common_dir, 'packed-refs'))
+            except IOError:
+                return self._packed_refs
+            try:
+                for line in f:
+                    # comments and peeled (^) lines of annotated tags
+                    if line.startswith(('#', '^')):
+                        continue
+                    parts = line.split()
+                    if len(parts) == 2:
+                        self._packed_refs[parts[1]] = parts[0]
+            finally:
+                f.close()
+        return self._packed_refs
+
+    def read_ref(self, name):
+        """
+        Return (symbolic target, None) for symbolic ref, (None, hash) for ordinary one,
+        or None when ref does not exist
+        """
+        content = read_git_file(os.path.join(self.get_ref_directory(name), name))
+        if content is None:
+            if name in self.get_packed_refs():
+                return (None, self.get_packed_refs()[name])
+            return None
+
+        if content.startswith("ref:"):
+            return (content[len("ref:"):].strip(), None)
+        elif HEX_HASH_PATTERN.match(content):
+            return (None, content)
+        else:
+            raise ValueError("Cannot read ref %s" % name)
+
+    def resolve_ref(self, name):
+        """ Return hash given full ref name points to, following symbolic refs; None if it does not exist """
+        for depth in range(SYMBOLIC_REF_MAX_DEPTH):
+            ref = self.read_ref(name)
+            if ref is None:
+                return None
+            name, hash = ref
+            if hash:
+                return hash
+        raise ValueError("Too deep nesting of symbolic refs")
+
+    def get_head(self):
+        """
+        Return (branch ref, hash) of HEAD; branch ref is None when HEAD is detached,
+        hash is None on branch with no commit yet
+        """
+        ref = self.read_ref("HEAD")
+        if ref is None:
+            raise ValueError("No HEAD in %s" % self.git_dir)
+        branch, hash = ref
+        if branch:
+            hash = self.resolve_ref(branch)
+        return (branch, hash)
+
+    def resolve(self, name):
+        """ Resolve ref name the way git rev-parse does, or return None when it cannot be done here """
+        if HEX_HASH_PATTERN.match(name):
+            return name
+        if not REF_NAME_PATTERN.match(name) or name.startswith(('-', '/')) or '..' in name or name.endswith(('.', '/', '.lock')):
+            return None
+
+        candidates = ["refs/%s", "refs/tags/%s", "refs/heads/%s", "refs/remotes/%s", "refs/remotes/%s/HEAD"]
+        if name.startswith("refs/") or PSEUDO_REF_PATTERN.match(name):
+            candidates.insert(0, "%s")
+
+        try:
+            for candidate in candidates:
+                hash = self.resolve_ref(candidate % name)
+                if hash:
+                    return hash
+        except ValueError:
+            return None
+
+        return None
+
+def get_ref_reader(runner=None):
+    """
+    Return RefReader for repository of given runner (or current directory),
+    or None when its refs are not stored in layout we can read
+    """
+    git_dir = (runner or GitRunner()).git_dir
+    if not git_dir:
+        if os.environ.get('GIT_DIR'):
+            git_dir = os.path.abspath(os.environ['GIT_DIR'])
+        elif os.environ.get('GIT_CEILING_DIRECTORIES'):
+            return None
+        else:
+            git_dir = find_git_dir(os.getcwd())
+
+    if git_dir and os.path.isfile(git_dir):
+        git_dir = find_git_dir(os.path.dirname(git_dir))
+
+    if not git_dir or os.environ.get('GIT_COMMON_DIR') or not os.path.isfile(os.path.join(git_dir, 'HEAD')):
+        return None
+
+    reader = RefReader(git_dir)
+    if os.path.exists(os.path.join(reader.common_dir, 'reftable')):
+        return None
+    return reader
 
-def fetch_repository(repository, workdir=None, branch=None, cache_config_dir=None, cache_config_file_name="cached_repositories.ini", reference_repository=None):
+def fetch_repository(repository, workdir=None, branch=None, cache_config_dir=None, cache_config_file_name="cached_repositories.ini", reference_repository=None, history_only=False, checkout_paths=None, refresh_ttl=None):
     """
     Fetch repository inside a workdir. Return filesystem path of newly created dir.
+    See fetch_locked_repository; cached clone returned here is not protected from eviction,
+    use fetch_locked_repository when it's going to be used for long.
+    """
+    directory, lock = fetch_locked_repository(repository, workdir=workdir, branch=branch, cache_config_dir=cache_config_dir,
+        cache_config_file_name=cache_config_file_name, reference_repository=reference_repository,
+        history_only=history_only, checkout_paths=checkout_paths, refresh_ttl=refresh_ttl)
+    if lock is not None:
+        unlock_file(lock)
+    return directory
+
+def get_repository_lock_path(directory):
+    """ Return path of file locked by users (shared) and evictors (exclusive) of cached clone in directory """
+    return directory + ".lock"
+
+def lock_cached_repository(directory, shared=True, blocking=True):
+    """
+    Lock cached clone in directory, return lock handle for unlock_file. Return None if clone
+    is not there (anymore) or, if not blocking, when it's locked by someone else.
+    """
+    try:
+        lock = lock_file(get_repository_lock_path(directory), shared=shared, blocking=blocking)
+    except IOError:
+        # temporary directory clone was in has been removed
+        return None
+    if lock is not None and not os.path.isdir(directory):
+        # clone has been evicted before we got the lock
+        unlock_file(lock)
+        return None
+    return lock
+
+def fetch_locked_repository(repository, workdir=None, branch=None, cache_config_dir=None, cache_config_file_name="cached_repositories.ini", reference_repository=None, history_only=False, checkout_paths=None, refresh_ttl=None):
+    """
+    Fetch repository inside a workdir. Return (filesystem path of newly created dir, lock),
+    where lock is a handle for unlock_file, or None when repository is not cached.
+    Cached clone is not evicted until its lock is unlocked.
+
+    Clones are cached separately for every branch and kind of clone (full or history-only).
     if cache_config_dir is False, no attempt to use caching is used. If None, curdir is used, if string, it's taken as path to directory.
         If given directory is not writeable, warning is logged and fetch proceeds as if cache_config_dir would be False
+
+    With history_only, only commits and tags of given branch are downloaded (blobless, no-checkout,
+    single-branch clone), which is all we need for computing versions. Paths from checkout_paths
+    are then checked out (and their blobs downloaded) on demand.
+
+    If refresh_ttl is given, cached repository not refreshed for refresh_ttl seconds (0 means always)
+    is fetched and its branch reset to the remote one before being returned. When that fails,
+    repository is cloned again next to the cached one and swapped in its place.
     """
-    write_repository_cache = False
+    cache_index = None
 
     if cache_config_dir is not False:
         if not cache_config_dir:
             cache_config_dir = os.curdir
 
-        if not os.path.isdir(cache_config_dir) or not os.access(cache_config_dir, os.W_OK):
-            cache_config_dir = False
-        else:
-            cache_file_path = os.path.join(cache_config_dir, cache_config_file_name)
-            parser = SafeConfigParser()
-            write_repository_cache = True
+        if os.path.isdir(cache_config_dir) and os.access(cache_config_dir, os.W_OK):
+            cache_index = RepositoryCacheIndex(cache_config_dir, cache_config_file_name)
+
+            cached = cache_index.get(repository, history_only=history_only, branch=branch)
+            if cached:
+                cached_repo, cached_history_only = cached
+                # refresh changes clone in place, so it waits until nobody else is using it
+                refresh = refresh_ttl is not None and \
+                    cache_index.needs_refresh(repository, refresh_ttl, branch=branch, history_only=cached_history_only)
+                lock = lock_cached_repository(cached_repo, shared=not refresh)
+            else:
+                lock = None
 
-            if os.path.exists(cache_file_path):
-                parser.read([cache_file_path])
-                if parser.has_section(repository) and parser.has_option(repository, "cache_dir"):
-                    cached_repo = parser.get(repository, "cache_dir")
-                    if os.path.exists(cached_repo):
-                        return cached_repo
+            if lock is not None:
+                try:
+                    # clone may have been refreshed by someone else while waiting for the lock
+                    if refresh and cache_index.needs_refresh(repository, refresh_ttl, branch=branch, history_only=cached_history_only):
+                        if not refresh_repository(cached_repo, branch=branch, history_only=cached_history_only):
+                            # clone is broken; it's replaced only when new one is ready
+                            fresh_repo = os.path.join(mkdtemp(dir=os.path.dirname(os.path.dirname(cached_repo))), "repository")
+                            try:
+                                clone_repository(repository, fresh_repo, branch=branch, reference_repository=reference_repository, history_only=cached_history_only)
+                            except:
+                                rmtree(os.path.dirname(fresh_repo), ignore_errors=True)
+                                raise
+                            swap_repository(fresh_repo, cached_repo)
+                        cache_index.mark_refreshed(repository, branch=branch, history_only=cached_history_only)
+                    if cached_history_only and checkout_paths:
+                        checkout_repository_paths(cached_repo, checkout_paths)
+                except:
+                    unlock_file(lock)
+                    raise
+                if refresh:
+                    downgrade_lock(lock)
+                return (cached_repo, lock)
 
     #HACK: I'm now aware about some "generate me temporary dir name" function,
     # so I'll make this create/remove workaround - patch welcomed ,)
     dir = os.path.abspath(os.path.join(mkdtemp(dir=workdir), "repository"))
 
-    clone = ["git", "clone", repository, dir]
+    clone_repository(repository, dir, branch=branch, reference_repository=reference_repository, history_only=history_only)
+
+    if history_only and checkout_paths:
+        checkout_repository_paths(dir, checkout_paths)
+
+    lock = None
+    if cache_index:
+        # locked before others can find it in index
+        lock = lock_cached_repository(dir)
+        cache_index.add(repository, dir, history_only=history_only, branch=branch)
+
+    return (dir, lock)
+
+def clone_repository(repository, dir, branch=None, reference_repository=None, history_only=False):
+    """ Clone repository into dir, with branch checked out (or, with history_only, with history of branch only) """
+    clone = ["clone", repository, dir]
 
     if reference_repository and os.path.exists(reference_repository):
         clone.extend(["--reference", reference_repository])
 
-    check_call(clone, stdout=PIPE, stdin=PIPE, stderr=PIPE)
+    if history_only:
+        clone.extend(["--no-checkout", "--filter=blob:none", "--single-branch"])
+        if branch:
+            clone.extend(["--branch", branch])
+
+    GitRunner().check_call(clone)
+
+    if not history_only and branch and branch != "master":
+        GitRunner(repository_directory=dir).check_call(["checkout", "-b", branch, "origin/%s" % branch])
+
+def swap_repository(fresh_directory, directory):
+    """
+    Move repository from fresh_directory (created inside its own temporary directory) to directory,
+    removing repository previously there and temporary directory fresh one was created in.
+    """
+    stale = mkdtemp(dir=os.path.dirname(directory), prefix=".stale-")
+    os.rename(directory, os.path.join(stale, os.path.basename(directory)))
+    os.rename(fresh_directory, directory)
+    rmtree(stale, ignore_errors=True)
+    os.rmdir(os.path.dirname(fresh_directory))
+
+def refresh_repository(repository_directory, branch=None, history_only=False):
+    """
+    Fetch branch (checked out one if not given) from origin into repository_directory,
+    check it out and reset it to the fetched one, so rewritten history is followed too.
+    Return False if that is not possible.
+    """
+    runner = GitRunner(repository_directory=repository_directory)
+    try:
+        if not branch:
+            branch = runner.check_output(["symbolic-ref", "--short", "HEAD"]).strip()
+        remote_ref = "refs/remotes/origin/%s" % branch
+        runner.check_call(["fetch", "--prune", "--tags", "origin", "+refs/heads/%s:%s" % (branch, remote_ref)])
+        if history_only:
+            # there is no working tree to check out, just move branch
+            runner.check_call(["update-ref", "refs/heads/%s" % branch, remote_ref])
+            runner.check_call(["symbolic-ref", "HEAD", "refs/heads/%s" % branch])
+        else:
+            runner.check_call(["checkout", "--force", "-B", branch, remote_ref])
+    except CalledProcessError:
+        log.warning("Cannot refresh cached repository %s: %s" % (repository_directory, traceback.format_exc()))
+        return False
+    return True
+
+def checkout_repository_paths(repository_directory, paths):
+    """ Check out only given paths from HEAD, leaving rest of working tree empty """
+    GitRunner(repository_directory=repository_directory).check_call(["checkout", "HEAD", "--"] + list(paths))
+
+
+def lock_file(path, shared=False, blocking=True):
+    """
+    Acquire exclusive (or shared) inter-process lock on path, return handle for unlock_file.
+    If not blocking, None is returned when lock is held by someone else.
+    """
+    f = open(path, 'a')
+    if flock:
+        flags = shared and LOCK_SH or LOCK_EX
+        if not blocking:
+            flags |= LOCK_NB
+        try:
+            flock(f.fileno(), flags)
+        except IOError:
+            f.close()
+            if blocking:
+                raise
+            return None
+    return f
+
+def downgrade_lock(f):
+    """ Turn exclusive lock from lock_file into shared one, without unlocking it """
+    if flock:
+        flock(f.fileno(), LOCK_SH)
+
+def unlock_file(f):
+    if flock:
+        flock(f.fileno(), LOCK_UN)
+    f.close()
+
+def get_directory_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+class RepositoryCacheIndex(object):
+    """
+    Index of repositories cloned by fetch_repository, stored as ini file (section per
+    repository, branch and kind of clone, with cache_dir, history_only, last_used and size options).
+
+    Every read-modify-write is done under lock (both inter-process and inter-thread one)
+    and file is replaced atomically, so parallel builds sharing workspace do not lose entries.
+    """
+
+    def __init__(self, directory, file_name="cached_repositories.ini"):
+        super(RepositoryCacheIndex, self).__init__()
+        self.path = os.path.join(directory, file_name)
+
+    def lock(self):
+        _repository_cache_lock.acquire()
+        try:
+            return lock_file(self.path + ".lock")
+        except:
+            _repository_cache_lock.release()
+            raise
+
+    def unlock(self, lock):
+        try:
+            unlock_file(lock)
+        finally:
+            _repository_cache_lock.release()
+
+    def read(self):
+        parser = SafeConfigParser()
+        parser.read([self.path])
+        return parser
+
+    def write(self, parser):
+        fd, temporary_path = mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.%s.' % os.path.basename(self.path))
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                parser.write(f)
+            finally:
+                f.close()
+            os.rename(temporary_path, self.path)
+        except:
+            os.remove(temporary_path)
+            raise
+
+    def get_section(self, repository, branch=None, history_only=False):
+        """
+        Return name of section for clone of given branch of repository (or its default branch);
+        full and history-only clones are kept in separate sections
+        """
+        section = repository
+        if branch:
+            section += "#%s" % branch
+        if history_only:
+            section += "#history-only"
+        return section
+
+    def get_entry(self, parser, section):
+        if not parser.has_option(section, "cache_dir"):
+            return None
+
+        def get_option(option, default):
+            if parser.has_option(section, option):
+                return parser.get(section, option)
+            return default
+
+        return {
+            'section' : section,
+            'repository' : get_option("repository", section),
+            'cache_dir' : parser.get(section, "cache_dir"),
+            'history_only' : parser.has_option(section, "history_only") and parser.getboolean(section, "history_only"),
+            'last_used' : float(get_option("last_used", 0)),
+            'last_refreshed' : float(get_option("last_refreshed", 0)),
+            'size' : int(get_option("size", 0)),
+        }
+
+    def get(self, repository, history_only=False, branch=None):
+        """
+        Return (cache_dir, history_only) for cached clone of repository branch, or None when it is not cached.
+        History-only clone has no working tree, so it is not returned unless history_only is requested
+        (full clone may be returned then).
+        """
+        sections = [self.get_section(repository, branch)]
+        if history_only:
+            sections.insert(0, self.get_section(repository, branch, history_only=True))
+
+        lock = self.lock()
+        try:
+            parser = self.read()
+            for section in sections:
+                entry = self.get_entry(parser, section)
+                if not entry or not os.path.exists(entry['cache_dir']):
+                    continue
+                if entry['history_only'] and not history_only:
+                    continue
+
+                parser.set(section, "last_used", repr(time()))
+                self.write(parser)
+                return (entry['cache_dir'], entry['history_only'])
+            return None
+        finally:
+            self.unlock(lock)
+
+    def needs_refresh(self, repository, ttl, now=None, branch=None, history_only=False):
+        """ Return True if repository clone has not been cloned or refreshed in last ttl seconds """
+        entry = self.get_entry(self.read(), self.get_section(repository, branch, history_only))
+        return not entry or (now or time()) - entry['last_refreshed'] >= ttl
+
+    def mark_refreshed(self, repository, branch=None, history_only=False):
+        section = self.get_section(repository, branch, history_only)
+        lock = self.lock()
+        try:
+            parser = self.read()
+            if parser.has_section(section):
+                parser.set(section, "last_refreshed", repr(time()))
+                self.write(parser)
+        finally:
+            self.unlock(lock)
+
+    def add(self, repository, directory, history_only=False, branch=None):
+        size = get_directory_size(directory)
+        section = self.get_section(repository, branch, history_only)
+
+        lock = self.lock()
+        try:
+            parser = self.read()
+            if not parser.has_section(section):
+                parser.add_section(section)
+            parser.set(section, "repository", repository)
+            if branch:
+                parser.set(section, "branch", branch)
+            parser.set(section, "cache_dir", directory)
+            parser.set(section, "history_only", str(bool(history_only)).lower())
+            parser.set(section, "last_used", repr(time()))
+            parser.set(section, "last_refreshed", repr(time()))
+            parser.set(section, "size", str(size))
+            self.write(parser)
+        finally:
+            self.unlock(lock)
+
+    def get_entries(self):
+        parser = self.read()
+        return [entry for entry in [self.get_entry(parser, repository) for repository in parser.sections()] if entry]
+
+    def evict(self, max_size=None, max_age=None, now=None):
+        """
+        Remove cached repositories not used for max_age seconds and then least recently
+        used ones until their total size is not bigger than max_size bytes.
+        Entries for directories that no longer exist are dropped too.
+        Repositories in use (locked by lock_cached_repository) are skipped.
+
+        Return list of removed repositories.
+        """
+        now = now or time()
+
+        lock = self.lock()
+        try:
+            parser = self.read()
+            entries = [entry for entry in [self.get_entry(parser, repository) for repository in parser.sections()] if entry]
+            entries.sort(key=lambda entry: entry['last_used'])
+
+            total_size = sum([entry['size'] for entry in entries])
+            removed = []
+            for entry in entries:
+                expired = max_age is not None and now - entry['last_used'] > max_age
+                too_big = max_size is not None and total_size > max_size
+                missing = not os.path.exists(entry['cache_dir'])
+                if not (expired or too_big or missing):
+                    continue
+
+                if not missing:
+                    repository_lock = lock_cached_repository(entry['cache_dir'], shared=False, blocking=False)
+                    if repository_lock is None:
+                        continue
+                    try:
+                        rmtree(entry['cache_dir'])
+                        # lock file can go too, as lock_cached_repository checks the clone
+                        # is still there once it gets the lock
+                        os.remove(get_repository_lock_path(entry['cache_dir']))
+                    finally:
+                        unlock_file(repository_lock)
+                    # fetch_repository clones into repository/ inside of temporary directory
+                    try:
+                        os.rmdir(os.path.dirname(entry['cache_dir']))
+                    except OSError:
+                        pass
+
+                parser.remove_section(entry['section'])
+                total_size -= entry['size']
+                removed.append(entry['repository'])
+
+            if removed:
+                self.write(parser)
+            return removed
+        finally:
+            self.unlock(lock)
+
+def collect_repository_cache(directory, file_name="cached_repositories.ini", max_size=None, max_age=None):
+    """ Evict repositories cached by fetch_repository in directory; suitable to be run from cron """
+    removed = RepositoryCacheIndex(directory, file_name).evict(max_size=max_size, max_age=max_age)
+    for repository in removed:
+        log.info("Removed cached repository %s" % repository)
+    return removed
+
+class RepositoryMirrors(object):
+    """
+    Bare mirrors of remote repositories, one per URL, kept in given directory.
+
+    Mirrors are refreshed by incremental fetch, so repeated builds download only new objects,
+    and local clones are made from them with hardlinked objects, so they do not depend on mirror.
+    Least recently used mirrors are removed by evict when max_size (in bytes) is exceeded;
+    call it outside of hot paths (i.e. once per build or from cron).
+    """
+
+    LAST_USED_FILE_NAME = "citools-last-used"
+
+    def __init__(self, directory, max_size=None):
+        super(RepositoryMirrors, self).__init__()
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        self._locks = {}
+        self._locks_lock = Lock()
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
 
-    if branch and branch != "master":
-        check_call(["git", "checkout", "-b", branch, "origin/%s" % branch], cwd=dir, stdout=PIPE, stdin=PIPE, stderr=PIPE)
+    def get_mirror_path(self, url):
+        name = urlsplit(url)[2].rstrip("/").split("/")[-1]
+        if name.endswith(".git"):
+            name = name[:-4]
+        return os.path.join(self.directory, "%s-%s.git" % (name, sha1(url).hexdigest()[:12]))
 
-    if write_repository_cache:
-        if not parser.has_section(repository):
-            parser.add_section(repository)
-        parser.set(repository, "cache_dir", dir)
-        f = open(cache_file_path, "w")
-        parser.write(f)
+    def _get_thread_lock(self, path):
+        self._locks_lock.acquire()
+        try:
+            return self._locks.setdefault(path, Lock())
+        finally:
+            self._locks_lock.release()
+
+    def update(self, url):
+        """ Create or refresh mirror of url, return its path """
+        path, file_lock = self.lock_updated(url)
+        unlock_file(file_lock)
+        return path
+
+    def lock_updated(self, url):
+        """
+        Create or refresh mirror of url under exclusive lock, then downgrade the lock to shared one,
+        so mirror cannot be evicted until it's unlocked. Return (path, lock handle for unlock_file).
+        """
+        path = self.get_mirror_path(url)
+        thread_lock = self._get_thread_lock(path)
+        thread_lock.acquire()
+        try:
+            file_lock = lock_file(path + ".lock")
+            try:
+                if os.path.exists(path):
+                    GitRunner(git_dir=path).check_call(["remote", "update", "--prune"])
+                else:
+                    GitRunner().check_call(["clone", "--mirror", url, path])
+                downgrade_lock(file_lock)
+            except:
+                unlock_file(file_lock)
+                raise
+        finally:
+            thread_lock.release()
+
+        self.touch(path)
+        return path, file_lock
+
+    def touch(self, path):
+        f = open(os.path.join(path, self.LAST_USED_FILE_NAME), 'w')
+        f.write(str(time()))
         f.close()
 
-    return dir
+    def clone(self, url, workdir=None, branch=None, history_only=False, checkout_paths=None):
+        """
+        Refresh mirror and make cheap local clone from it. Return filesystem path of clone.
+
+        Mirror stays locked from its update until it's cloned, so it cannot be evicted in the meantime;
+        clone does not borrow its objects, so it can outlive the mirror.
+        """
+        mirror, file_lock = self.lock_updated(url)
+        try:
+            dir = os.path.abspath(os.path.join(mkdtemp(dir=workdir), "repository"))
+
+            clone = ["clone"]
+            if history_only:
+                clone.extend(["--no-checkout", "--single-branch"])
+            if branch:
+                clone.extend(["--branch", branch])
+            clone.extend([mirror, dir])
+
+            GitRunner().check_call(clone)
+        finally:
+            unlock_file(file_lock)
+        GitRunner(repository_directory=dir).check_call(["remote", "set-url", "origin", url])
+
+        if history_only and checkout_paths:
+            checkout_repository_paths(dir, checkout_paths)
+
+        return dir
+
+    def get_mirrors(self):
+        """ Return list of (last used timestamp, path) of all mirrors, least recently used first """
+        mirrors = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".git") and os.path.isdir(path):
+                last_used = os.path.join(path, self.LAST_USED_FILE_NAME)
+                if os.path.exists(last_used):
+                    mirrors.append((os.stat(last_used).st_mtime, path))
+                else:
+                    mirrors.append((0, path))
+        mirrors.sort()
+        return mirrors
+
+    def evict(self, max_size=None, keep=None):
+        """
+        Remove least recently used mirrors until their total size is under max_size.
+        Mirrors being updated or cloned at the moment (their lock is held) are skipped.
+        Lock files are never removed, so that nobody can lock already unlinked one.
+        Return list of removed paths.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return []
+        keep = keep or []
+
+        mirrors = [(last_used, path, get_directory_size(path)) for last_used, path in self.get_mirrors()]
+        total_size = sum([size for last_used, path, size in mirrors])
+
+        removed = []
+        for last_used, path, size in mirrors:
+            if total_size <= max_size:
+                break
+            if path in keep:
+                continue
+
+            file_lock = lock_file(path + ".lock", blocking=False)
+            if file_lock is None:
+                continue
+            try:
+                rmtree(path)
+            finally:
+                unlock_file(file_lock)
+
+            total_size -= size
+            removed.append(path)
+
+        return removed
+
+
+def get_cursor_collection(collection):
+    """ Return collection holding import cursors for changesets stored in collection """
+    return collection.database["%s_cursors" % collection.name]
 
+def ensure_metadata_indexes(collection):
+    """ Create indexes used for incremental imports of changesets into collection """
+    collection.create_index([("repository_uri", 1), ("hash", 1)])
+    collection.create_index([("repository_uri", 1), ("commit_order", -1)])
+    get_cursor_collection(collection).create_index([("repository_uri", 1), ("branch", 1)], unique=True)
 
+def get_repository_cursor(collection, repository_uri, branch):
+    """ Return cursor document ({repository_uri, branch, hash, commit_order}) or None """
+    return get_cursor_collection(collection).find_one({"repository_uri" : repository_uri, "branch" : branch})
 
-def get_last_revision(collection, repository_uri=None):
+def store_repository_cursor(collection, repository_uri, branch, changeset):
+    """ Remember changeset as last imported one for branch of repository """
+    get_cursor_collection(collection).update(
+        {"repository_uri" : repository_uri, "branch" : branch},
+        {"$set" : {"hash" : changeset['hash'], "commit_order" : changeset.get('commit_order', None)}},
+        upsert=True
+    )
+
+def get_last_stored_changeset(collection, repository_uri):
+    """ Return changeset with highest commit_order stored for repository, or None """
+    result = list(collection.find({"repository_uri" : repository_uri, "commit_order" : {"$exists" : True}}).sort([("commit_order", -1)]).limit(1))
+    if result:
+        return result[0]
+    return None
+
+def get_last_revision(collection, repository_uri=None, branch=None):
+    """
+    Return hash of last imported changeset for repository.
+
+    Cursor of given branch is used if available, then changeset with highest commit_order;
+    for collections filled before commit_order was stored, last inserted document is taken.
+    """
     if not repository_uri:
         repository_uri = get_repository_uri()
 
     assert repository_uri
 
-    from pymongo import DESCENDING
-    result = collection.find({"repository_uri" : repository_uri}).sort([("$natural", DESCENDING),]).limit(1)
+    if branch:
+        cursor = get_repository_cursor(collection, repository_uri, branch)
+        if cursor:
+            return cursor['hash']
+
+    last = get_last_stored_changeset(collection, repository_uri)
+    if last:
+        return last['hash']
+
+    result = collection.find({"repository_uri" : repository_uri}).sort([("$natural", -1),]).limit(1)
     if result.count() == 0:
         return None
     else:
         return list(result)[0]['hash']
 
-def get_revision_metadata_property(changeset, property, filter=None, encoding="utf-8"):
+def number_changesets(data, start=0):
+    """ Yield changesets from data with commit_order set, starting after start """
+    order = start
+    for item in data:
+        order += 1
+        item['commit_order'] = order
+        yield item
+
+def get_current_branch_name(runner=None):
+    """ Return name of checked out branch, or HEAD when detached """
+    runner = runner or GitRunner()
+    reader = get_ref_reader(runner)
+    if reader is not None:
+        try:
+            branch = reader.get_head()[0]
+        except ValueError:
+            pass
+        else:
+            if branch and branch.startswith("refs/heads/"):
+                return branch[len("refs/heads/"):]
+            elif not branch:
+                return "HEAD"
+
+    returncode, stdout, stderr = runner.run(["symbolic-ref", "-q", "HEAD"])
+    if returncode != 0 or not stdout.strip().startswith("refs/heads/"):
+        return "HEAD"
+    return stdout.strip()[len("refs/heads/"):]
+
+def get_git_date_format(filters):
+    """ Return --date option for git output read by filters: raw only when all of them are filter_parse_date """
+    for filter in filters:
+        if filter is not filter_parse_date:
+            return LOCAL_GIT_DATE_FORMAT
+    return GIT_DATE_FORMAT
+
+def get_revision_metadata_property(changeset, property, filter=None, encoding="utf-8", runner=None):
     default_filter = lambda x: x.decode(encoding)
     filter = filter or default_filter
+    runner = runner or GitRunner()
 
-    cmd = ["git", "show", "--quiet", '--date=local', '--pretty=format:%s' % property, changeset]
-    proc = Popen(cmd, stdout=PIPE, stderr=PIPE, env={"LC_ALL" : USED_GIT_PARSING_LOCALE})
-    stdout, stderr = proc.communicate()
+    cmd = ["show", "--quiet", get_git_date_format([filter]), '--pretty=format:%s' % property, changeset]
+    returncode, stdout, stderr = runner.run(cmd)
 
     # --quiet causes git show to returncode 1
-    if proc.returncode not in (0, 1):
+    if returncode not in (0, 1):
         log.error("Cannot retrieve log: stdout: %s stderr: %s" % (stdout, stderr))
-        raise CalledProcessError(proc.returncode, cmd)
+        raise CalledProcessError(returncode, ["git"] + cmd)
 
     return filter(stdout.strip())
 
 def filter_parse_date(stdout, used_locale=None):
-    """ Construct a datetime object from local date string returned by git show """
-    # originally, we just passed this to strptime, but it turned out it's not exactly
-    # working for some cases, such as single-digit days
-    
-    setlocale(LC_ALL, used_locale or USED_GIT_PARSING_LOCALE)
-    
+    """
+    Construct a (naive, local time) datetime object from date returned by git show,
+    either --date=raw one (epoch and timezone) or --date=local one (in english).
+
+    Locale is never touched, so this is safe to use from many threads; used_locale is ignored.
+    """
+    match = RAW_DATE_PATTERN.match(stdout)
+    if match:
+        return datetime.fromtimestamp(int(match.group('timestamp')))
+
     # use regexp to sniff what we want, skipping things like TZ info
-    match = re.match(r"^(?P<dow>\w+)\ {1}(?P<month>\w+)\ {1}(?P<day>\d{1,2})\ {1}(?P<hour>\d{1,2})\:{1}(?P<minute>\d{1,2})\:{1}(?P<second>\d{1,2})\ {1}(?P<year>\d+).*$", stdout, re.UNICODE)
-    if not match:
+    match = LOCAL_DATE_PATTERN.match(stdout)
+    if not match or match.group('dow')[:3] not in DAYS_OF_WEEK or match.group('month')[:3] not in MONTHS:
         raise ValueError("Date '%s' is not matching our format, please report bug" % str(stdout))
     data = match.groupdict()
-    # to be able to provide zero-padded values, non-string values must be integers 
-    data.update(dict([(key, int(value)) for key, value in data.items() if key not in ["dow", "month"]]))
-    date = datetime.strptime("%(dow)s %(month)s %(day)02d %(hour)02d:%(minute)02d:%(second)02d %(year)04d" % data,
-        "%a %b %d %H:%M:%S %Y"
-    )
-    resetlocale()
-    return date
+    return datetime(int(data['year']), MONTHS[data['month'][:3]], int(data['day']),
+        int(data['hour']), int(data['minute']), int(data['second']))
     
-def get_repository_uri():
-    cmd = ["git", "config", "remote.origin.url"]
-    proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = proc.communicate()
+def get_repository_uri(runner=None):
+    runner = runner or GitRunner()
+    returncode, stdout, stderr = runner.run(["config", "remote.origin.url"])
     return stdout.strip()
 
-def get_revision_metadata(changeset, metadata_property_map=None, repository_uri=None, encoding="utf-8"):
+def _decode_commit_field(field):
+    def decode(session, commit, encoding):
+        return commit[field].decode(commit['encoding'] or encoding)
+    return decode
+
+def _commit_date(field):
+    def date(session, commit, encoding):
+        # same as what filter_parse_date gives us
+        return datetime.fromtimestamp(commit[field])
+    return date
+
+# properties of default metadata map that can be answered from GitSession.read_commit
+SESSION_METADATA_PROPERTIES = {
+    "%h" : lambda session, commit, encoding: session.abbreviate(commit['hash']).decode(encoding),
+    "%H" : lambda session, commit, encoding: commit['hash'].decode(encoding),
+    "%aN" : _decode_commit_field('author_name'),
+    "%ae" : _decode_commit_field('author_email'),
+    "%ad" : _commit_date('author_timestamp'),
+    "%cN" : _decode_commit_field('commiter_name'),
+    "%ce" : _decode_commit_field('commiter_email'),
+    "%cd" : _commit_date('commiter_timestamp'),
+    "%s" : _decode_commit_field('subject'),
+}
+
+# names are translated by .mailmap in git log, which session does not do
+MAILMAP_METADATA_PROPERTIES = ["%aN", "%cN"]
+
+def get_session_metadata(session, changeset, encoding="utf-8"):
+    """ Return {property : value} for properties from SESSION_METADATA_PROPERTIES session is able to answer """
+    try:
+        commit = session.read_commit(changeset)
+    except ValueError:
+        log.error("Cannot read commit %s from session: %s" % (changeset, traceback.format_exc()))
+        return {}
+
+    values = {}
+    for property, extract in SESSION_METADATA_PROPERTIES.items():
+        if property in MAILMAP_METADATA_PROPERTIES and session.has_mailmap():
+            continue
+        try:
+            values[property] = extract(session, commit, encoding)
+        except (KeyError, ValueError):
+            log.error("Error when parsing metadata: %s" % traceback.format_exc())
+    return values
+
+DEFAULT_METADATA_PROPERTY_MAP = {
+    "%h" : {'name' : "hash_abbrev"},
+    "%H" : {'name' : "hash"},
+    "%aN" : {'name' : "author_name"},
+    "%ae" : {'name' : "author_email"},
+    "%ad" : {'name' : "author_date", 'filter' : filter_parse_date},
+    "%cN" : {'name' : "commiter_name"},
+    "%ce" : {'name' : "commiter_email"},
+    "%cd" : {'name' : "commiter_date", 'filter' : filter_parse_date},
+    "%s" : {'name' : "subject"},
+}
+
+# git log output is split into commits by NUL (-z) and into properties by ASCII unit separator
+METADATA_RECORD_SEPARATOR = "\x00"
+METADATA_FIELD_SEPARATOR = "\x1f"
+
+METADATA_READ_SIZE = 64 * 1024
+DEFAULT_METADATA_CHUNK_SIZE = 500
+
+def get_revision_metadata(changeset, metadata_property_map=None, repository_uri=None, encoding="utf-8", runner=None, session=None):
     """
     Return dictionary of metadatas defined in metadata_property_map.
 
     Uses slow solution (git log query per property) to avoid "delimiter inside result" problem.
+    When GitSession is given, commit is read from it instead and only what session cannot answer
+    (or what has custom filter in metadata_property_map) is asked from git log.
+    For ranges of commits, use retrieve_repository_metadata.
     """
-    
-    # it looks like git is displaying time in en_US locale even if, i.e. cs_CZ
-    # is set, which is bad when using with %a or %b...so hack it
-    
-    setlocale(LC_ALL, USED_GIT_PARSING_LOCALE)
 
     metadata = {
-        "repository_uri" : repository_uri or get_repository_uri()
+        "repository_uri" : repository_uri or get_repository_uri(runner=runner)
     }
 
-    metadata_property_map = metadata_property_map or {
-        "%h" : {'name' : "hash_abbrev"},
-        "%H" : {'name' : "hash"},
-        "%aN" : {'name' : "author_name"},
-        "%ae" : {'name' : "author_email"},
-        "%ad" : {'name' : "author_date", 'filter' : filter_parse_date},
-        "%cN" : {'name' : "commiter_name"},
-        "%ce" : {'name' : "commiter_email"},
-        "%cd" : {'name' : "commiter_date", 'filter' : filter_parse_date},
-        "%s" : {'name' : "subject"},
+    metadata_property_map = metadata_property_map or DEFAULT_METADATA_PROPERTY_MAP
 
-    }
+    answered = {}
+    if session is not None:
+        answered = get_session_metadata(session, changeset, encoding=encoding)
+        # value from session is what default filter gives, custom filters need git output
+        for property in answered.keys():
+            if metadata_property_map.get(property, {}).get('filter', None) is not DEFAULT_METADATA_PROPERTY_MAP[property].get('filter', None):
+                del answered[property]
 
     for property in metadata_property_map:
+        if property in answered:
+            metadata[metadata_property_map[property]['name']] = answered[property]
+            continue
+
         if 'filter' in metadata_property_map[property]:
             filter = metadata_property_map[property]['filter']
         else:
             filter = None
         try:
-            metadata[metadata_property_map[property]['name']] = get_revision_metadata_property(changeset, property, filter)
+            metadata[metadata_property_map[property]['name']] = get_revision_metadata_property(changeset, property, filter, runner=runner)
         except (CalledProcessError, ValueError):
             metadata[metadata_property_map[property]['name']] = "[failed to retrieve]"
             log.error("Error when parsing metadata: %s" % traceback.format_exc())
 
-    resetlocale()
     return metadata
 
+def parse_metadata_record(record, properties, metadata_property_map, repository_uri=None, encoding="utf-8", runner=None, session=None):
+    """
+    Return metadata dictionary from one git log record, which is commit hash followed by properties,
+    separated by METADATA_FIELD_SEPARATOR.
+
+    If separator is part of some value, record cannot be split reliably and properties are
+    retrieved by get_revision_metadata, through session when given.
+    """
+    fields = record.split(METADATA_FIELD_SEPARATOR)
+    if len(fields) != len(properties) + 1:
+        return get_revision_metadata(fields[0].strip(), metadata_property_map=metadata_property_map,
+            repository_uri=repository_uri, encoding=encoding, runner=runner, session=session)
+
+    metadata = {
+        "repository_uri" : repository_uri
+    }
+
+    for property, value in zip(properties, fields[1:]):
+        filter = metadata_property_map[property].get('filter', None) or (lambda x: x.decode(encoding))
+        try:
+            metadata[metadata_property_map[property]['name']] = filter(value.strip())
+        except ValueError:
+            metadata[metadata_property_map[property]['name']] = "[failed to retrieve]"
+            log.error("Error when parsing metadata: %s" % traceback.format_exc())
+
+    return metadata
 
-def retrieve_repository_metadata(changeset, repository_uri=None, encoding="utf-8"):
+def iter_repository_metadata(changeset, repository_uri=None, encoding="utf-8", runner=None, metadata_property_map=None, session=None):
     """
-    Return list of dictionaris with metadata about changesets since revision to current
+    Yield dictionaries with metadata about changesets since revision to current, as git log streams them.
+
+    Changesets are yielded in topological order, oldest first (every changeset after all its parents),
+    so when they are stored in this order, last stored changeset is a safe point to resume from.
+    This ordering has its price: git has to walk the whole range (keeping it in memory) before
+    first changeset is written out, so only parsing and storing is streamed. Incremental imports
+    keep the range small; first import of a big repository waits for the walk.
+
+    Commits that cannot be split from git log output are looked up one by one, through
+    GitSession when given (instead of git show per property).
     """
-    command = ["git", "log", r'--pretty=format:%H']
+    runner = runner or (session and session.runner) or GitRunner()
+    metadata_property_map = metadata_property_map or DEFAULT_METADATA_PROPERTY_MAP
+    properties = list(metadata_property_map)
+
+    format = "%x1f".join(["%H"] + properties)
+    date_format = get_git_date_format([metadata_property_map[property].get('filter', None)
+        for property in properties if property in GIT_DATE_PROPERTIES])
+    command = ["log", "-z", "--topo-order", "--reverse", date_format, "--pretty=format:%s" % format]
     if changeset:
         command.append("%s.." % changeset)
-    proc = Popen(command, stdout=PIPE, stderr=PIPE)
-    stdout, stderr = proc.communicate()
 
-    if not proc.returncode == 0:
-        log.error("Cannot retrieve log: stdout: %s stderr: %s" % (stdout, stderr))
-        raise CalledProcessError(proc.returncode, command)
+    repository_uri = repository_uri or get_repository_uri(runner=runner)
 
-    metadata = []
-    hashes = stdout.splitlines()
-    hashes.reverse()
-    for hash in hashes:
-        metadata.append(get_revision_metadata(hash, repository_uri=repository_uri, encoding=encoding))
+    # stderr is not read until log is done; pipe could fill up and block git
+    errors = TemporaryFile()
+    proc = runner.popen(command, bufsize=-1, stderr=errors)
+    try:
+        buffer = ''
+        while True:
+            data = proc.stdout.read(METADATA_READ_SIZE)
+            if not data:
+                break
+            records = (buffer + data).split(METADATA_RECORD_SEPARATOR)
+            buffer = records.pop()
+            for record in records:
+                yield parse_metadata_record(record, properties, metadata_property_map,
+                    repository_uri=repository_uri, encoding=encoding, runner=runner, session=session)
 
-    return metadata
+        if proc.wait() != 0:
+            errors.seek(0)
+            log.error("Cannot retrieve log: stderr: %s" % errors.read())
+            raise CalledProcessError(proc.returncode, ["git"] + command)
 
-def store_repository_metadata(collection, data):
-    for item in data:
-        if 'hash' not in item:
-            raise ValueError("Trying to store metadata for changeset without hash! %s" % str(item))
-        
-        if '_id' not in item:
-            older_version = collection.find_one({'hash' : item['hash']})
-            if older_version:
-                older_version.update(item)
-                item = older_version
+        if buffer:
+            yield parse_metadata_record(buffer, properties, metadata_property_map,
+                repository_uri=repository_uri, encoding=encoding, runner=runner, session=session)
+    finally:
+        if proc.returncode is None:
+            # consumer is not interested in rest of the log
+            proc.stdout.close()
+            proc.wait()
+        errors.close()
+
+def retrieve_repository_metadata(changeset, repository_uri=None, encoding="utf-8", runner=None, metadata_property_map=None, session=None):
+    """
+    Return list of dictionaris with metadata about changesets since revision to current
+
+    Whole range is read by single git log call; see iter_repository_metadata.
+    """
+    return list(iter_repository_metadata(changeset, repository_uri=repository_uri, encoding=encoding,
+        runner=runner, metadata_property_map=metadata_property_map, session=session))
+
+def iter_chunks(iterable, size):
+    """ Yield lists of up to size items from iterable """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def get_stored_hashes(collection, items):
+    """
+    Return set of (repository_uri, hash) of items already stored in collection, using one query
+    per repository. For items without repository_uri, any repository matches (and None is used as uri).
+    """
+    hashes_by_uri = {}
+    for item in items:
+        hashes_by_uri.setdefault(item.get('repository_uri', None), []).append(item['hash'])
+
+    stored = set()
+    for repository_uri, hashes in hashes_by_uri.items():
+        spec = {'hash' : {'$in' : hashes}}
+        if repository_uri is not None:
+            spec['repository_uri'] = repository_uri
+        for document in collection.find(spec, {'hash' : 1}):
+            stored.add((repository_uri, document['hash']))
+    return stored
+
+def get_metadata_spec(item):
+    if '_id' in item:
+        return {'_id' : item['_id']}
+    spec = {'hash' : item['hash']}
+    if item.get('repository_uri', None) is not None:
+        spec['repository_uri'] = item['repository_uri']
+    return spec
+
+def get_metadata_update(item):
+    return {'$set' : dict([(key, value) for key, value in item.items() if key != '_id'])}
+
+def update_metadata(collection, items):
+    """ Upsert items into collection, with unordered bulk operation if pymongo supports it """
+    if not items:
+        return
+
+    try:
+        from pymongo import UpdateOne
+    except ImportError:
+        UpdateOne = None
+
+    if UpdateOne is not None and hasattr(collection, 'bulk_write'):
+        collection.bulk_write([UpdateOne(get_metadata_spec(item), get_metadata_update(item), upsert=True) for item in items], ordered=False)
+
+    elif hasattr(collection, 'initialize_unordered_bulk_op'):
+        bulk = collection.initialize_unordered_bulk_op()
+        for item in items:
+            bulk.find(get_metadata_spec(item)).upsert().update(get_metadata_update(item))
+        bulk.execute()
+
+    else:
+        for item in items:
+            collection.update(get_metadata_spec(item), get_metadata_update(item), upsert=True)
+
+def insert_metadata(collection, items, manipulate=False):
+    """ Insert new items into collection by one batch """
+    if not items:
+        return
+
+    if not manipulate and hasattr(collection, 'insert_many'):
+        collection.insert_many(items, ordered=False)
+    else:
+        collection.insert(items, manipulate=manipulate)
+
+def store_repository_metadata(collection, data, chunk_size=DEFAULT_METADATA_CHUNK_SIZE, manipulate=False, chunk_stored_callback=None):
+    """
+    Store changesets from data (may be a generator) into collection, chunk_size of them at once.
+    Return number of changesets stored.
 
-        collection.save(item)
+    For every chunk, already stored changesets are found by one query; new ones are then inserted
+    in one batch and stored ones are upserted in one unordered bulk operation.
+
+    Changesets are plain documents, so SON manipulators of database are bypassed,
+    unless manipulate is True.
+
+    chunk_stored_callback is called with every chunk after it has been stored.
+    """
+    stored = 0
+    for chunk in iter_chunks(data, chunk_size):
+        for item in chunk:
+            if 'hash' not in item:
+                raise ValueError("Trying to store metadata for changeset without hash! %s" % str(item))
+
+        stored_hashes = get_stored_hashes(collection, [item for item in chunk if '_id' not in item])
+
+        new_items, updated_items = [], []
+        for item in chunk:
+            key = (item.get('repository_uri', None), item['hash'])
+            if '_id' in item or key in stored_hashes:
+                updated_items.append(item)
+            else:
+                new_items.append(item)
+                # same changeset later in chunk is an update
+                stored_hashes.add(key)
+
+        insert_metadata(collection, new_items, manipulate=manipulate)
+        update_metadata(collection, updated_items)
+
+        stored += len(chunk)
+        log.info("Stored %s changesets, last one is %s" % (stored, chunk[-1]['hash']))
+
+        if chunk_stored_callback:
+            chunk_stored_callback(chunk)
+    return stored
+
+def import_repository_metadata(collection, repository_uri, runner=None, branch=None, chunk_size=DEFAULT_METADATA_CHUNK_SIZE, manipulate=False, session=None):
+    """
+    Store changesets of repository (accessed through runner) not yet stored in collection.
+    Import continues from last stored changeset and cursor of branch is kept updated.
+
+    Per-commit lookups go through session; own one is opened if not given.
+
+    Return number of changesets stored.
+    """
+    runner = runner or (session and session.runner) or GitRunner()
+    branch = branch or get_current_branch_name(runner=runner)
+
+    # import is streamed and stored in chunks; when interrupted, next run
+    # continues from last stored changeset
+    changeset = get_last_revision(collection, repository_uri=repository_uri, branch=branch)
+    last = get_last_stored_changeset(collection, repository_uri)
+
+    own_session = session is None
+    if own_session:
+        session = GitSession(runner=runner)
+
+    try:
+        data = number_changesets(
+            iter_repository_metadata(changeset, repository_uri=repository_uri, runner=runner, session=session),
+            start=(last and last['commit_order']) or 0
+        )
+
+        return store_repository_metadata(collection, data, chunk_size=chunk_size, manipulate=manipulate,
+            chunk_stored_callback=lambda chunk: store_repository_cursor(collection, repository_uri, branch, chunk[-1]))
+    finally:
+        if own_session:
+            session.close()
+
+def harvest_repository(collection, repository, cache_directory=None, chunk_size=DEFAULT_METADATA_CHUNK_SIZE, manipulate=False):
+    """
+    Import metadata of repository, which is either path to local clone (identified by its origin)
+    or URI, which is cloned (or refreshed, if already cached) in cache_directory first.
+    Without cache_directory, history of repository is cloned into temporary directory,
+    removed when import is done.
+
+    Return number of changesets stored.
+    """
+    if os.path.isdir(repository):
+        runner = GitRunner(repository_directory=repository)
+        repository_uri = get_repository_uri(runner=runner) or os.path.abspath(repository)
+        return import_repository_metadata(collection, repository_uri, runner=runner, chunk_size=chunk_size, manipulate=manipulate)
+
+    if cache_directory:
+        directory, lock = fetch_locked_repository(repository, workdir=cache_directory, cache_config_dir=cache_directory, refresh_ttl=0)
+        try:
+            return import_repository_metadata(collection, repository, runner=GitRunner(repository_directory=directory),
+                chunk_size=chunk_size, manipulate=manipulate)
+        finally:
+            if lock is not None:
+                unlock_file(lock)
+
+    directory = fetch_repository(repository, cache_config_dir=False, history_only=True)
+    try:
+        return import_repository_metadata(collection, repository, runner=GitRunner(repository_directory=directory),
+            chunk_size=chunk_size, manipulate=manipulate)
+    finally:
+        rmtree(os.path.dirname(directory), ignore_errors=True)
+
+def harvest_repositories(repositories, get_collection, jobs=1, cache_directory=None, chunk_size=DEFAULT_METADATA_CHUNK_SIZE, manipulate=False):
+    """
+    Harvest metadata of all repositories by up to jobs threads, sharing collection
+    obtained by calling get_collection once. Number of sockets used at once is limited
+    by pool size of its connection.
+
+    Failure of one repository does not stop the others. Return list of
+    {repository, stored, time, error} dictionaries, in order of repositories.
+    """
+    repositories = list(repositories)
+    collection = get_collection()
+    ensure_metadata_indexes(collection)
+
+    def harvest(repository):
+        start = time()
+        try:
+            stored = harvest_repository(collection, repository, cache_directory=cache_directory,
+                chunk_size=chunk_size, manipulate=manipulate)
+        except Exception:
+            log.error("Harvesting of %s failed: %s" % (repository, traceback.format_exc()))
+            return {'repository' : repository, 'stored' : 0, 'time' : time() - start, 'error' : traceback.format_exc()}
+        return {'repository' : repository, 'stored' : stored, 'time' : time() - start, 'error' : None}
+
+    return map_in_threads(harvest, repositories, jobs=jobs)
+
+MONGODB_USER_OPTIONS = [
+    ("mongodb-host=", None, "mongo database host"),
+    ("mongodb-port=", None, "mongo database port"),
+    ("mongodb-username=", None, "mongo connection username"),
+    ("mongodb-password=", None, "mongo connection password"),
+    ("mongodb-database=", None, "mongo database name"),
+    ("mongodb-collection=", None, "mongo collection to store data to"),
+    ("mongodb-pool-size=", None, "maximum number of sockets kept open to mongo database"),
+    ("mongodb-timeout=", None, "mongo connect and socket timeout, in seconds"),
+]
 
 class SaveRepositoryInformationGit(Command):
     """ Store repository metadata information in mongo database for cthulhubot usage """
 
     description = ""
 
-    user_options = [
-        ("mongodb-host=", None, "mongo database host"),
-        ("mongodb-port=", None, "mongo database port"),
-        ("mongodb-username=", None, "mongo connection username"),
-        ("mongodb-password=", None, "mongo connection password"),
-        ("mongodb-database=", None, "mongo database name"),
-        ("mongodb-collection=", None, "mongo collection to store data to"),
+    user_options = MONGODB_USER_OPTIONS + [
         ("repository-uri=", None, "repository URL for identification"),
+        ("chunk-size=", None, "number of changesets stored at once (default %s)" % DEFAULT_METADATA_CHUNK_SIZE),
+        ("use-son-manipulators", None, "pass stored changesets through database SON manipulators"),
+        ("branch=", None, "branch to store import cursor for (default is current one)"),
     ]
 
+    boolean_options = ["use-son-manipulators"]
+
     def initialize_options(self):
         self.mongodb_host = None
         self.mongodb_port = None
@@ -223,7 +1553,12 @@ class SaveRepositoryInformationGit(Command):
         self.mongodb_password = None
         self.mongodb_database = None
         self.mongodb_collection = None
+        self.mongodb_pool_size = None
+        self.mongodb_timeout = None
         self.repository_uri = None
+        self.chunk_size = None
+        self.use_son_manipulators = False
+        self.branch = None
 
     def finalize_options(self):
         self.mongodb_host = self.mongodb_host or "localhost"
@@ -238,18 +1573,102 @@ class SaveRepositoryInformationGit(Command):
         if not self.mongodb_collection:
             raise DistutilsOptionError("Mongodb collection not given")
 
+        try:
+            self.mongodb_pool_size = self.mongodb_pool_size and int(self.mongodb_pool_size) or None
+            self.mongodb_timeout = self.mongodb_timeout and float(self.mongodb_timeout) or None
+        except ValueError:
+            raise DistutilsOptionError("mongodb-pool-size and mongodb-timeout must be numbers")
 
-    def run(self):
-        from citools.mongo import get_database_connection
-        collection = get_database_connection(
+        try:
+            self.chunk_size = int(self.chunk_size or DEFAULT_METADATA_CHUNK_SIZE)
+        except ValueError:
+            raise DistutilsOptionError("chunk-size must be a number")
+        if self.chunk_size < 1:
+            raise DistutilsOptionError("chunk-size must be positive")
+
+
+    def get_collection(self):
+        from citools.mongo import get_database_connection, DEFAULT_POOL_SIZE
+        return get_database_connection(
             hostname=self.mongodb_host,
             port=self.mongodb_port,
             database=self.mongodb_database,
             username=self.mongodb_username,
-            password=self.mongodb_password
+            password=self.mongodb_password,
+            pool_size=self.mongodb_pool_size or DEFAULT_POOL_SIZE,
+            connect_timeout=self.mongodb_timeout,
+            socket_timeout=self.mongodb_timeout,
         )[self.mongodb_collection]
-        
-        changeset = get_last_revision(collection, repository_uri=self.repository_uri)
-        data = retrieve_repository_metadata(changeset, repository_uri=self.repository_uri)
-        store_repository_metadata(collection, data)
+
+    def run(self):
+        collection = self.get_collection()
+
+        runner = GitRunner()
+        repository_uri = self.repository_uri or get_repository_uri(runner=runner)
+
+        ensure_metadata_indexes(collection)
+
+        import_repository_metadata(collection, repository_uri, runner=runner, branch=self.branch,
+            chunk_size=self.chunk_size, manipulate=self.use_son_manipulators)
+
+class HarvestRepositoriesInformationGit(SaveRepositoryInformationGit):
+    """ Store metadata of many repositories in mongo database for cthulhubot usage, in parallel """
+
+    description = "store metadata of given repositories into mongo database"
+
+    user_options = MONGODB_USER_OPTIONS + [
+        ("repositories=", None, "comma or whitespace separated list of repository URIs or local paths"),
+        ("repository-list=", None, "file with repository URIs or local paths, one per line"),
+        ("cache-directory=", None, "directory to clone (and cache) remote repositories in"),
+        ("jobs=", "j", "number of repositories harvested in parallel"),
+        ("chunk-size=", None, "number of changesets stored at once (default %s)" % DEFAULT_METADATA_CHUNK_SIZE),
+        ("use-son-manipulators", None, "pass stored changesets through database SON manipulators"),
+    ]
+
+    def initialize_options(self):
+        SaveRepositoryInformationGit.initialize_options(self)
+        self.repositories = None
+        self.repository_list = None
+        self.cache_directory = None
+        self.jobs = None
+
+    def finalize_options(self):
+        SaveRepositoryInformationGit.finalize_options(self)
+
+        repositories = (self.repositories or '').replace(',', ' ').split()
+        if self.repository_list:
+            f = open(self.repository_list)
+            try:
+                repositories.extend([line.strip() for line in f if line.strip() and not line.strip().startswith('#')])
+            finally:
+                f.close()
+
+        if not repositories:
+            raise DistutilsOptionError("No repositories given")
+        self.repositories = repositories
+
+        try:
+            self.jobs = int(self.jobs or 1)
+        except ValueError:
+            raise DistutilsOptionError("jobs must be a number")
+
+        # every job needs its socket
+        self.mongodb_pool_size = self.mongodb_pool_size or self.jobs
+
+    def run(self):
+        start = time()
+        results = harvest_repositories(self.repositories, self.get_collection, jobs=self.jobs,
+            cache_directory=self.cache_directory,
+            chunk_size=self.chunk_size, manipulate=self.use_son_manipulators)
+
+        for result in results:
+            if result['error']:
+                print "%(repository)s: FAILED after %(time).2fs" % result
+            else:
+                print "%(repository)s: %(stored)s changesets stored in %(time).2fs" % result
+        print "Harvested %s repositories in %.2fs" % (len(results), time() - start)
+
+        failed = [result['repository'] for result in results if result['error']]
+        if failed:
+            raise DistutilsExecError("Harvesting failed for %s" % ', '.join(failed))
 
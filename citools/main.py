@@ -5,6 +5,7 @@ import os
 import sys
 
 from argparse import ArgumentParser
+from ConfigParser import NoOptionError, NoSectionError
 
 from citools.config import Configuration
 from citools.backup import Backuper
@@ -18,6 +19,36 @@ def restore_backup(config):
     backuper.clean_backup()
     return 0
 
+def repository_gc(config):
+    """
+    Evict repositories cached by fetch_repository. Configured in [repository_cache] section:
+    directory (required), file_name, max_size (in bytes) and max_age (in seconds).
+    """
+    from citools.git import collect_repository_cache
+
+    def get_option(option, default=None):
+        try:
+            return config.get("repository_cache", option)
+        except (NoSectionError, NoOptionError):
+            return default
+
+    directory = get_option("directory")
+    if not directory:
+        print "Cache directory not configured, set directory in [repository_cache] section"
+        return 1
+
+    max_size = get_option("max_size")
+    max_age = get_option("max_age")
+
+    removed = collect_repository_cache(
+        directory = directory,
+        file_name = get_option("file_name", "cached_repositories.ini"),
+        max_size = max_size and int(max_size),
+        max_age = max_age and int(max_age),
+    )
+    print "Removed %s cached repositories" % len(removed)
+    return 0
+
 def validate_arguments(config):
     print "Arguments are valid"
     return 0
@@ -70,4 +101,5 @@ def main(argv=None, config=None, do_exit=True):
 ACTIONS_MAP = {
     "restore_backup" : restore_backup,
     "validate_arguments" : validate_arguments,
+    "repository_gc" : repository_gc,
 }
\ No newline at end of file
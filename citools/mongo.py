@@ -1,27 +1,98 @@
+from threading import Lock
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
 from pymongo.son_manipulator import AutoReference
 from pymongo.son_manipulator import NamespaceInjector
-from pymongo.connection import Connection
+
+try:
+    from pymongo import MongoClient
+except ImportError:
+    # pymongo < 2.4
+    MongoClient = None
+    from pymongo.connection import Connection
 
 import logging
 
 log = logging.getLogger("citools.mongo")
 
-def get_mongo_and_database_connections(hostname=None, port=27017, database=None, username=None, password=None):
-    connection = Connection(hostname, int(port))
+DEFAULT_POOL_SIZE = 10
+
+# (hostname, port, database, username, password hash) -> (database, connection)
+_connections = {}
+_connections_lock = Lock()
+
+def create_connection(hostname=None, port=27017, pool_size=DEFAULT_POOL_SIZE, connect_timeout=None, socket_timeout=None):
+    """
+    Return new connection keeping up to pool_size sockets open.
+    Timeouts are in seconds, None meaning no timeout.
+    """
+    if MongoClient is not None:
+        kwargs = {'maxPoolSize' : pool_size}
+        if connect_timeout is not None:
+            kwargs['connectTimeoutMS'] = int(connect_timeout * 1000)
+        if socket_timeout is not None:
+            kwargs['socketTimeoutMS'] = int(socket_timeout * 1000)
+        return MongoClient(hostname, int(port), **kwargs)
+    else:
+        return Connection(hostname, int(port), max_pool_size=pool_size, network_timeout=socket_timeout)
+
+def disconnect(connection):
+    # disconnect() has been renamed to close() in newer pymongo
+    if hasattr(connection, 'close'):
+        connection.close()
+    else:
+        connection.disconnect()
+
+def get_mongo_and_database_connections(hostname=None, port=27017, database=None, username=None, password=None, pool_size=DEFAULT_POOL_SIZE, connect_timeout=None, socket_timeout=None):
+    """
+    Return (database, connection) tuple.
+
+    Connections are shared by whole process: first call for given hostname, port, database
+    and credentials connects, authenticates and installs SON manipulators, following calls
+    (from any thread) get the same pooled connection. Pool size and timeouts are thus
+    taken from the first call only.
+    """
+    port = int(port or 27017)
+    # password is part of key, so that wrong one is never accepted thanks to earlier call;
+    # only its hash is kept around
+    key = (hostname, port, database, username, password and sha1(password).hexdigest())
+
+    _connections_lock.acquire()
+    try:
+        if key not in _connections:
+            connection = create_connection(hostname, port, pool_size=pool_size,
+                connect_timeout=connect_timeout, socket_timeout=socket_timeout)
+
+            db = connection[database]
 
-    database = connection[database]
+            db.add_son_manipulator(NamespaceInjector())
+            db.add_son_manipulator(AutoReference(db))
 
-    database.add_son_manipulator(NamespaceInjector())
-    database.add_son_manipulator(AutoReference(database))
+            if username or password:
+                auth = db.authenticate(username, password)
+                if auth is not True:
+                    log.error("FATAL: Not connected to Mongo Database, authentication failed")
+                    disconnect(connection)
+                    raise AssertionError("Not authenticated to use selected database")
 
-    if username or password:
-        auth = database.authenticate(username, password)
-        if auth is not True:
-            log.msg("FATAL: Not connected to Mongo Database, authentication failed")
-            raise AssertionError("Not authenticated to use selected database")
+            _connections[key] = (db, connection)
 
-    return (database, connection)
+        return _connections[key]
+    finally:
+        _connections_lock.release()
 
+def close_connections():
+    """ Disconnect and forget all shared connections """
+    _connections_lock.acquire()
+    try:
+        for database, connection in _connections.values():
+            disconnect(connection)
+        _connections.clear()
+    finally:
+        _connections_lock.release()
 
-def get_database_connection(hostname=None, port=None, database=None, username=None, password=None):
-    return get_mongo_and_database_connections(hostname=hostname, port=port, database=database, username=username, password=password)[0]
+def get_database_connection(hostname=None, port=None, database=None, username=None, password=None, **kwargs):
+    return get_mongo_and_database_connections(hostname=hostname, port=port, database=database, username=username, password=password, **kwargs)[0]
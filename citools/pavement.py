@@ -107,8 +107,8 @@ def bump():
     else:
         format = "%s-[0-9]*" % options.name
 
-    from citools.version import get_git_describe, compute_version
-    version = compute_version(get_git_describe(accepted_tag_pattern=format))
+    from citools.version import get_git_version
+    version = get_git_version(accepted_tag_pattern=format)[1]
 
     new_version = list(version[:-1])
     new_version[len(new_version)-1] += 1
@@ -122,16 +122,15 @@ def bump():
     ('accepted-tag-pattern=', 't', 'Tag pattern passed to git describe for version recognition'),
 ])
 def compute_version_git(options):
-    from citools.version import get_git_describe, compute_version, get_branch_suffix, retrieve_current_branch
+    from citools.version import get_git_version, get_branch_suffix, retrieve_current_branch
     if not getattr(options, "accepted_tag_pattern", None):
         options.accepted_tag_pattern = "%s-[0-9]*" % options.name
 
     dist = _get_distribution()
 
-    current_git_version = get_git_describe(accepted_tag_pattern=options.accepted_tag_pattern)
+    current_git_version, options.version = get_git_version(accepted_tag_pattern=options.accepted_tag_pattern)
     branch_suffix = get_branch_suffix(dist.metadata, retrieve_current_branch())
 
-    options.version = compute_version(current_git_version)
     dist.metadata.version = options.version_str = '.'.join(map(str, options.version))
 
     dist.metadata.branch_suffix = options.branch_suffix = branch_suffix
@@ -170,15 +169,14 @@ def update_debian_version(options):
 
 @task
 def replace_version(options):
-    from citools.version import replace_inits, replace_scripts, replace_version_in_file
-
-    replace_inits(options.version, options.packages)
-    # replace_scripts(options.version, options.py_modules)
-
-    replace_version_in_file(options.version, 'setup.py')
+    from citools.version import replace_versions
 
+    files = ['setup.py']
     if exists('pavement.py'):
-        replace_version_in_file(options.version, 'pavement.py')
+        files.append('pavement.py')
+
+    # py_modules are not replaced here
+    replace_versions(options.version, packages=options.packages, files=files)
 
 
 @task
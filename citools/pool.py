@@ -0,0 +1,55 @@
+"""
+Minimal bounded worker pool, usable on every python we support
+(no multiprocessing.pool / concurrent.futures there)
+"""
+
+import sys
+from Queue import Queue, Empty
+from threading import Thread
+
+__all__ = ('map_in_threads',)
+
+def map_in_threads(function, items, jobs=1):
+    """
+    Return list of function(item) for every item, computed by at most jobs threads.
+
+    Results are in the same order as items. If any call fails, remaining items
+    are not started and exception of first failed item (in items order) is re-raised.
+    """
+    items = list(items)
+    jobs = min(int(jobs or 1), len(items))
+
+    if jobs <= 1:
+        return [function(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+
+    queue = Queue()
+    for position, item in enumerate(items):
+        queue.put((position, item))
+
+    def worker():
+        while not errors:
+            try:
+                position, item = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                results[position] = function(item)
+            except Exception:
+                errors.append((position, sys.exc_info()))
+
+    threads = [Thread(target=worker) for i in xrange(jobs)]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        errors.sort()
+        exc_type, exc_value, exc_traceback = errors[0][1]
+        raise exc_type, exc_value, exc_traceback
+
+    return results
@@ -1,14 +1,32 @@
 from shutil import rmtree
 from subprocess import CalledProcessError
 from distutils.command.config import config
+from distutils.errors import DistutilsOptionError
+from fnmatch import fnmatchcase
 import re
 import os
-from subprocess import Popen, PIPE, CalledProcessError
-from tempfile import mkdtemp
+from tempfile import mkdtemp, mkstemp
+from time import time
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from heapq import nlargest
 from unicodedata import normalize, combining
-from urlparse import urlsplit
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-from citools.git import fetch_repository
+from citools.git import (
+    fetch_repository, fetch_locked_repository, unlock_file, RepositoryMirrors,
+    GitRunner, GitSession, get_git_runner, get_ref_reader, get_common_dir,
+)
+from citools.pool import map_in_threads
 
 """
 Help us handle continuous versioning. Idea is simple: We have n-number digits
@@ -22,43 +40,77 @@ DEFAULT_TAG_VERSION = (0, 0)
 
 REVLIST_TAG_PATTERN = re.compile("^\ \((.*)\)$")
 
+VERSION_CACHE_FILE_NAME = "citools_version_cache.json"
+VERSION_CACHE_MAX_ENTRIES = 64
+
+DESCRIBE_VERSION_PATTERN = re.compile("(?P<bordel>[a-z0-9\-\_\/]*)(?P<arch>\d+\.\d+)(?P<rest>.*)")
+STAGING_PATTERN = re.compile("(\.\d+)")
+BUILD_PATTERN = re.compile("\-{1}(?P<build>\d+)\-{1}g{1}[0-9a-f]{7}")
+ZERO_VERSION_PATTERN = re.compile("^0(\.0)+$")
+VERSION_LINE_PATTERN = re.compile(r"^(VERSION){1}(\ )+(\=){1}(\ )+\({1}([0-9])+(\,{1}(\ )*[0-9]+)+(\)){1}", re.MULTILINE)
+DIGITS = "0123456789"
+
 def compute_version(string):
     """ Return VERSION tuple, computed from git describe output """
-    match = re.match("(?P<bordel>[a-z0-9\-\_\/]*)(?P<arch>\d+\.\d+)(?P<rest>.*)", string)
+    match = DESCRIBE_VERSION_PATTERN.match(string)
 
-    if not match or not match.groupdict().has_key('arch'):
+    if not match:
         raise ValueError(u"String %s should be a scheme version, but it's not; failing" % str(string))
 
-    version = match.groupdict()['arch']
+    bordel, version, rest = match.group('bordel', 'arch', 'rest')
 
     # if bordel ends with digit numbers, they should be part of <arch>
-    if match.groupdict().has_key('bordel') and match.groupdict()['bordel']:
-        i = 0
-        bordel = match.groupdict()['bordel']
-        while re.match("\d", bordel[~i]) and i < len(bordel):
-            version = bordel[~i] + version
-            i +=1
-
-
-    if match.groupdict().has_key('rest') and match.groupdict()['rest']:
-        staging = re.findall("(\.\d+)", match.groupdict()['rest'])
-        version = ''.join([version]+staging)
+    if bordel:
+        prefix = bordel.rstrip(DIGITS)
+        if len(prefix) != len(bordel):
+            version = bordel[len(prefix):] + version
 
+    if rest:
+        staging = STAGING_PATTERN.findall(rest)
+        if staging:
+            version = ''.join([version]+staging)
 
     # we're using integer version numbers instead of string
-    build_match = re.match(".*(%(version)s){1}.*\-{1}(?P<build>\d+)\-{1}g{1}[0-9a-f]{7}" % {'version' : version}, string)
+    # build number is the last -<build>-g<hash> following version in string
+    build = None
+    position = string.find(version)
+    if position != -1:
+        for build_match in BUILD_PATTERN.finditer(string, position + len(version)):
+            build = build_match.group('build')
+    else:
+        # version assembled from non-adjacent parts; use original (slow) lookup
+        build_match = re.match(".*(%(version)s){1}.*\-{1}(?P<build>\d+)\-{1}g{1}[0-9a-f]{7}" % {'version' : version}, string)
+        if build_match:
+            build = build_match.group('build')
 
-    if not build_match or not build_match.groupdict().has_key('build'):
+    if build is None:
         # if version is 0.0....
-        if re.match("^0(\.0)+$", version):
+        if ZERO_VERSION_PATTERN.match(version):
             # return 0.0.1 instead of 0.0.0, as "ground zero version" is not what we want
             build = 1
         else:
             build = 0
-    else:
-        build = int(build_match.groupdict()['build'])
 
-    return tuple(list(map(int, version.split(".")))+[build])
+    return tuple([int(i) for i in version.split(".")]+[int(build)])
+
+def compute_versions(strings, ignore_errors=False):
+    """
+    Return list of VERSION tuples for given git describe outputs, in one pass.
+
+    With ignore_errors, strings not being a scheme version are represented by None
+    instead of raising ValueError.
+    """
+    versions = []
+    append = versions.append
+    compute = compute_version
+    for string in strings:
+        try:
+            append(compute(string))
+        except ValueError:
+            if not ignore_errors:
+                raise
+            append(None)
+    return versions
 
 def sum_versions(version1, version2):
     """
@@ -84,18 +136,30 @@ def sum_versions(version1, version2):
     return tuple(final_version)
 
 
-def get_git_last_hash(commit="HEAD"):
-    p = Popen(["git", "rev-parse", commit], stdout=PIPE, stderr=PIPE)
-    stdout = p.communicate()[0]
-    if p.returncode == 0:
+def get_git_last_hash(commit="HEAD", runner=None, session=None):
+    if session is not None:
+        try:
+            return session.resolve(commit)
+        except ValueError:
+            return ''
+
+    runner = runner or GitRunner()
+    reader = get_ref_reader(runner)
+    if reader is not None:
+        hash = reader.resolve(commit)
+        if hash:
+            return hash
+
+    returncode, stdout, stderr = runner.run(["rev-parse", commit])
+    if returncode == 0:
         return stdout.strip()
     else:
         return ''
 
-def get_git_revlist_tags(commit="HEAD"):
-    p = Popen(["git", "rev-list", "--simplify-by-decoration", "--pretty=format:%d", commit], stdout=PIPE, stderr=PIPE)
-    stdout = p.communicate()[0]
-    if p.returncode == 0:
+def get_git_revlist_tags(commit="HEAD", runner=None):
+    runner = runner or GitRunner()
+    returncode, stdout, stderr = runner.run(["rev-list", "--simplify-by-decoration", "--pretty=format:%d", commit])
+    if returncode == 0:
         return stdout.strip()
     else:
         return ''
@@ -118,7 +182,56 @@ def get_tags_from_line(tagline):
             tags.append(candidate)
     return tags
 
-def get_tags_from_current_branch(revlist_output, accepted_tag_pattern):
+def get_git_annotated_tags(runner=None):
+    """
+    Return set of names of all annotated tags in repository, retrieved by single git call.
+    Lightweight tags are skipped, as git describe is ignoring them too.
+    """
+    runner = runner or GitRunner()
+    returncode, stdout, stderr = runner.run(["for-each-ref", "--format=%(objecttype) %(refname)", "refs/tags"])
+    tags = set()
+    if returncode == 0:
+        for line in stdout.splitlines():
+            objecttype, refname = line.split(' ', 1)
+            if objecttype == 'tag':
+                tags.add(refname[len('refs/tags/'):])
+    return tags
+
+def is_annotated_tag(session, tag):
+    """ Return True if tag is an annotated one, asking session for type of its object """
+    try:
+        return session.read_object("refs/tags/%s" % tag)[1] == 'tag'
+    except ValueError:
+        return False
+
+class AnnotatedTags(object):
+    """ Set-like container of annotated tags, checked through GitSession on first test """
+
+    def __init__(self, session):
+        super(AnnotatedTags, self).__init__()
+        self.session = session
+        self.known = {}
+
+    def __contains__(self, tag):
+        if tag not in self.known:
+            self.known[tag] = is_annotated_tag(self.session, tag)
+        return self.known[tag]
+
+def get_tags_from_current_branch(revlist_output, accepted_tag_pattern, annotated_tags=None, runner=None, session=None):
+    """
+    Return tags from rev-list decoration output matching accepted_tag_pattern.
+
+    Pattern is in git describe --match syntax, which is glob-like, so we match it
+    in-process with fnmatch instead of asking git for every single tag.
+
+    When GitSession is given and annotated_tags are not, only matching tags are checked through it.
+    """
+    if annotated_tags is None:
+        if session is not None:
+            annotated_tags = AnnotatedTags(session)
+        else:
+            annotated_tags = get_git_annotated_tags(runner=runner)
+
     lines = revlist_output.splitlines()
 
     tags = []
@@ -127,14 +240,9 @@ def get_tags_from_current_branch(revlist_output, accepted_tag_pattern):
     for line in lines:
         if not line.startswith("commit: "):
             for tag in get_tags_from_line(line):
-                # now here is the thing: user provides accepted_tag_pattern in non-pythonic,
-                # git, shell-like syntax. Not to force user to provide details, we'll just
-                # validate it by running git.
-                # TODO: This may be optimized in future (shell module?), patches welcomed
-                proc = Popen(['git', 'describe', '--match=%s' % accepted_tag_pattern, tag], stdout=PIPE, stderr=PIPE)
-                verified_tag = proc.communicate()[0].strip()
-
-                if proc.returncode == 0 and tag == verified_tag:
+                # decoration contains also branches and lightweight tags, which
+                # git describe wouldn't consider
+                if fnmatchcase(tag, accepted_tag_pattern) and tag in annotated_tags:
                     tags.append(tag)
     return tags
 
@@ -144,67 +252,89 @@ def get_highest_version(versions):
     Get highest version for version slice strings
     (3, 0) > (2, 2, 3) > (1, 155) > (1, 1) > (1, 0, 234, 3890)
     """
-    current_slice = 0
+    highest = get_highest_versions(versions, count=1)
 
-    if len(versions) < 1:
+    if len(highest) < 1:
         return DEFAULT_TAG_VERSION
 
-    while len(versions) > 1:
-        slice_map = dict([(v[current_slice], v) for v in versions if len(v) >= current_slice+1])
-        slice_vers = slice_map.keys()
-        slice_vers.sort()
-        highest = slice_vers[-1]
+    return highest[0]
+
+def get_highest_versions(versions, count=1, use_numpy=False):
+    """
+    Return list of count highest versions, highest first.
+
+    Versions are compared slice by slice, as in get_highest_version; when one version is
+    prefix of another, the longer one is higher. Duplicates are kept.
+
+    With use_numpy, comparison is vectorized (numpy must be installed). Building the array
+    from tuples costs more than plain comparison, so it only pays off for bulk comparisons
+    of very wide versions.
+    """
+    versions = list(versions)
+
+    if use_numpy and numpy is None:
+        raise ValueError("numpy is not installed, cannot use vectorized selection")
+
+    if not versions or count < 1:
+        return []
 
-        versions = [v for v in versions if v[current_slice] == highest]
+    if not use_numpy:
+        if count == 1:
+            return [max(versions, key=tuple)]
+        return nlargest(count, versions, key=tuple)
 
-        if len(versions) < 1:
-            raise NotImplementedError()
+    # pad shorter versions with -1, which is lower than any (non-negative) slice
+    width = max([len(v) for v in versions])
+    matrix = numpy.array([tuple(v) + (-1,) * (width - len(v)) for v in versions], dtype=numpy.int64)
 
-        current_slice += 1
+    if count == 1:
+        candidates = numpy.arange(len(versions))
+        for column in xrange(width):
+            values = matrix[candidates, column]
+            candidates = candidates[values == values.max()]
+            if len(candidates) == 1:
+                break
+        return [versions[candidates[0]]]
 
-    return versions[0]
+    # lexsort is sorting by last key first, so pass columns in reverse
+    order = numpy.lexsort(matrix.T[::-1])
+    return [versions[i] for i in order[::-1][:count]]
 
 
 def get_highest_tag(tag_list):
     """
     Return highest tag from given git describe output tags
     """
+    tag_list = list(tag_list)
     version_map = {}
-    for i in tag_list:
-        try:
-            version_map[compute_version(i)] = i
-        except ValueError:
-            # bad i format -> shall not be considered
-            pass
+    for version, tag in zip(compute_versions(tag_list, ignore_errors=True), tag_list):
+        # bad tag format -> shall not be considered
+        if version is not None:
+            version_map[version] = tag
 
     return version_map[get_highest_version(version_map.keys())]
     
 
-def get_git_describe(fix_environment=False, repository_directory=None, accepted_tag_pattern=None, prefer_highest_version=True):
+def get_git_describe(fix_environment=False, repository_directory=None, accepted_tag_pattern=None, prefer_highest_version=True, session=None):
     """
     Return output of git describe. If no tag found, initial version is considered to be 0.0
 
     accepted_tag_pattern is used to filter tags only to 'project numbering ones'.
 
     if accepted_tag_given, prefer_hightest_version may be used. This will prefer tags matching accepted_tag_pattern, but with
+
+    GitSession of the repository may be given to answer tag queries.
     """
     if repository_directory and not fix_environment:
         raise ValueError("Both fix_environment and repository_directory or none of them must be given")
-    
-    if fix_environment:
-        if not repository_directory:
-            raise ValueError(u"Cannot fix environment when repository directory not given")
-        env_git_dir = None
-        if os.environ.has_key('GIT_DIR'):
-            env_git_dir = os.environ['GIT_DIR']
 
-        os.environ['GIT_DIR'] = os.path.join(repository_directory, '.git')
+    runner = get_git_runner(fix_environment=fix_environment, repository_directory=repository_directory)
 
-    command = ["git", "describe"]
+    command = ["describe"]
 
     if accepted_tag_pattern is not None:
         if not prefer_highest_version:
-            command.append('--match="%s"' % accepted_tag_pattern)
+            command.append('--match=%s' % accepted_tag_pattern)
         else:
             # git describe fails us on layout similar to:
             #        o
@@ -217,8 +347,10 @@ def get_git_describe(fix_environment=False, repository_directory=None, accepted_
             # to work around this, we will find "highest" tag matching accepted_tag_patterns and use it
             # as a tag pattern for git describe output
             available_tags = get_tags_from_current_branch(
-                revlist_output=get_git_revlist_tags(),
-                accepted_tag_pattern=accepted_tag_pattern
+                revlist_output=get_git_revlist_tags(runner=runner),
+                accepted_tag_pattern=accepted_tag_pattern,
+                runner=runner,
+                session=session
             )
 
             # if not tag available, just use default
@@ -227,116 +359,248 @@ def get_git_describe(fix_environment=False, repository_directory=None, accepted_
             else:
                 pattern = get_highest_tag(available_tags)
 
-            command.append('--match="%s"' % pattern)
+            command.append('--match=%s' % pattern)
+
+    returncode, stdout, stderr = runner.run(command)
+
+    if returncode == 0:
+        return stdout.strip()
+
+    elif returncode == 128:
+        return '.'.join(map(str, DEFAULT_TAG_VERSION))
+
+    else:
+        raise ValueError("Unknown return code %s" % returncode)
 
+def get_git_dir_and_head(fix_environment=False, repository_directory=None):
+    """
+    Return (absolute git directory, HEAD hash) tuple, or (None, None) when
+    there is no repository or no commit yet
+    """
+    runner = get_git_runner(fix_environment=fix_environment, repository_directory=repository_directory)
+    reader = get_ref_reader(runner)
+    if reader is not None:
+        head = reader.resolve("HEAD")
+        if head:
+            return (reader.git_dir, head)
+
+    returncode, stdout, stderr = runner.run(["rev-parse", "--git-dir", "HEAD"])
+    lines = stdout.splitlines()
+    if returncode != 0 or len(lines) != 2:
+        return (None, None)
+    return (os.path.abspath(lines[0].strip()), lines[1].strip())
+
+def get_tag_refs_fingerprint(git_dir):
+    """
+    Return fingerprint of all tag refs, computed from filesystem metadata only,
+    so it changes whenever tag is created, moved or deleted (or refs are packed)
+    """
+    common_dir = get_common_dir(git_dir)
+
+    parts = []
+    packed_refs = os.path.join(common_dir, 'packed-refs')
+    if os.path.exists(packed_refs):
+        st = os.stat(packed_refs)
+        parts.append("packed-refs %r %s" % (st.st_mtime, st.st_size))
+
+    tags_dir = os.path.join(common_dir, 'refs', 'tags')
+    for root, dirs, files in os.walk(tags_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            parts.append("%s %r %s" % (path[len(tags_dir):], st.st_mtime, st.st_size))
+
+    return sha1('\n'.join(parts)).hexdigest()
+
+def read_version_cache(cache_file):
+    try:
+        f = open(cache_file)
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return {}
+
+def write_version_cache(cache_file, cache):
+    """ Write cache atomically, so concurrent readers never see half-written file """
     try:
-        proc = Popen(' '.join(command), stdout=PIPE, stderr=PIPE, shell=True)
-        stdout, stderr = proc.communicate()
-        
-        if proc.returncode == 0:
-            return stdout.strip()
+        handle, tmp_path = mkstemp(dir=os.path.dirname(cache_file), prefix='.citools_version_cache-')
+        f = os.fdopen(handle, 'w')
+        try:
+            json.dump(cache, f)
+        finally:
+            f.close()
+        os.rename(tmp_path, cache_file)
+    except (IOError, OSError):
+        # cache is just an optimization; readonly repository must not break build
+        pass
 
-        elif proc.returncode == 128:
-            return '.'.join(map(str, DEFAULT_TAG_VERSION))
+def get_git_version(fix_environment=False, repository_directory=None, accepted_tag_pattern=None, prefer_highest_version=True, use_cache=True, session=None):
+    """
+    Return (git describe output, VERSION tuple) for given repository.
 
-        else:
-            raise ValueError("Unknown return code %s" % proc.returncode)
+    Result is cached in git directory under key of repository, HEAD hash, tag refs and pattern,
+    so repeated calls on same commit are not running describe again.
 
-    finally:
-        if fix_environment:
-            if env_git_dir:
-                os.environ['GIT_DIR'] = env_git_dir
-            else:
-                del os.environ['GIT_DIR']
+    session (GitSession of the repository) is passed to get_git_describe.
+    """
+    describe_kwargs = {
+        'fix_environment' : fix_environment,
+        'repository_directory' : repository_directory,
+        'accepted_tag_pattern' : accepted_tag_pattern,
+        'prefer_highest_version' : prefer_highest_version,
+        'session' : session,
+    }
+
+    git_dir, head = None, None
+    if use_cache:
+        git_dir, head = get_git_dir_and_head(fix_environment=fix_environment, repository_directory=repository_directory)
+
+    if not git_dir:
+        describe = get_git_describe(**describe_kwargs)
+        return (describe, compute_version(describe))
+
+    cache_file = os.path.join(git_dir, VERSION_CACHE_FILE_NAME)
+    key = sha1('\0'.join([
+        git_dir, head, get_tag_refs_fingerprint(git_dir),
+        str(accepted_tag_pattern), str(bool(prefer_highest_version))
+    ])).hexdigest()
+
+    cache = read_version_cache(cache_file)
+    if key in cache:
+        describe, version = cache[key]['describe'], cache[key]['version']
+        return (describe, tuple(version))
+
+    describe = get_git_describe(**describe_kwargs)
+    version = compute_version(describe)
+
+    # drop oldest entries, cache shall stay small enough to be read on every call
+    if len(cache) >= VERSION_CACHE_MAX_ENTRIES:
+        for old_key in sorted(cache, key=lambda k: cache[k].get('stored', 0))[:len(cache) - VERSION_CACHE_MAX_ENTRIES + 1]:
+            del cache[old_key]
+
+    cache[key] = {
+        'describe' : describe,
+        'version' : list(version),
+        'stored' : time(),
+    }
+    write_version_cache(cache_file, cache)
+
+    return (describe, version)
 
 def replace_version(source_file, version):
+    """ Return lines of source_file with first VERSION line replaced by version """
     content = []
-    version_regexp = re.compile(r"^(VERSION){1}(\ )+(\=){1}(\ )+\({1}([0-9])+(\,{1}(\ )*[0-9]+)+(\)){1}")
+    found = False
 
     for line in source_file:
-        if version_regexp.match(line):
+        if not found and VERSION_LINE_PATTERN.match(line):
             content.append('VERSION = %s\n' % str(version))
+            found = True
         else:
             content.append(line)
     return content
 
-def get_git_head_hash(fix_environment=False, repository_directory=None):
+def get_git_head_hash(fix_environment=False, repository_directory=None, session=None):
     """ Return output of git describe. If no tag found, initial version is considered to be 0.0.1 """
-    if fix_environment:
-        if not repository_directory:
-            raise ValueError(u"Cannot fix environment when repository directory not given")
-        env_git_dir = None
-        if os.environ.has_key('GIT_DIR'):
-            env_git_dir = os.environ['GIT_DIR']
-
-        os.environ['GIT_DIR'] = os.path.join(repository_directory, '.git')
-
-    try:
-        proc = Popen(["git", "rev-parse", "HEAD"], stdout=PIPE)
-        return_code = proc.wait()
-        if return_code == 0:
-            return proc.stdout.read().strip()
-        else:
-            raise ValueError("Non-zero return code %s from git log" % return_code)
-
-    finally:
-        if fix_environment:
-            if env_git_dir:
-                os.environ['GIT_DIR'] = env_git_dir
-            else:
-                del os.environ['GIT_DIR']
+    if session is not None:
+        return session.resolve("HEAD")
+
+    runner = get_git_runner(fix_environment=fix_environment, repository_directory=repository_directory)
+    reader = get_ref_reader(runner)
+    if reader is not None:
+        head = reader.resolve("HEAD")
+        if head:
+            return head
+
+    return_code, stdout, stderr = runner.run(["rev-parse", "HEAD"])
+    if return_code == 0:
+        return stdout.strip()
+    else:
+        raise ValueError("Non-zero return code %s from git log" % return_code)
 
-def get_git_head_tstamp(fix_environment=False, repository_directory=None):
+def get_git_head_tstamp(fix_environment=False, repository_directory=None, session=None):
     """ return timestamp of last commit on current branch """
-    if fix_environment:
-        if not repository_directory:
-            raise ValueError("Cannot fix environment when repository directory not given")
-        env_git_dir = os.environ.get('GIT_DIR', None)
-        os.environ['GIT_DIR'] = os.path.join(repository_directory, '.git')
+    if session is not None:
+        return str(session.read_commit("HEAD")['author_timestamp'])
 
-    try:
-        proc = Popen(["git", "log", "-n1", "--pretty=format:%at"], stdout=PIPE)
-        return_code = proc.wait()
-        if return_code == 0:
-            return proc.stdout.read().strip()
-        else:
-            raise ValueError("Non-zero return code %s from git log" % return_code)
-
-    finally:
-        if fix_environment:
-            if env_git_dir:
-                os.environ['GIT_DIR'] = env_git_dir
-            else:
-                del os.environ['GIT_DIR']
+    runner = get_git_runner(fix_environment=fix_environment, repository_directory=repository_directory)
+    return_code, stdout, stderr = runner.run(["log", "-n1", "--pretty=format:%at"])
+    if return_code == 0:
+        return stdout.strip()
+    else:
+        raise ValueError("Non-zero return code %s from git log" % return_code)
 
 
 def replace_init(version, name):
     """ Update VERSION attribute in $name/__init__.py module """
     file = os.path.join(name, '__init__.py')
-    replace_version_in_file(version, file)
+    return replace_version_in_file(version, file)
 
 def replace_inits(version, packages=None):
-    if packages is None:
-        packages = []
-    for p in packages:
-        p = p.replace('.', '/')
-        replace_init(version, p)
+    return replace_versions(version, packages=packages)
 
 def replace_scripts(version, scripts=None):
-    if scripts is None:
-        scripts = []
-    for s in scripts:
-        s = '%s.py' % s
-        replace_version_in_file(version, s)
+    return replace_versions(version, py_modules=scripts)
 
 def replace_version_in_file(version, file):
-    """ Update VERSION attribute in $name/__init__.py module """
-    file = open(file, 'r')
-    content = replace_version(version=version, source_file=file)
-    file.close()
-    file = open(file.name, 'wb')
-    file.writelines(content)
-    file.close()
+    """
+    Update VERSION attribute in given file. File is rewritten atomically and only
+    when VERSION differs, so mtime is kept for files already having proper version.
+
+    Return True if file has been changed.
+    """
+    f = open(file, 'rb')
+    try:
+        content = f.read()
+    finally:
+        f.close()
+
+    match = VERSION_LINE_PATTERN.search(content)
+    if not match:
+        return False
+
+    line_end = content.find('\n', match.start())
+    if line_end == -1:
+        line_end = len(content)
+    new_content = content[:match.start()] + 'VERSION = %s\n' % str(version) + content[line_end+1:]
+
+    if new_content == content:
+        return False
+
+    fd, temporary_path = mkstemp(dir=os.path.dirname(os.path.abspath(file)), prefix='.%s.' % os.path.basename(file))
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(new_content)
+        finally:
+            f.close()
+        os.chmod(temporary_path, os.stat(file).st_mode & 07777)
+        os.rename(temporary_path, file)
+    except:
+        os.remove(temporary_path)
+        raise
+    return True
+
+def replace_versions(version, packages=None, py_modules=None, files=None):
+    """
+    Update VERSION in __init__.py of all packages, in all py_modules and in other files given
+    (like setup.py or pavement.py), in one pass. Return list of files that have been changed.
+    """
+    paths = []
+    for package in packages or []:
+        paths.append(os.path.join(package.replace('.', '/'), '__init__.py'))
+    for module in py_modules or []:
+        paths.append('%s.py' % module)
+    paths.extend(files or [])
+
+    changed = []
+    for path in paths:
+        if replace_version_in_file(version, path):
+            changed.append(path)
+    return changed
 
 def get_current_branch(branch_output):
     """
@@ -353,42 +617,45 @@ def get_current_branch(branch_output):
 
 
 def retrieve_current_branch(fix_environment=False, repository_directory=None, **kwargs):
-    #######
-    # FIXME: repository_directory and fix_environment artifact shall be refactored
-    # in something like secure_and_fixed_git_command or something.
-    # But pay attention to nested command in get_git_describe, it probably shall be using callback.
-    # See #6679
-    #######
     if repository_directory and not fix_environment:
         raise ValueError("Both fix_environment and repository_directory or none of them must be given")
 
-    if fix_environment:
-        if not repository_directory:
-            raise ValueError(u"Cannot fix environment when repository directory not given")
-        env_git_dir = None
-        if os.environ.has_key('GIT_DIR'):
-            env_git_dir = os.environ['GIT_DIR']
+    runner = get_git_runner(fix_environment=fix_environment, repository_directory=repository_directory)
 
-        os.environ['GIT_DIR'] = os.path.join(repository_directory, '.git')
+    # detached HEAD and branch without commits are left to git, which reports them its own way
+    reader = get_ref_reader(runner)
+    if reader is not None:
+        try:
+            branch, head = reader.get_head()
+        except ValueError:
+            pass
+        else:
+            if head and branch and branch.startswith("refs/heads/"):
+                return branch[len("refs/heads/"):]
 
-    try:
-        proc = Popen('git branch --no-color', stdout=PIPE, stderr=PIPE, shell=True)
-        stdout, stderr = proc.communicate()
+    command = ["branch", "--no-color"]
+    returncode, stdout, stderr = runner.run(command)
 
-        if proc.returncode == 0:
-            return get_current_branch(stdout)
-        else:
-            raise CalledProcessError("git branch returned exit code %s" % proc.returncode)
+    if returncode == 0:
+        return get_current_branch(stdout)
+    else:
+        raise CalledProcessError(returncode, ["git"] + command)
 
-    finally:
-        if fix_environment:
-            if env_git_dir:
-                os.environ['GIT_DIR'] = env_git_dir
-            else:
-                del os.environ['GIT_DIR']
 
+def compute_meta_version(dependency_repositories, workdir=None, accepted_tag_pattern=None, cachedir=None, dependency_versions=None, remove_cloned_dirs=False, jobs=1, cache_max_size=None, refresh_ttl=None):
+    """
+    Compute version as sum of my version and versions of all dependency_repositories.
+
+    If cachedir is given, dependencies are cloned from bare mirrors kept there
+    (see citools.git.RepositoryMirrors), limited to cache_max_size bytes
+    (mirrors over the limit are evicted once all dependencies are cloned).
 
-def compute_meta_version(dependency_repositories, workdir=None, accepted_tag_pattern=None, cachedir=None, dependency_versions=None, remove_cloned_dirs=False):
+    Otherwise, clones are reused through fetch_repository cache; refresh_ttl is passed to it,
+    so that cached clones older than that are fetched and fast-forwarded.
+
+    Dependencies are fetched and described by up to jobs threads; versions are still summed
+    (and filled into dependency_versions) in order of dependency_repositories.
+    """
 
     kwargs = {}
 
@@ -403,38 +670,47 @@ def compute_meta_version(dependency_repositories, workdir=None, accepted_tag_pat
             'accepted_tag_pattern' : accepted_tag_pattern
         })
 
-    describe = get_git_describe(**kwargs)
+    describe, version = get_git_version(**kwargs)
     meta_branch = retrieve_current_branch(**kwargs)
-
-    version = compute_version(describe)
     
     repositories_dir = mkdtemp(dir=os.curdir, prefix="build-repository-dependencies-")
-    for repository_dict in dependency_repositories:
+
+    mirrors = None
+    if cachedir:
+        mirrors = RepositoryMirrors(cachedir, max_size=cache_max_size)
+
+    def fetch_version(repository_dict):
         if repository_dict.has_key('branch'):
             branch = repository_dict['branch']
         else:
             branch = meta_branch
 
-        reference_repository = None
-
-        if cachedir:
-            reponame = urlsplit(repository_dict['url'])[2].split("/")[-1]
-            if reponame.endswith(".git"):
-                cachename = reponame[:-4]
-            else:
-                cachename = reponame
-
-            if os.path.exists(os.path.join(cachedir, cachename)):
-                reference_repository = os.path.abspath(os.path.join(cachedir, cachename))
-                
-            elif os.path.exists(os.path.join(cachedir, cachename+".git")):
-                reference_repository = os.path.abspath(os.path.join(cachedir, cachename+".git"))
+        lock = None
+        if mirrors:
+            workdir = mirrors.clone(repository_dict['url'], branch=branch, workdir=repositories_dir, history_only=True)
+        else:
+            # cached clone is kept locked while being described, so it cannot be evicted meanwhile
+            workdir, lock = fetch_locked_repository(repository_dict['url'], branch=branch, workdir=repositories_dir, history_only=True, refresh_ttl=refresh_ttl)
 
-        workdir = fetch_repository(repository_dict['url'], branch=branch, workdir=repositories_dir, reference_repository=reference_repository)
         # this is pattern for dependency repo, NOT for for ourselves -> pattern of it, not ours
         # now hardcoded, but shall be retrieved via egg_info or custom command
         project_pattern = "%s-[0-9]*" % repository_dict['package_name']
-        new_version = compute_version(get_git_describe(repository_directory=workdir, fix_environment=True, accepted_tag_pattern=project_pattern))
+        try:
+            session = GitSession(runner=get_git_runner(fix_environment=True, repository_directory=workdir))
+            try:
+                return (workdir, get_git_version(repository_directory=workdir, fix_environment=True, accepted_tag_pattern=project_pattern, session=session)[1])
+            finally:
+                session.close()
+        finally:
+            if lock is not None:
+                unlock_file(lock)
+
+    results = map_in_threads(fetch_version, dependency_repositories, jobs=jobs)
+
+    if mirrors and cache_max_size is not None:
+        mirrors.evict()
+
+    for repository_dict, (workdir, new_version) in zip(dependency_repositories, results):
         if dependency_versions is not None:
             dependency_versions[repository_dict['package_name']] = new_version
         version = sum_versions(version, new_version)
@@ -476,13 +752,27 @@ class GitSetMetaVersion(config):
 
     user_options = [
         ("cache-directory=", None, "Directory where dependent repositories are cached in"),
+        ("cache-max-size=", None, "Maximum size of repository cache directory in megabytes"),
+        ("jobs=", "j", "Number of dependency repositories fetched in parallel"),
+        ("refresh-ttl=", None, "Refresh cached dependency clones older than this number of seconds"),
     ]
 
     def initialize_options(self):
         self.cache_directory = None
+        self.cache_max_size = None
+        self.jobs = None
+        self.refresh_ttl = None
 
     def finalize_options(self):
         self.cache_directory = self.cache_directory or None
+        try:
+            self.jobs = int(self.jobs or 1)
+            if self.cache_max_size:
+                self.cache_max_size = int(self.cache_max_size) * 1024 * 1024
+            if self.refresh_ttl is not None:
+                self.refresh_ttl = int(self.refresh_ttl)
+        except ValueError:
+            raise DistutilsOptionError("jobs, cache-max-size and refresh-ttl must be numbers")
 
     def run(self):
         """
@@ -498,7 +788,10 @@ class GitSetMetaVersion(config):
                 self.distribution.dependencies_git_repositories,
                 accepted_tag_pattern = format,
                 cachedir = self.cache_directory,
-                dependency_versions = dependency_versions
+                dependency_versions = dependency_versions,
+                jobs = self.jobs,
+                cache_max_size = self.cache_max_size,
+                refresh_ttl = self.refresh_ttl
             )
 
             branch_suffix = get_branch_suffix(self.distribution.metadata, retrieve_current_branch())
@@ -507,10 +800,8 @@ class GitSetMetaVersion(config):
             version = meta_version
             version_str = '.'.join(map(str, version))
 
-            replace_inits(version, self.distribution.packages)
-            replace_scripts(version, self.distribution.py_modules)
-
-            replace_version_in_file(version, 'setup.py')
+            replace_versions(version, packages=self.distribution.packages,
+                py_modules=self.distribution.py_modules, files=['setup.py'])
 
             self.distribution.metadata.version = version_str
             self.distribution.metadata.dependency_versions = dict([(k,'.'.join(map(str, v))) for k,v in dependency_versions.items()])
@@ -545,19 +836,17 @@ class GitSetVersion(config):
             # format is given, sorry. If you want it configurable, use paver
             format = "%s-[0-9]*" % self.distribution.metadata.get_name()
 
-            current_git_version = get_git_describe(accepted_tag_pattern=format)
+            current_git_version, version = get_git_version(accepted_tag_pattern=format)
             branch_suffix = get_branch_suffix(self.distribution.metadata, retrieve_current_branch())
 
-            version = compute_version(current_git_version)
             version_str = '.'.join(map(str, version))
 
-            replace_inits(version, self.distribution.packages)
-            replace_scripts(version, self.distribution.py_modules)
-
-            replace_version_in_file(version, 'setup.py')
-
+            files = ['setup.py']
             if os.path.exists('pavement.py'):
-                replace_version_in_file(version, 'pavement.py')
+                files.append('pavement.py')
+
+            replace_versions(version, packages=self.distribution.packages,
+                py_modules=self.distribution.py_modules, files=files)
 
             self.distribution.metadata.version = version_str
             self.distribution.metadata.branch_suffix = branch_suffix
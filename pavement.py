@@ -67,6 +67,7 @@ setup(
             'copy_dependency_images = citools.build:CopyDependencyImages',
             'buildbot_ping_git = citools.buildbots:BuildbotPingGit',
             'save_repository_information_git = citools.git:SaveRepositoryInformationGit',
+            'harvest_repositories_information_git = citools.git:HarvestRepositoriesInformationGit',
             'replace_templates = citools.build:ReplaceTemplateFiles',
             'rename_template_files = citools.build:RenameTemplateFiles',
         ],
@@ -120,10 +120,14 @@ class MongoTestCase(TestCase):
         if os.environ.get("MONGODB_PASSWORD", None):
             connection_arguments['password'] = os.environ.get("MONGODB_PASSWORD", None)
 
+        self.connection_arguments = connection_arguments
+
         try:
             self.database, self.connection = get_mongo_and_database_connections(
                 **connection_arguments
             )
+            # client connects lazily, so ask server to find out it's there
+            self.connection.server_info()
         except ConnectionFailure:
             raise SkipTest("Cannot connect to mongo database, check your settings")
 
@@ -1,9 +1,23 @@
-from nose.tools import assert_equals, assert_raises, assert_true
+import bz2
+import gzip
+import os
+from cStringIO import StringIO
+from shutil import rmtree
+from tempfile import mkdtemp
 
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equals, assert_raises, assert_true, with_setup
+
+from pyparsing import ParserElement
+
+from citools.pool import map_in_threads
 from citools.debian.control import (
     ControlFileParagraph, SourceParagraph,
     Dependency, ControlFile, PackageParagraph,
-    get_dependency,
+    get_dependency, get_grammar, build_depends_grammar,
+    build_paragraph_grammar, tokenize_paragraph,
+    iter_paragraphs, iter_paragraph_sources, lzma,
+    DependencyGraph,
 )
 
 # {{{  Test ControlFileParagraph generic parsing
@@ -54,6 +68,63 @@ def test_comments_are_ignored():
     par = ControlFileParagraph(source)
     assert_equals('value1', par['key1'])
 
+def test_fields_parsed_on_first_access():
+    parsed = []
+    class MyControlFileParagraph(ControlFileParagraph):
+        def parse_my_key(self, value):
+            parsed.append(value)
+            return 'X%sX' % value
+    par = MyControlFileParagraph('key1: value1\nMy-Key: my custom value')
+    assert_equals([], parsed)
+    assert_equals('Xmy custom valueX', par.get('my_key'))
+    assert_equals('Xmy custom valueX', par['My-Key'])
+    assert_equals(['my custom value'], parsed)
+
+def test_unaccessed_fields_dumped_verbatim():
+    source = 'Package: package\nDepends: python (>=2.5),foo |bar'
+    par = PackageParagraph(source)
+    assert_equals(source, par.dump())
+    par['depends']
+    assert_equals('Package: package\nDepends: python (>= 2.5), foo | bar', par.dump())
+
+def test_fields_parsed_through_all_dict_accessors():
+    source = 'Package: package\nDepends: python (>= 2.5), foo'
+    for values in (
+        lambda par: list(par.itervalues()),
+        lambda par: [value for key, value in par.iteritems()],
+        lambda par: par.copy().values(),
+        lambda par: [par.pop('depends'), par.pop('package')],
+        lambda par: [par.setdefault('depends'), par.setdefault('package')],
+    ):
+        par = PackageParagraph(source)
+        assert_true(all(not isinstance(value, basestring) for value in values(par)))
+
+def test_paragraphs_compared_parsed():
+    par = PackageParagraph('Package: package\nDepends: python (>= 2.5), foo')
+    assert_equals(PackageParagraph('Package: package\nDepends: python (>=2.5),foo'), par)
+    assert_equals(dict(par.items()), par)
+    assert_true(PackageParagraph('Package: package\nDepends: python (>= 2.6), foo') != par)
+
+def test_assigned_field_not_parsed_again():
+    par = PackageParagraph('Package: package\nDepends: python')
+    par['depends'] = [Dependency('ella')]
+    assert_equals('ella', par['depends'][0].name)
+
+def test_parsing_keeps_default_whitespace():
+    whitespace = ParserElement.DEFAULT_WHITE_CHARS
+    PackageParagraph('Package: package\nDepends: python (>= 2.5)')
+    assert_equals(whitespace, ParserElement.DEFAULT_WHITE_CHARS)
+
+def test_grammar_built_once_per_delimiters():
+    assert_true(get_grammar(build_depends_grammar, (',', '|')) is get_grammar(build_depends_grammar, (',', '|')))
+    assert_true(get_grammar(build_depends_grammar, (',', '|')) is not get_grammar(build_depends_grammar, (',',)))
+
+def test_grammar_built_once_in_threads():
+    delimiters = (',', ';')
+    grammars = map_in_threads(lambda i: get_grammar(build_depends_grammar, delimiters), range(8), jobs=8)
+    assert_true(all(grammar is grammars[0] for grammar in grammars))
+    assert_equals(['a', ';', 'b'], [str(i) for i in grammars[0].parseString('a ; b', True).asList()])
+
 ##############################################################################
 # }}}
 
@@ -318,6 +389,58 @@ Description: package with static files without version in path
     assert_equals([l.strip() for l in debian_control.splitlines()], [l.strip() for l in cfile.dump().splitlines()])
 
 
+def test_relation_index_follows_changed_relations():
+    par = PackageParagraph('Package: package\nDepends: ella (= 1.0), django | ella (= 1.0)')
+    index = par.get_relation_index('depends')
+    assert_equals(['django', 'ella'], sorted(index))
+    assert_equals(2, len(index['ella']))
+    assert_true(index is par.get_relation_index('depends'))
+
+    par['depends'] = par['depends'] + [',', Dependency('south')]
+    assert_equals(['django', 'ella', 'south'], sorted(par.get_relation_index('depends')))
+
+    par['depends'][0] = Dependency('other')
+    par['depends'][2].name = 'renamed'
+    par.invalidate_relation_index('depends')
+    assert_equals(['ella', 'other', 'renamed', 'south'], sorted(par.get_relation_index('depends')))
+
+    par['depends'] = [Dependency('mypage')]
+    assert_equals(['mypage'], sorted(par.get_relation_index('depends')))
+
+    par.pop('depends')
+    assert_equals({}, par.get_relation_index('depends'))
+
+def test_relation_index_reused_by_version_replacement():
+    cfile = ControlFile('Source: source\n\nPackage: package\nArchitecture: all\nDepends: ella (= 1.0), django (= 1.0)')
+    index = cfile.packages[0].get_relation_index('depends')
+    cfile.replace_dependencies([Dependency('ella', '1.1')])
+    assert_true(index is cfile.packages[0].get_relation_index('depends'))
+    cfile.packages[0]['depends'] = [Dependency('ella', '1.1', '='), ',', Dependency('south', '1.0', '=')]
+    cfile.replace_dependencies([Dependency('ella', '1.2'), Dependency('south', '1.3')])
+    assert_equals(['ella (= 1.2)', ',', 'south (= 1.3)'], [str(d) for d in cfile.packages[0]['depends']])
+
+def test_versions_replaced_in_relations_changed_in_place():
+    cfile = ControlFile('Source: source\n\nPackage: package\nArchitecture: all\nDepends: ella (= 1.0), django (= 1.0)')
+    depends = cfile.packages[0]['depends']
+    cfile.replace_dependencies([Dependency('ella', '1.1')])
+    depends[0] = Dependency('south', '1.0', '=')
+    depends[2].name = 'ella'
+    cfile.packages[0].invalidate_relation_index('depends')
+    cfile.replace_dependencies([Dependency('ella', '1.2'), Dependency('south', '1.3')])
+    assert_equals(['south (= 1.3)', ',', 'ella (= 1.2)'], [str(d) for d in depends])
+
+def test_replaced_dependencies_in_all_packages():
+    cfile = ControlFile(master_control_content_pattern % {
+        'package1_name': 'package1',
+        'package2_name': 'package2',
+        'package1_version': '0.1.0',
+        'package2_version': '0.2.1',
+        'metapackage_version': '0.10.0',
+    })
+    cfile.replace_dependencies([Dependency('centrum-python-package1-aaa', '0.1.1'), Dependency('centrum-python-metapackage-aaa', '0.11.0')])
+    assert_equals(['0.1.1', '0.2.1', '0.1.0', '0.2.1', '0.11.0'], [d.version for d in cfile.get_dependencies()])
+    assert_raises(ValueError, cfile.replace_dependencies, [Dependency('centrum-python-package2-bbb', '0.2.0')])
+
 def test_upgrade_to_multicipher_version_passes_downgrade_check():
     cfile = ControlFile()
     assert_true(cfile.check_downgrade('0.5.0.0', '0.17.0.114'))
@@ -382,3 +505,260 @@ Description: metapackage aaa
 ##############################################################################
 # }}}
 
+
+# {{{  Test paragraph tokenizer gives same results as paragraph grammar
+##############################################################################
+
+def get_grammar_items(source):
+    return [(row.key, row.value) for row in get_grammar(build_paragraph_grammar).parseString(source, True)]
+
+def assert_tokenized_as_by_grammar(source):
+    items = tokenize_paragraph(source)
+    assert_true(items is not None)
+    assert_equals(get_grammar_items(source), items)
+
+def test_tokenizer_parity_on_control_files():
+    from tests.test_debian import slave_control_content_pattern
+
+    versions = {
+        'package1_name': 'package1',
+        'package2_name': 'package2',
+        'package1_version': '0.1.0',
+        'package2_version': '0.2.1',
+        'metapackage_version': '0.10.0',
+    }
+    control_files = [
+        master_control_content_pattern % versions,
+        slave_control_content_pattern % {'project_name' : 'project'},
+        ControlFile.DEFAULT_SOURCE_PARAGRAPH,
+        ControlFile.DEFAULT_PACKAGE_PARAGRAPH,
+    ]
+    for control_file in control_files:
+        for paragraph in control_file.split('\n\n'):
+            yield assert_tokenized_as_by_grammar, paragraph
+
+def test_tokenizer_parity_on_edge_cases():
+    for source in [
+        '', '\n', '# only comment', 'key:value', 'key:   spaced   ', 'k : v', ' k: v', 'K-1: v',
+        'Depends:', 'Depends:\nX: y', 'k: a\n b', 'k: a\n  b', 'k: a\n .\n b', 'k: a#b', 'k: a\n #b',
+        '# c\nk: v\n# c2\nl: w\n# end', 'k: v\n#', 'k: v\n', 'k: v\n\n', 'k: v\n  # x\n', 'k: a\n b \n',
+        u'k: \u0159e\u0159icha\n \u0159',
+    ]:
+        yield assert_tokenized_as_by_grammar, source
+
+def test_hash_starts_comment_only_at_line_start():
+    sources = {
+        'Homepage: http://example.com/#top\nk: v': [('Homepage', 'http://example.com/#top'), ('k', 'v')],
+        'k: #x\nl: y': [('k', '#x'), ('l', 'y')],
+        'k:#x': [('k', '#x')],
+        'k: a\n #b': [('k', 'a #b')],
+        '# c\nk: v\n#\nl: w': [('k', 'v'), ('l', 'w')],
+    }
+    for source, items in sources.items():
+        assert_equals(items, tokenize_paragraph(source))
+        assert_tokenized_as_by_grammar(source)
+
+def test_unusual_paragraphs_left_to_grammar():
+    for source in ['k: a\n\tb', 'k: a\r\nl: b\r\n', ' # c\nk: v', 'k: v\n ']:
+        assert_equals(None, tokenize_paragraph(source))
+        assert_equals(get_grammar_items(source), ControlFileParagraph(source)._parse_items(source))
+
+def test_malformed_paragraph_still_raises_parse_error():
+    from pyparsing import ParseException
+    for source in ['nocolon', 'key:\n b', 'k: v\n \nl: w', 'k: a\n b\n# c\n c', '\nk: v', 'k.x: v']:
+        assert_equals(None, tokenize_paragraph(source))
+        assert_raises(ParseException, ControlFileParagraph, source)
+
+##############################################################################
+# }}}
+
+
+# {{{  Test streaming paragraphs from apt indexes
+##############################################################################
+
+packages_index = """\
+Package: python-foo
+Version: 1.0-1
+Architecture: all
+Depends: python (>= 2.5), python-bar
+Description: foo library
+ with long description
+ .
+ on more paragraphs
+
+Package: python-bar
+Version: 2.0
+Architecture: all
+Provides: python-bar-2.0
+Description: bar library
+
+
+Package: python-baz
+Version: 0.1
+Architecture: all
+Description: baz library
+"""
+
+index_directory = None
+
+def create_index_directory():
+    global index_directory
+    index_directory = mkdtemp(prefix='test_debian_index_')
+
+def remove_index_directory():
+    rmtree(index_directory)
+
+def write_index(name, content, open_file=open):
+    path = os.path.join(index_directory, name)
+    f = open_file(path, 'wb')
+    f.write(content)
+    f.close()
+    return path
+
+def assert_index_read(path):
+    paragraphs = list(iter_paragraphs(path))
+    assert_equals(['python-foo', 'python-bar', 'python-baz'], [p['package'].name for p in paragraphs])
+    assert_equals('foo library with long description . on more paragraphs', paragraphs[0]['description'])
+    assert_equals(['python', 'python-bar'], [d.name for d in paragraphs[0]['depends'] if d != ','])
+
+@with_setup(create_index_directory, remove_index_directory)
+def test_plain_index_streamed():
+    assert_index_read(write_index('Packages', packages_index))
+
+@with_setup(create_index_directory, remove_index_directory)
+def test_gzip_index_streamed():
+    assert_index_read(write_index('Packages.gz', packages_index, gzip.open))
+
+@with_setup(create_index_directory, remove_index_directory)
+def test_bz2_index_streamed():
+    assert_index_read(write_index('Packages.bz2', packages_index, bz2.BZ2File))
+
+@with_setup(create_index_directory, remove_index_directory)
+def test_xz_index_streamed():
+    if lzma is None:
+        raise SkipTest("lzma module not installed")
+    assert_index_read(write_index('Packages.xz', lzma.compress(packages_index)))
+
+@with_setup(create_index_directory, remove_index_directory)
+def test_concatenated_gzip_streams_read():
+    first, second = packages_index.split('\n\n', 1)
+    path = write_index('Packages.gz', first + '\n\n', gzip.open)
+    f = open(path, 'ab')
+    gz = gzip.GzipFile(fileobj=f, mode='wb')
+    gz.write(second)
+    gz.close()
+    f.close()
+    assert_index_read(path)
+
+def test_paragraphs_split_across_read_chunks():
+    expected = [p.strip('\n') for p in packages_index.split('\n\n') if p.strip('\n')]
+    for read_size in (1, 2, 7, 64):
+        assert_equals(expected, list(iter_paragraph_sources(StringIO(packages_index), read_size=read_size)))
+
+def test_only_requested_packages_parsed():
+    parsed = []
+    class RecordingParagraph(PackageParagraph):
+        def __init__(self, source):
+            parsed.append(source)
+            super(RecordingParagraph, self).__init__(source)
+
+    paragraphs = list(iter_paragraphs(StringIO(packages_index), package_names=['python-baz'], paragraph_class=RecordingParagraph))
+    assert_equals(['python-baz'], [p['package'].name for p in paragraphs])
+    assert_equals(1, len(parsed))
+
+debian_packages_stanza = """\
+Package: zlib1g-dev
+Source: zlib
+Version: 1:1.2.11.dfsg-2+deb11u2
+Installed-Size: 592
+Maintainer: Mark Brown <broonie@debian.org>
+Architecture: amd64
+Provides: libz-dev, zlib-dev (= 1:1.2.11.dfsg-2+deb11u2)
+Depends: zlib1g (= 1:1.2.11.dfsg-2+deb11u2), libc6-dev | libc-dev, libstdc++6 (>= 4.1.1), python3:any (>> 3.9~), perl (<< 5.33~rc1), dpkg (>= 1.19.0.5~) [amd64 !i386] <!nocheck>
+Description: compression library - development
+Multi-Arch: same
+Homepage: http://zlib.net/
+Section: libdevel
+Priority: optional
+Filename: pool/main/z/zlib/zlib1g-dev_1.2.11.dfsg-2+deb11u2_amd64.deb
+Size: 191220
+MD5sum: 8d0a6e0a7a0a7d6b4d5d68d9c1f5c3a9
+"""
+
+def test_debian_packages_stanza_parsed():
+    paragraph = list(iter_paragraphs(StringIO(debian_packages_stanza)))[0]
+    depends = [d for d in paragraph['depends'] if d not in (',', '|')]
+    assert_equals(['zlib1g', 'libc6-dev', 'libc-dev', 'libstdc++6', 'python3:any', 'perl', 'dpkg'], [d.name for d in depends])
+    assert_equals(['=', '', '', '>=', '>>', '<<', '>='], [d.sign for d in depends])
+    assert_equals(['1:1.2.11.dfsg-2+deb11u2', '', '', '4.1.1', '3.9~', '5.33~rc1', '1.19.0.5~'], [d.version for d in depends])
+    assert_equals('[amd64 !i386] <!nocheck>', depends[-1].restrictions)
+    assert_equals(['libz-dev', 'zlib-dev'], [p.name for p in paragraph['provides'] if p != ','])
+
+def test_debian_packages_stanza_dumped_back():
+    paragraph = list(iter_paragraphs(StringIO(debian_packages_stanza)))[0]
+    paragraph['depends'], paragraph['provides']
+    assert_equals(debian_packages_stanza.strip('\n'), paragraph.dump())
+
+def test_unknown_compression_refused():
+    assert_raises(ValueError, list, iter_paragraphs(StringIO(packages_index), compression='lzip'))
+
+##############################################################################
+# }}}
+
+
+# {{{  Test DependencyGraph
+##############################################################################
+
+def get_control_file(*packages):
+    paragraphs = ['Source: source']
+    for package, depends in packages:
+        paragraphs.append('Package: %s\nArchitecture: all\nDepends: %s' % (package, depends))
+    return ControlFile('\n\n'.join(paragraphs))
+
+def get_graph():
+    return DependencyGraph([
+        get_control_file(('meta', 'web (= 1.0), lib'), ('meta-static', '')),
+        get_control_file(('web', 'lib | other-lib, python (>= 2.5)')),
+        get_control_file(('lib', 'python'), ('other-lib', '')),
+    ])
+
+def test_build_order_puts_dependencies_first():
+    assert_equals(['meta-static', 'lib', 'other-lib', 'web', 'meta'], get_graph().get_build_order())
+
+def test_provided_package_resolved_to_provider():
+    graph = DependencyGraph([
+        get_control_file(('app', 'virtual-db')),
+        ControlFile('Source: db\n\nPackage: db\nProvides: virtual-db'),
+    ])
+    assert_equals(['db', 'app'], graph.get_build_order())
+
+def test_dependency_cycle_raises_error():
+    graph = DependencyGraph([get_control_file(('a', 'b'), ('b', 'c'), ('c', 'a'), ('d', ''))])
+    assert_raises(ValueError, graph.get_build_order)
+
+def test_reverse_dependents_found_transitively():
+    graph = get_graph()
+    assert_equals(['meta', 'web'], graph.get_reverse_dependents('lib'))
+    assert_equals(['web', 'meta'], graph.get_reverse_dependents('other-lib'))
+    assert_equals([], graph.get_reverse_dependents('meta'))
+
+def test_edges_computed_once_until_graph_changes():
+    graph = get_graph()
+    dependents = graph.get_dependents()
+    graph.get_reverse_dependents('lib')
+    assert_true(dependents is graph.get_dependents())
+    graph.add_control_file(get_control_file(('tool', 'lib')))
+    assert_equals(['meta', 'web', 'tool'], graph.get_reverse_dependents('lib'))
+
+def test_changed_relations_seen_after_invalidation():
+    graph = get_graph()
+    assert_equals([], graph.get_reverse_dependents('meta-static'))
+    graph.packages['lib']['depends'] = [Dependency('meta-static')]
+    graph.invalidate()
+    assert_equals(['lib', 'meta', 'web'], graph.get_reverse_dependents('meta-static'))
+
+def test_package_in_two_control_files_refused():
+    assert_raises(ValueError, DependencyGraph, [get_control_file(('a', '')), get_control_file(('a', ''))])
+
+##############################################################################
+# }}}
@@ -2,15 +2,25 @@
 from ConfigParser import SafeConfigParser
 from datetime import datetime
 import os
-from subprocess import Popen, PIPE
+from subprocess import CalledProcessError, Popen, PIPE
 from shutil import rmtree
 from tempfile import mkdtemp, mkstemp
+from threading import Thread
 from unittest import TestCase
 
 from nose.plugins.skip import SkipTest
 
-from citools.git import retrieve_repository_metadata, fetch_repository, filter_parse_date
-from citools.version import get_current_branch
+from citools.git import (
+    retrieve_repository_metadata, fetch_repository, filter_parse_date,
+    RepositoryMirrors, get_directory_size, refresh_repository, GitRunner, GitSession,
+    iter_repository_metadata, iter_chunks, get_current_branch_name,
+    RepositoryCacheIndex, RefReader, get_ref_reader, lock_file, unlock_file,
+    fetch_locked_repository, lock_cached_repository, collect_repository_cache,
+    get_revision_metadata,
+)
+from citools.main import main
+from citools.pool import map_in_threads
+from citools.version import get_current_branch, get_git_describe, get_git_head_hash, get_git_last_hash, retrieve_current_branch
 
 from helpers import GitTestCase
 
@@ -24,6 +34,12 @@ class TestDateParsing(TestCase):
 
     def test_tz_parsed(self):
         self.assertEquals(datetime(2009, 12, 1, 20, 58, 01), filter_parse_date('Tue Dec 1 20:58:01 2009 +0100'))
+
+    def test_raw_parsed_to_local_time(self):
+        self.assertEquals(datetime.fromtimestamp(1259697481), filter_parse_date('1259697481 +0100'))
+
+    def test_unknown_month_rejected(self):
+        self.assertRaises(ValueError, filter_parse_date, 'Tue Foo 1 20:58:01 2009')
     
     def tearDown(self):
         super(TestDateParsing, self).tearDown()
@@ -54,6 +70,14 @@ class TestGitBranchParsing(TestCase):
   testomation
 """))
 
+class TestChunking(TestCase):
+
+    def test_iterable_split_to_chunks(self):
+        self.assertEquals([[0, 1], [2, 3], [4]], list(iter_chunks(iter(range(5)), 2)))
+
+    def test_empty_iterable_gives_no_chunks(self):
+        self.assertEquals([], list(iter_chunks([], 2)))
+
 class TestRepositoryFetching(GitTestCase):
 
     def setUp(self):
@@ -84,16 +108,149 @@ class TestRepositoryFetching(GitTestCase):
         invalid_repo_uri = "ssh://user@nonexisting.example.com/repository"
 
         handle, cache_file = mkstemp(prefix="config_git_", suffix=".ini")
-        f = open(cache_file, "w+b")
+        f = os.fdopen(handle, "w+b")
         f.write("""[%s]
 cache_dir = %s
 """ % (invalid_repo_uri, self.repo))
         f.close()
 
-        self.assertEquals(self.repo, fetch_repository(repository=invalid_repo_uri,
-            cache_config_dir=os.path.dirname(cache_file),
-            cache_config_file_name=os.path.basename(cache_file)
-        ))
+        try:
+            self.assertEquals(self.repo, fetch_repository(repository=invalid_repo_uri,
+                cache_config_dir=os.path.dirname(cache_file),
+                cache_config_file_name=os.path.basename(cache_file)
+            ))
+        finally:
+            for path in (cache_file, cache_file + ".lock"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _fetch_cached(self, **kwargs):
+        return fetch_repository(repository=self.repo, workdir=self.cache_dir, cache_config_dir=self.cache_dir, **kwargs)
+
+    def _get_head(self, dir):
+        return GitRunner(repository_directory=dir).check_output(["rev-parse", "HEAD"]).strip()
+
+    def _commit_to_origin(self, content):
+        f = open(os.path.join(self.repo, 'test.txt'), 'wb')
+        f.write(content)
+        f.close()
+        return self.commit()
+
+    def test_cached_clone_refreshed_on_hit(self):
+        self.cache_dir = mkdtemp(prefix="test_git_")
+        dir = self._fetch_cached()
+        new_head = self._commit_to_origin("new")
+
+        self.assertEquals(dir, self._fetch_cached(refresh_ttl=0))
+        self.assertEquals(new_head, self._get_head(dir))
+
+    def test_cached_clone_not_refreshed_while_fresh(self):
+        self.cache_dir = mkdtemp(prefix="test_git_")
+        dir = self._fetch_cached()
+        old_head = self._get_head(dir)
+        self._commit_to_origin("new")
+
+        self._fetch_cached(refresh_ttl=3600)
+        self.assertEquals(old_head, self._get_head(dir))
+
+    def test_history_only_clone_refreshed(self):
+        self.cache_dir = mkdtemp(prefix="test_git_")
+        dir = self._fetch_cached(history_only=True)
+        new_head = self._commit_to_origin("new")
+
+        self.assertEquals(dir, self._fetch_cached(history_only=True, refresh_ttl=0))
+        self.assertEquals(new_head, self._get_head(dir))
+
+    def test_rewritten_history_followed_in_place(self):
+        self.cache_dir = mkdtemp(prefix="test_git_")
+        dir = self._fetch_cached()
+        self.do_piped_command_for_success(["git", "commit", "--amend", "-m", "rewritten"])
+        new_head = self.do_piped_command_for_success(["git", "rev-parse", "HEAD"])[0].strip()
+
+        self.assertEquals(dir, self._fetch_cached(refresh_ttl=0))
+        self.assertEquals(new_head, self._get_head(dir))
+
+    def test_refresh_waits_until_clone_not_used(self):
+        self.cache_dir = mkdtemp(prefix="test_git_")
+        dir, lock = fetch_locked_repository(repository=self.repo, workdir=self.cache_dir, cache_config_dir=self.cache_dir)
+        old_head = self._get_head(dir)
+        new_head = self._commit_to_origin("new")
+
+        refresher = Thread(target=self._fetch_cached, kwargs={'refresh_ttl': 0})
+        try:
+            refresher.start()
+            # others not refreshing are not blocked
+            self.assertEquals(dir, self._fetch_cached())
+            refresher.join(0.5)
+            self.assertTrue(refresher.isAlive())
+            self.assertEquals(old_head, self._get_head(dir))
+        finally:
+            unlock_file(lock)
+        refresher.join()
+        self.assertEquals(new_head, self._get_head(dir))
+
+    def test_broken_clone_replaced_in_place(self):
+        self.cache_dir = mkdtemp(prefix="test_git_")
+        dir = self._fetch_cached()
+        GitRunner(repository_directory=dir).check_call(["remote", "remove", "origin"])
+        new_head = self._commit_to_origin("new")
+        entries = sorted(os.listdir(self.cache_dir))
+
+        self.assertEquals(dir, self._fetch_cached(refresh_ttl=0))
+        self.assertEquals(new_head, self._get_head(dir))
+        self.assertEquals(["repository", "repository.lock"], sorted(os.listdir(os.path.dirname(dir))))
+        self.assertEquals(entries, sorted(os.listdir(self.cache_dir)))
+
+    def test_refresh_checks_out_requested_branch(self):
+        self.cache_dir = mkdtemp(prefix="test_git_")
+        dir = self._fetch_cached()
+        self.do_piped_command_for_success(["git", "checkout", "-b", "other"])
+        other_head = self._commit_to_origin("other")
+
+        self.assertTrue(refresh_repository(dir, branch="other"))
+        self.assertEquals(other_head, self._get_head(dir))
+        self.assertEquals("other", get_current_branch_name(runner=GitRunner(repository_directory=dir)))
+
+    def test_history_only_refresh_fetches_requested_branch(self):
+        self.cache_dir = mkdtemp(prefix="test_git_")
+        dir = self._fetch_cached(history_only=True)
+        self.do_piped_command_for_success(["git", "checkout", "-b", "other"])
+        other_head = self._commit_to_origin("other")
+
+        self.assertTrue(refresh_repository(dir, branch="other", history_only=True))
+        self.assertEquals(other_head, self._get_head(dir))
+
+    def test_fetched_repository_kept_locked_against_eviction(self):
+        self.cache_dir = mkdtemp(prefix="test_git_")
+        dir, lock = fetch_locked_repository(repository=self.repo, workdir=self.cache_dir, cache_config_dir=self.cache_dir)
+        try:
+            self.assertEquals([], collect_repository_cache(self.cache_dir, max_size=0))
+            self.assertTrue(os.path.exists(dir))
+        finally:
+            unlock_file(lock)
+
+        cached, lock = fetch_locked_repository(repository=self.repo, workdir=self.cache_dir, cache_config_dir=self.cache_dir)
+        unlock_file(lock)
+        self.assertEquals(dir, cached)
+        self.assertEquals([self.repo], collect_repository_cache(self.cache_dir, max_size=0))
+        self.assertFalse(os.path.exists(dir))
+
+    def test_other_branch_not_taken_from_cache(self):
+        self.cache_dir = mkdtemp(prefix="test_git_")
+        self.do_piped_command_for_success(["git", "branch", "other"])
+        master = self._fetch_cached(history_only=True)
+        other = self._fetch_cached(history_only=True, branch="other")
+
+        self.assertNotEquals(master, other)
+        self.assertEquals(other, self._fetch_cached(history_only=True, branch="other"))
+
+    def test_history_only_clone_not_taken_for_full_checkout(self):
+        self.cache_dir = mkdtemp(prefix="test_git_")
+        history = self._fetch_cached(history_only=True)
+        full = self._fetch_cached()
+
+        self.assertNotEquals(history, full)
+        self.assertTrue(os.path.exists(os.path.join(full, 'test.txt')))
 
     def test_fetching_creates_cache(self):
         repo_uri = os.path.abspath(self.repo)
@@ -118,9 +275,227 @@ cache_dir = %s
         TestCase.tearDown(self)
         # delete temporary repository and restore ENV vars after update
         rmtree(self.repo)
+        if getattr(self, 'cache_dir', None):
+            rmtree(self.cache_dir)
         os.chdir(self.oldcwd)
 
 
+class TestRepositoryCacheIndex(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.directory = mkdtemp(prefix="test_cache_index_")
+        self.index = RepositoryCacheIndex(self.directory)
+
+    def _create_clone(self, size):
+        dir = os.path.join(mkdtemp(dir=self.directory), "repository")
+        os.mkdir(dir)
+        f = open(os.path.join(dir, "data"), "wb")
+        f.write("x" * size)
+        f.close()
+        return dir
+
+    def _set_last_used(self, repository, last_used):
+        parser = self.index.read()
+        parser.set(repository, "last_used", str(last_used))
+        self.index.write(parser)
+
+    def test_added_repository_retrieved(self):
+        dir = self._create_clone(10)
+        self.index.add("repo", dir)
+        self.assertEquals((dir, False), self.index.get("repo"))
+
+    def test_size_and_usage_recorded(self):
+        self.index.add("repo", self._create_clone(10))
+        self._set_last_used("repo", 1)
+        self.index.get("repo")
+        entry = self.index.get_entries()[0]
+        self.assertEquals(10, entry['size'])
+        self.assertTrue(entry['last_used'] > 1)
+
+    def test_history_only_clone_not_given_for_full_checkout(self):
+        dir = self._create_clone(10)
+        self.index.add("repo", dir, history_only=True)
+        self.assertEquals(None, self.index.get("repo"))
+        self.assertEquals((dir, True), self.index.get("repo", history_only=True))
+
+    def test_branches_cached_separately(self):
+        master, other = self._create_clone(10), self._create_clone(10)
+        self.index.add("repo", master)
+        self.index.add("repo", other, branch="other")
+        self.assertEquals((master, False), self.index.get("repo"))
+        self.assertEquals((other, False), self.index.get("repo", branch="other"))
+        self.assertEquals(None, self.index.get("repo", branch="third"))
+
+    def test_full_clone_given_for_history_only_request(self):
+        dir = self._create_clone(10)
+        self.index.add("repo", dir, branch="other")
+        self.assertEquals((dir, False), self.index.get("repo", history_only=True, branch="other"))
+
+    def test_old_repositories_evicted(self):
+        old, new = self._create_clone(10), self._create_clone(10)
+        self.index.add("old", old)
+        self.index.add("new", new)
+        self._set_last_used("old", 100)
+
+        self.assertEquals(["old"], self.index.evict(max_age=3600))
+        self.assertFalse(os.path.exists(old))
+        self.assertEquals(None, self.index.get("old"))
+        self.assertEquals((new, False), self.index.get("new"))
+
+    def test_least_recently_used_evicted_to_fit_size(self):
+        for name, last_used in (("a", 300), ("b", 100), ("c", 200)):
+            self.index.add(name, self._create_clone(10))
+            self._set_last_used(name, last_used)
+
+        self.assertEquals(["b", "c"], self.index.evict(max_size=15))
+        self.assertEquals(["a"], [entry['repository'] for entry in self.index.get_entries()])
+
+    def test_repository_in_use_not_evicted(self):
+        dir = self._create_clone(10)
+        self.index.add("repo", dir)
+        self._set_last_used("repo", 100)
+
+        lock = lock_cached_repository(dir)
+        try:
+            self.assertEquals([], self.index.evict(max_age=3600))
+        finally:
+            unlock_file(lock)
+        self.assertTrue(os.path.exists(dir))
+
+        self.assertEquals(["repo"], self.index.evict(max_age=3600))
+        self.assertFalse(os.path.exists(os.path.dirname(dir)))
+
+    def test_evicted_repository_not_locked(self):
+        dir = self._create_clone(10)
+        self.index.add("repo", dir)
+        self.index.evict(max_size=0)
+        self.assertEquals(None, lock_cached_repository(dir))
+
+    def test_missing_directories_dropped(self):
+        dir = self._create_clone(10)
+        self.index.add("repo", dir)
+        rmtree(dir)
+        self.assertEquals(["repo"], self.index.evict())
+
+    def test_parallel_additions_not_lost(self):
+        map_in_threads(lambda i: self.index.add("repo-%s" % i, self.directory), range(20), jobs=5)
+        self.assertEquals(20, len(self.index.get_entries()))
+
+    def test_gc_action(self):
+        self.index.add("repo", self._create_clone(10))
+        self._set_last_used("repo", 100)
+
+        handle, config_file = mkstemp(prefix="test_citools_", suffix=".ini")
+        f = os.fdopen(handle, "w")
+        f.write("[repository_cache]\ndirectory = %s\nmax_age = 3600\n" % self.directory)
+        f.close()
+
+        try:
+            self.assertEquals(0, main(argv=["--config", config_file, "repository_gc"], do_exit=False))
+        finally:
+            os.remove(config_file)
+        self.assertEquals([], self.index.get_entries())
+
+    def tearDown(self):
+        rmtree(self.directory)
+        TestCase.tearDown(self)
+
+class TestRepositoryMirrors(GitTestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+
+        self._create_git_repository()
+        f = open(os.path.join(self.repo, 'test.txt'), 'wb')
+        f.write("test")
+        f.close()
+        self.do_piped_command_for_success(["git", "add", "*"])
+        self.commit()
+        self.do_piped_command_for_success(["git", "tag", "-a", "-m", "tagging", "project-1.0"])
+
+        self.cache_dir = mkdtemp(prefix="test_git_")
+        self.workdir = mkdtemp(prefix="test_git_")
+        self.mirrors = RepositoryMirrors(self.cache_dir)
+
+    def test_mirror_is_bare(self):
+        mirror = self.mirrors.update(self.repo)
+        self.assertTrue(os.path.exists(os.path.join(mirror, "HEAD")))
+        self.assertFalse(os.path.exists(os.path.join(mirror, "test.txt")))
+
+    def test_clone_has_version_of_original(self):
+        dir = self.mirrors.clone(self.repo, workdir=self.workdir, history_only=True)
+        self.assertEquals("project-1.0", get_git_describe(repository_directory=dir, fix_environment=True))
+
+    def test_clone_points_to_original_url(self):
+        dir = self.mirrors.clone(self.repo, workdir=self.workdir)
+        self.assertEquals(self.repo, Popen(["git", "config", "remote.origin.url"], cwd=dir, stdout=PIPE).communicate()[0].strip())
+
+    def test_mirror_refreshed_on_update(self):
+        self.mirrors.update(self.repo)
+
+        f = open(os.path.join(self.repo, 'test.txt'), 'wb')
+        f.write("changed")
+        f.close()
+        self.commit()
+
+        dir = self.mirrors.clone(self.repo, workdir=self.workdir, history_only=True)
+        self.assertTrue(get_git_describe(repository_directory=dir, fix_environment=True).startswith("project-1.0-1-g"))
+
+    def test_least_recently_used_evicted(self):
+        other_repo = mkdtemp(prefix="test_git_")
+        try:
+            self.do_piped_command_for_success(["git", "clone", self.repo, other_repo])
+
+            old_mirror = self.mirrors.update(other_repo)
+            os.utime(os.path.join(old_mirror, RepositoryMirrors.LAST_USED_FILE_NAME), (0, 0))
+            new_mirror = self.mirrors.update(self.repo)
+
+            self.assertEquals([old_mirror], self.mirrors.evict(max_size=get_directory_size(new_mirror)))
+            self.assertTrue(os.path.exists(new_mirror))
+        finally:
+            rmtree(other_repo)
+
+    def test_clone_survives_evicted_mirror(self):
+        dir = self.mirrors.clone(self.repo, workdir=self.workdir, history_only=True)
+        self.assertEquals([self.mirrors.get_mirror_path(self.repo)], self.mirrors.evict(max_size=0))
+        self.assertEquals("project-1.0", get_git_describe(repository_directory=dir, fix_environment=True))
+
+    def test_mirror_in_use_not_evicted(self):
+        mirror = self.mirrors.update(self.repo)
+        file_lock = lock_file(mirror + ".lock", shared=True)
+        try:
+            self.assertEquals([], self.mirrors.evict(max_size=0))
+        finally:
+            unlock_file(file_lock)
+        self.assertTrue(os.path.exists(mirror))
+
+    def test_mirror_not_evicted_between_update_and_clone(self):
+        evicted = []
+        other = RepositoryMirrors(self.cache_dir)
+        class EvictingMirrors(RepositoryMirrors):
+            def touch(self, path):
+                # runs after update and before clone
+                evicted.extend(other.evict(max_size=0))
+                RepositoryMirrors.touch(self, path)
+
+        dir = EvictingMirrors(self.cache_dir).clone(self.repo, workdir=self.workdir, history_only=True)
+        self.assertEquals([], evicted)
+        self.assertEquals("project-1.0", get_git_describe(repository_directory=dir, fix_environment=True))
+        self.assertEquals([self.mirrors.get_mirror_path(self.repo)], self.mirrors.evict(max_size=0))
+
+    def test_lock_file_kept_after_eviction(self):
+        mirror = self.mirrors.update(self.repo)
+        self.mirrors.evict(max_size=0)
+        self.assertFalse(os.path.exists(mirror))
+        self.assertTrue(os.path.exists(mirror + ".lock"))
+
+    def tearDown(self):
+        rmtree(self.cache_dir)
+        rmtree(self.workdir)
+        GitTestCase.tearDown(self)
+
+
 class TestHistoryMetadataRetrieval(GitTestCase):
     def setUp(self):
         TestCase.setUp(self)
@@ -267,3 +642,233 @@ class TestHistoryMetadataRetrieval(GitTestCase):
         self.revisions.append(self.commit(message=u"你好, řeřicha".encode('utf-8')))
 
         self.assertEquals(u"你好, řeřicha", retrieve_repository_metadata(str(self.revisions[len(self.revisions)-1])+"^")[0]['subject'])
+
+    def test_custom_property_map_used(self):
+        metadata = retrieve_repository_metadata(str(self.revisions[0]), metadata_property_map={
+            "%s" : {'name' : "subject"},
+            "%P" : {'name' : "parents", 'filter' : lambda x: x.split()},
+        })
+        parents = dict([(i['subject'], i['parents']) for i in metadata])
+        self.assertEquals([self.revisions[0]], parents['2'])
+        self.assertEquals([self.revisions[1]], parents['3'])
+
+    def test_custom_date_filter_gets_local_date(self):
+        date_map = {
+            "%H" : {'name' : "hash"},
+            "%ad" : {'name' : "author_date", 'filter' : lambda x: "custom " + x},
+        }
+        revision = self.revisions[1]
+        local_date = self.do_piped_command_for_success(["git", "show", "--quiet", "--date=local", "--pretty=format:%ad", revision])[0].strip()
+
+        streamed = [i for i in retrieve_repository_metadata(str(self.revisions[0]), metadata_property_map=date_map) if i['hash'] == revision]
+        self.assertEquals("custom " + local_date, streamed[0]['author_date'])
+        self.assertEquals("custom " + local_date, get_revision_metadata(revision, metadata_property_map=date_map)['author_date'])
+        session = GitSession()
+        try:
+            self.assertEquals("custom " + local_date, get_revision_metadata(revision, metadata_property_map=date_map, session=session)['author_date'])
+        finally:
+            session.close()
+
+    def _get_parents_map(self):
+        return {
+            "%H" : {'name' : "hash"},
+            "%P" : {'name' : "parents", 'filter' : lambda x: x.split()},
+        }
+
+    def test_history_streamed_with_parents_first(self):
+        seen = []
+        for item in iter_repository_metadata(None, metadata_property_map=self._get_parents_map()):
+            for parent in item['parents']:
+                self.assertTrue(parent in seen)
+            seen.append(item['hash'])
+        # revisions + merge commit
+        self.assertEquals(len(self.revisions) + 1, len(seen))
+
+    def test_current_branch_name(self):
+        self.do_piped_command_for_success(["git", "checkout", "new_branch"])
+        self.assertEquals("new_branch", get_current_branch_name())
+
+    def test_detached_head_branch_name(self):
+        self._prepare_shorter_tree(self.revisions[3])
+        self.assertEquals("HEAD", get_current_branch_name())
+
+    def test_stream_may_be_abandoned(self):
+        stream = iter_repository_metadata(None, metadata_property_map=self._get_parents_map())
+        self.assertEquals(self.revisions[0], stream.next()['hash'])
+        stream.close()
+
+    def test_unknown_changeset_raises_error(self):
+        self.assertRaises(CalledProcessError, list, iter_repository_metadata("nonexistent"))
+
+    def test_metadata_retrieved_in_threads(self):
+        expected = retrieve_repository_metadata(None)
+        results = map_in_threads(lambda i: retrieve_repository_metadata(None), range(6), jobs=3)
+        self.assertEquals([expected] * 6, results)
+
+    def test_field_separator_inside_value_handled(self):
+        f = open(os.path.join(self.repo, 'test2.txt'), 'wb')
+        f.write("changed AGAIN")
+        f.close()
+
+        self.revisions.append(self.commit(message="separated\x1fsubject"))
+
+        metadata = retrieve_repository_metadata(str(self.revisions[len(self.revisions)-1])+"^")[0]
+        self.assertEquals(u"separated\x1fsubject", metadata['subject'])
+        self.assertEquals(self.revisions[len(self.revisions)-1], metadata['hash'])
+
+    def test_separator_inside_value_looked_up_through_session(self):
+        f = open(os.path.join(self.repo, 'test2.txt'), 'wb')
+        f.write("changed AGAIN")
+        f.close()
+
+        self.revisions.append(self.commit(message="separated\x1fsubject"))
+        changeset = str(self.revisions[len(self.revisions)-2])
+
+        session = GitSession()
+        try:
+            metadata = retrieve_repository_metadata(changeset, session=session)
+            self.assertEquals(None, session.process.poll())
+        finally:
+            session.close()
+        self.assertEquals(retrieve_repository_metadata(changeset), metadata)
+
+class TestGitSession(GitTestCase):
+    def setUp(self):
+        GitTestCase.setUp(self)
+        self._create_git_repository()
+
+        f = open(os.path.join(self.repo, 'test.txt'), 'wb')
+        f.write("test")
+        f.close()
+        self.do_piped_command_for_success(["git", "add", "*"])
+        self.first = self.commit(message="first")
+
+        f = open(os.path.join(self.repo, 'test.txt'), 'wb')
+        f.write("changed")
+        f.close()
+        self.second = self.commit(message=u"second\nline\n\nbody, řeřicha".encode('utf-8'))
+        self.do_piped_command_for_success(["git", "tag", "-a", "-m", "tagging", "project-0.1"])
+
+        self.session = GitSession(runner=GitRunner(repository_directory=self.repo))
+
+    def test_head_resolved(self):
+        self.assertEquals(self.second, self.session.resolve("HEAD"))
+
+    def test_parent_resolved(self):
+        self.assertEquals(self.first, self.session.resolve("HEAD^"))
+
+    def test_missing_revision_raises_error(self):
+        self.assertRaises(ValueError, self.session.resolve, "nonexistent")
+
+    def test_session_usable_after_missing_revision(self):
+        self.assertFalse(self.session.exists("nonexistent"))
+        self.assertEquals(self.first, self.session.resolve(self.first))
+
+    def test_commit_parsed(self):
+        commit = self.session.read_commit("HEAD")
+        expected = self.do_piped_command_for_success(["git", "log", "-n1", "--pretty=format:%an%n%ce%n%at"])[0].splitlines()
+        self.assertEquals([self.first], commit['parents'])
+        self.assertEquals(expected[0], commit['author_name'])
+        self.assertEquals(expected[1], commit['commiter_email'])
+        self.assertEquals(int(expected[2]), commit['author_timestamp'])
+
+    def test_subject_folded_like_git_log(self):
+        self.assertEquals('second line', self.session.read_commit("HEAD")['subject'])
+
+    def test_annotated_tag_peeled_to_commit(self):
+        self.assertEquals(self.second, self.session.read_commit("project-0.1")['hash'])
+
+    def test_abbreviation_is_prefix(self):
+        abbrev = self.session.abbreviate(self.second)
+        self.assertEquals(7, len(abbrev))
+        self.assertTrue(self.second.startswith(abbrev))
+
+    def test_abbreviation_follows_core_abbrev(self):
+        self.do_piped_command_for_success(["git", "config", "core.abbrev", "12"])
+        session = GitSession(runner=GitRunner(repository_directory=self.repo))
+        try:
+            expected = self.do_piped_command_for_success(["git", "log", "-n1", "--pretty=format:%h"])[0].strip()
+            self.assertEquals(expected, session.abbreviate(self.second))
+        finally:
+            session.close()
+
+    def test_head_hash_from_session(self):
+        self.assertEquals(self.second, get_git_head_hash(session=self.session))
+
+    def tearDown(self):
+        self.session.close()
+        GitTestCase.tearDown(self)
+
+class TestRefReader(GitTestCase):
+    def setUp(self):
+        GitTestCase.setUp(self)
+        self._create_git_repository()
+
+        f = open(os.path.join(self.repo, 'test.txt'), 'wb')
+        f.write("test")
+        f.close()
+        self.do_piped_command_for_success(["git", "add", "*"])
+        self.first = self.commit(message="first")
+        self.do_piped_command_for_success(["git", "tag", "-a", "-m", "tagging", "project-0.1"])
+        self.do_piped_command_for_success(["git", "checkout", "-b", "feature"])
+
+        f = open(os.path.join(self.repo, 'test.txt'), 'wb')
+        f.write("changed")
+        f.close()
+        self.second = self.commit(message="second")
+
+        self.reader = get_ref_reader(GitRunner(repository_directory=self.repo))
+        self.worktree = None
+
+    def rev_parse(self, name):
+        return self.do_piped_command_for_success(["git", "rev-parse", name])[0].strip()
+
+    def test_head_read_from_loose_refs(self):
+        self.assertEquals(("refs/heads/feature", self.second), self.reader.get_head())
+
+    def test_branches_and_tags_resolved_like_rev_parse(self):
+        for name in ["HEAD", "master", "feature", "project-0.1", "refs/tags/project-0.1", "heads/master", self.first]:
+            self.assertEquals(self.rev_parse(name), self.reader.resolve(name))
+
+    def test_refs_read_from_packed_refs(self):
+        self.do_piped_command_for_success(["git", "pack-refs", "--all"])
+        reader = RefReader(self.reader.git_dir)
+        self.assertEquals(self.first, reader.resolve("master"))
+        self.assertEquals(self.rev_parse("project-0.1"), reader.resolve("project-0.1"))
+        self.assertEquals(("refs/heads/feature", self.second), reader.get_head())
+
+    def test_expressions_and_missing_refs_left_to_git(self):
+        for name in ["HEAD^", "feature~1", self.first[:7], "nonexistent", "master@{1}"]:
+            self.assertEquals(None, self.reader.resolve(name))
+        self.assertEquals(self.first, get_git_last_hash("feature~1"))
+        self.assertEquals('', get_git_last_hash("nonexistent"))
+
+    def test_detached_head(self):
+        self.do_piped_command_for_success(["git", "checkout", self.first])
+        self.assertEquals((None, self.first), self.reader.get_head())
+        self.assertEquals("HEAD", get_current_branch_name())
+
+    def test_current_branch_read_without_git(self):
+        self.assertEquals("feature", retrieve_current_branch())
+        self.assertEquals("feature", get_current_branch_name())
+        self.assertEquals(self.second, get_git_head_hash())
+
+    def test_worktree_refs_read_through_gitdir_file(self):
+        self.worktree = mkdtemp(prefix='test_git_worktree_')
+        os.rmdir(self.worktree)
+        self.do_piped_command_for_success(["git", "worktree", "add", "-b", "other", self.worktree, "master"])
+
+        reader = get_ref_reader(GitRunner(repository_directory=self.worktree))
+        self.assertEquals(self.reader.git_dir, reader.common_dir)
+        self.assertEquals(("refs/heads/other", self.first), reader.get_head())
+        self.assertEquals(self.second, reader.resolve("feature"))
+        self.assertEquals("other", retrieve_current_branch(fix_environment=True, repository_directory=self.worktree))
+
+    def test_unknown_ref_storage_left_to_git(self):
+        os.mkdir(os.path.join(self.repo, '.git', 'reftable'))
+        self.assertEquals(None, get_ref_reader(GitRunner(repository_directory=self.repo)))
+
+    def tearDown(self):
+        if self.worktree:
+            rmtree(self.worktree)
+        GitTestCase.tearDown(self)
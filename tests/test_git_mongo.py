@@ -1,6 +1,18 @@
 from datetime import datetime
+import os
+from shutil import rmtree
+from subprocess import check_call, PIPE
+import tempfile
+from tempfile import mkdtemp
+from unittest import TestCase
 
-from citools.git import get_last_revision, store_repository_metadata
+from nose.plugins.skip import SkipTest
+
+from citools.git import (
+    get_last_revision, store_repository_metadata, ensure_metadata_indexes, number_changesets,
+    get_repository_cursor, store_repository_cursor, get_last_stored_changeset,
+    harvest_repositories,
+)
 
 from copy import deepcopy
 from helpers import MongoTestCase
@@ -69,3 +81,171 @@ class TestLastStoreRetrieval(MongoTestCase):
         self.assertEquals('overrulled', self.collection.find_one({
             'hash_abbrev' : self.changeset['hash_abbrev']
         })['commiter_name'])
+
+class TestSharedConnections(MongoTestCase):
+
+    def test_connection_reused(self):
+        from citools.mongo import get_mongo_and_database_connections
+        database, connection = get_mongo_and_database_connections(**self.connection_arguments)
+        self.assertTrue(connection is self.connection)
+        self.assertTrue(database is self.database)
+
+    def test_connection_reconnected_after_close(self):
+        from citools.mongo import get_mongo_and_database_connections, close_connections
+        close_connections()
+        database, connection = get_mongo_and_database_connections(**self.connection_arguments)
+        self.assertFalse(connection is self.connection)
+        self.connection = connection
+
+    def test_other_password_not_given_authenticated_connection(self):
+        from pymongo.errors import OperationFailure
+        from citools.mongo import get_mongo_and_database_connections
+        arguments = dict(self.connection_arguments, password=(self.connection_arguments.get('password') or '') + 'other')
+        try:
+            database, connection = get_mongo_and_database_connections(**arguments)
+        except (AssertionError, OperationFailure):
+            # wrong password may be refused by server
+            return
+        self.assertFalse(connection is self.connection)
+        connection.close()
+
+class TestBulkMetadataStoring(TestCase):
+
+    def setUp(self):
+        super(TestBulkMetadataStoring, self).setUp()
+        try:
+            import mongomock
+        except ImportError:
+            raise SkipTest("mongomock not installed")
+        self.collection = mongomock.MongoClient().db.repository_information
+
+    def _get_changeset(self, number, repository_uri='repo', **kwargs):
+        changeset = {
+            'hash' : '%040x' % number,
+            'repository_uri' : repository_uri,
+            'subject' : 'commit %s' % number,
+        }
+        changeset.update(kwargs)
+        return changeset
+
+    def test_all_changesets_stored_in_chunks(self):
+        stored = store_repository_metadata(self.collection, (self._get_changeset(i) for i in range(7)), chunk_size=3)
+        self.assertEquals(7, stored)
+        self.assertEquals(7, self.collection.find({'repository_uri' : 'repo'}).count())
+
+    def test_stored_changeset_updated_in_place(self):
+        store_repository_metadata(self.collection, [self._get_changeset(1, author_name='author')])
+        store_repository_metadata(self.collection, [self._get_changeset(1, subject='amended')])
+
+        self.assertEquals(1, self.collection.find().count())
+        stored = self.collection.find_one({'hash' : self._get_changeset(1)['hash']})
+        self.assertEquals('amended', stored['subject'])
+        self.assertEquals('author', stored['author_name'])
+
+    def test_same_hash_in_other_repository_stored_separately(self):
+        store_repository_metadata(self.collection, [self._get_changeset(1)])
+        store_repository_metadata(self.collection, [self._get_changeset(1, repository_uri='fork')])
+        self.assertEquals(2, self.collection.find().count())
+
+    def test_duplicate_changeset_in_chunk_stored_once(self):
+        store_repository_metadata(self.collection, [self._get_changeset(1), self._get_changeset(1, subject='again')])
+        self.assertEquals(1, self.collection.find().count())
+        self.assertEquals('again', self.collection.find_one()['subject'])
+
+    def test_storing_without_hash_fails(self):
+        changeset = self._get_changeset(1)
+        del changeset['hash']
+        self.assertRaises(ValueError, store_repository_metadata, self.collection, [changeset])
+
+class TestImportCursor(TestCase):
+
+    def setUp(self):
+        super(TestImportCursor, self).setUp()
+        try:
+            import mongomock
+        except ImportError:
+            raise SkipTest("mongomock not installed")
+        self.collection = mongomock.MongoClient().db.repository_information
+        ensure_metadata_indexes(self.collection)
+
+    def _store(self, hashes, start=0, branch='master'):
+        data = number_changesets([{'hash' : hash, 'repository_uri' : 'repo'} for hash in hashes], start=start)
+        store_repository_metadata(self.collection, data, chunk_size=2,
+            chunk_stored_callback=lambda chunk: store_repository_cursor(self.collection, 'repo', branch, chunk[-1]))
+
+    def test_cursor_points_to_last_stored_changeset(self):
+        self._store(['a', 'b', 'c'])
+        cursor = get_repository_cursor(self.collection, 'repo', 'master')
+        self.assertEquals('c', cursor['hash'])
+        self.assertEquals(3, cursor['commit_order'])
+
+    def test_last_revision_taken_from_branch_cursor(self):
+        self._store(['a', 'b', 'c'])
+        self._store(['d'], start=3, branch='other')
+        self.assertEquals('c', get_last_revision(self.collection, repository_uri='repo', branch='master'))
+        self.assertEquals('d', get_last_revision(self.collection, repository_uri='repo', branch='other'))
+
+    def test_highest_commit_order_used_for_unknown_branch(self):
+        self._store(['a', 'b', 'c'])
+        # updating stored changeset in place must not make it last one
+        store_repository_metadata(self.collection, [{'hash' : 'a', 'repository_uri' : 'repo', 'subject' : 'x'}])
+        self.assertEquals('c', get_last_revision(self.collection, repository_uri='repo', branch='unknown'))
+
+    def test_no_revision_for_empty_repository(self):
+        self.assertEquals(None, get_last_stored_changeset(self.collection, 'repo'))
+
+class TestRepositoriesHarvesting(TestCase):
+
+    def setUp(self):
+        super(TestRepositoriesHarvesting, self).setUp()
+        try:
+            import mongomock
+        except ImportError:
+            raise SkipTest("mongomock not installed")
+        self.collection = mongomock.MongoClient().db.repository_information
+        self.directory = mkdtemp(prefix="test_harvest_")
+        self.repositories = [self._create_repository("one", 2), self._create_repository("two", 3)]
+
+    def _create_repository(self, name, commits):
+        path = os.path.join(self.directory, name)
+        os.mkdir(path)
+        for command in (['git', 'init'], ['git', 'config', 'user.name', 'dummy-tester'], ['git', 'config', 'user.email', 'dummy-tester@example.com']):
+            check_call(command, cwd=path, stdout=PIPE, stderr=PIPE)
+        for i in range(commits):
+            check_call(['git', 'commit', '--allow-empty', '-m', 'commit %s' % i], cwd=path, stdout=PIPE, stderr=PIPE)
+        return path
+
+    def _harvest(self, repositories):
+        return harvest_repositories(repositories, lambda: self.collection, jobs=2)
+
+    def test_all_repositories_stored(self):
+        results = self._harvest(self.repositories)
+        self.assertEquals([2, 3], [result['stored'] for result in results])
+        self.assertEquals(2, self.collection.find({'repository_uri' : os.path.abspath(self.repositories[0])}).count())
+        self.assertEquals(3, self.collection.find({'repository_uri' : os.path.abspath(self.repositories[1])}).count())
+
+    def test_only_new_changesets_stored_again(self):
+        self._harvest(self.repositories)
+        check_call(['git', 'commit', '--allow-empty', '-m', 'new'], cwd=self.repositories[0], stdout=PIPE, stderr=PIPE)
+        self.assertEquals([1, 0], [result['stored'] for result in self._harvest(self.repositories)])
+
+    def test_failing_repository_reported_without_stopping_others(self):
+        results = self._harvest([os.path.join(self.directory, "nonexistent")] + self.repositories)
+        self.assertTrue(results[0]['error'])
+        self.assertEquals([None, None], [result['error'] for result in results[1:]])
+        self.assertEquals([2, 3], [result['stored'] for result in results[1:]])
+
+    def test_remote_repository_clone_removed_without_cache_directory(self):
+        temporary = os.path.join(self.directory, "tmp")
+        os.mkdir(temporary)
+        tempfile.tempdir = temporary
+        try:
+            results = self._harvest(["file://%s" % self.repositories[0]])
+        finally:
+            tempfile.tempdir = None
+        self.assertEquals([2], [result['stored'] for result in results])
+        self.assertEquals([], os.listdir(temporary))
+
+    def tearDown(self):
+        rmtree(self.directory)
+        super(TestRepositoriesHarvesting, self).tearDown()
@@ -2,6 +2,7 @@
 from unittest import TestCase
 
 from mock import Mock
+from nose.plugins.skip import SkipTest
 import os
 from subprocess import Popen, PIPE, check_call
 from shutil import rmtree
@@ -9,12 +10,19 @@ from StringIO import StringIO
 from tempfile import mkdtemp
 
 from citools.version import (
-    compute_version, get_git_describe, replace_version, compute_meta_version,
+    compute_version, compute_versions, get_git_describe, replace_version, compute_meta_version,
     sum_versions, fetch_repository,
-    get_highest_tag, get_tags_from_line,
-    get_branch_suffix,
+    get_highest_tag, get_highest_version, get_highest_versions,
+    get_tags_from_line, get_tags_from_current_branch,
+    get_branch_suffix, get_git_version, replace_version_in_file, replace_versions,
+    VERSION_CACHE_FILE_NAME,
 )
 
+from citools.git import GitRunner, GitSession
+from citools.pool import map_in_threads
+
+from helpers import GitTestCase
+
 class TestVersioning(TestCase):
 
     def test_after_tag(self):
@@ -50,6 +58,20 @@ class TestVersioning(TestCase):
     def test_multiple_digit_versin(self):
         self.assertEquals((0, 10, 2), compute_version('log4j-0.10-2-gbb6aff8'))
 
+    def test_tag_starting_with_multiple_digits(self):
+        self.assertEquals((12, 3, 4), compute_version('12.3-4-g1754c3f'))
+
+    def test_batch_computing(self):
+        self.assertEquals([(0, 7, 20), (0, 0, 1), (9, 7, 3, 45, 532, 11, 44)], compute_versions(
+            ['tools-0.7-20-g1754c3f', '0.0', 'log4j-9.7.3.45.532.11-44-g1754c3f']
+        ))
+
+    def test_batch_computing_fails_on_bad_tag(self):
+        self.assertRaises(ValueError, compute_versions, ['tools-0.7', 'arghpaxorgz-zsdf'])
+
+    def test_batch_computing_may_ignore_bad_tags(self):
+        self.assertEquals([(0, 7, 0), None], compute_versions(['tools-0.7', 'arghpaxorgz-zsdf'], ignore_errors=True))
+
     def test_version_replacing_three_digits(self):
         source = StringIO("""arakadabra
 blah blah
@@ -84,6 +106,62 @@ for i in x:
 
         self.assertEquals(expected_output, ''.join(replace_version(source, version=(9, 7, 3, 45, 532, 11, 44))))
 
+class TestVersionFileReplacing(TestCase):
+
+    def setUp(self):
+        TestCase.setUp(self)
+        self.directory = mkdtemp(prefix='test_replace_version_')
+        self.oldcwd = os.getcwd()
+        os.chdir(self.directory)
+
+        os.mkdir('package')
+        self.init = os.path.join('package', '__init__.py')
+        self._write(self.init, "VERSION = (1, 2, 3)\nx = 1\n")
+        self._write('module.py', "import os\nVERSION = (1, 2, 3)\n")
+        self._write('setup.py', "VERSION = (0, 0, 1)\nOTHER = 1\nVERSION = (0, 0, 1)\n")
+
+    def _write(self, path, content):
+        f = open(path, 'wb')
+        f.write(content)
+        f.close()
+
+    def _read(self, path):
+        f = open(path, 'rb')
+        content = f.read()
+        f.close()
+        return content
+
+    def test_all_files_replaced_in_one_pass(self):
+        changed = replace_versions((1, 2, 4), packages=['package'], py_modules=['module'], files=['setup.py'])
+        self.assertEquals([self.init, 'module.py', 'setup.py'], changed)
+        self.assertEquals("VERSION = (1, 2, 4)\nx = 1\n", self._read(self.init))
+        self.assertEquals("import os\nVERSION = (1, 2, 4)\n", self._read('module.py'))
+
+    def test_only_first_version_replaced(self):
+        replace_version_in_file((1, 0, 0), 'setup.py')
+        self.assertEquals("VERSION = (1, 0, 0)\nOTHER = 1\nVERSION = (0, 0, 1)\n", self._read('setup.py'))
+
+    def test_unchanged_file_not_rewritten(self):
+        os.utime(self.init, (1000, 1000))
+        self.assertEquals(False, replace_version_in_file((1, 2, 3), self.init))
+        self.assertEquals(1000, os.stat(self.init).st_mtime)
+        self.assertEquals([], replace_versions((1, 2, 3), packages=['package']))
+
+    def test_file_mode_preserved(self):
+        os.chmod('module.py', 0750)
+        replace_version_in_file((2, 0, 0), 'module.py')
+        self.assertEquals(0750, os.stat('module.py').st_mode & 07777)
+
+    def test_no_temporary_files_left(self):
+        replace_versions((2, 0, 0), packages=['package'], py_modules=['module'], files=['setup.py'])
+        self.assertEquals(['__init__.py'], os.listdir('package'))
+        self.assertEquals(['module.py', 'package', 'setup.py'], sorted(os.listdir('.')))
+
+    def tearDown(self):
+        os.chdir(self.oldcwd)
+        rmtree(self.directory)
+        TestCase.tearDown(self)
+
 class TestGitVersionRetrieving(TestCase):
 
     def setUp(self):
@@ -192,6 +270,79 @@ class TestGitVersionRetrieving(TestCase):
         os.chdir(self.oldcwd)
         TestCase.tearDown(self)
 
+class TestVersionCache(GitTestCase):
+
+    def setUp(self):
+        GitTestCase.setUp(self)
+        self._create_git_repository()
+        self._commit("test")
+        check_call(['git', 'tag', '-m', '"tagging"', '-a', 'project-0.1'])
+
+    def _commit(self, content):
+        f = open(os.path.join(self.repo, 'test.txt'), 'wb')
+        f.write(content)
+        f.close()
+        check_call(['git', 'add', '*'])
+        self.commit()
+
+    def test_version_stored_in_cache(self):
+        self.assertEquals(('project-0.1', (0, 1, 0)), get_git_version(accepted_tag_pattern='project-[0-9]*'))
+        self.assertTrue(os.path.exists(os.path.join(self.repo, '.git', VERSION_CACHE_FILE_NAME)))
+        self.assertEquals(('project-0.1', (0, 1, 0)), get_git_version(accepted_tag_pattern='project-[0-9]*'))
+
+    def test_cache_invalidated_by_new_commit(self):
+        get_git_version(accepted_tag_pattern='project-[0-9]*')
+        self._commit("new content")
+        self.assertEquals((0, 1, 1), get_git_version(accepted_tag_pattern='project-[0-9]*')[1])
+
+    def test_cache_invalidated_by_new_tag(self):
+        self._commit("new content")
+        self.assertEquals((0, 1, 1), get_git_version(accepted_tag_pattern='project-[0-9]*')[1])
+        check_call(['git', 'tag', '-m', '"tagging"', '-a', 'project-0.2'])
+        self.assertEquals((0, 2, 0), get_git_version(accepted_tag_pattern='project-[0-9]*')[1])
+
+    def test_pattern_is_part_of_cache_key(self):
+        get_git_version(accepted_tag_pattern='project-[0-9]*')
+        self.assertEquals('0.0', get_git_version(accepted_tag_pattern='other-[0-9]*')[0])
+
+
+class TestDescribeInThreads(GitTestCase):
+
+    def setUp(self):
+        GitTestCase.setUp(self)
+        self._create_git_repository()
+        f = open(os.path.join(self.repo, 'test.txt'), 'wb')
+        f.write("test")
+        f.close()
+        check_call(['git', 'add', '*'])
+        self.commit()
+        check_call(['git', 'tag', '-m', '"tagging"', '-a', 'project-0.1'])
+        os.chdir(self.oldcwd)
+
+    def test_environment_not_altered(self):
+        environment = dict(os.environ)
+        get_git_describe(fix_environment=True, repository_directory=self.repo, accepted_tag_pattern='project-[0-9]*')
+        self.assertEquals(environment, dict(os.environ))
+
+    def test_match_pattern_without_highest_version_preference(self):
+        self.assertEquals('project-0.1', get_git_describe(fix_environment=True, repository_directory=self.repo,
+            accepted_tag_pattern='project-[0-9]*', prefer_highest_version=False))
+
+    def test_describe_with_session(self):
+        check_call(['git', 'tag', 'project-0.9'], cwd=self.repo)
+        session = GitSession(runner=GitRunner(repository_directory=self.repo))
+        try:
+            # lightweight tag is not considered, as git describe ignores it
+            self.assertEquals('project-0.1', get_git_describe(fix_environment=True, repository_directory=self.repo,
+                accepted_tag_pattern='project-[0-9]*', session=session))
+        finally:
+            session.close()
+
+    def test_describe_in_parallel(self):
+        results = map_in_threads(lambda i: get_git_describe(fix_environment=True, repository_directory=self.repo,
+            accepted_tag_pattern='project-[0-9]*'), range(8), jobs=4)
+        self.assertEquals(['project-0.1'] * 8, results)
+
 class TestMetaRepository(TestCase):
 
     def setUp(self):
@@ -278,6 +429,39 @@ class TestMetaRepository(TestCase):
         ]))
 
 
+    def test_computing_meta_version_in_parallel(self):
+        dependency_versions = {}
+        self.assertEquals((3, 1, 71, 1), compute_meta_version(dependency_repositories=[
+            {
+                'url':self.repo_one,
+                'package_name' : 'project',
+            },
+            {
+                'url' : self.repo_two,
+                'package_name' : 'secondproject',
+            }
+        ], dependency_versions=dependency_versions, jobs=2))
+
+        self.assertEquals({'project' : (1, 0, 59, 1), 'secondproject' : (2, 0, 12)}, dependency_versions)
+
+    def test_computing_meta_version_from_mirrors(self):
+        cachedir = mkdtemp(prefix='test_git_')
+        try:
+            for i in xrange(2):
+                self.assertEquals((3, 1, 71, 1), compute_meta_version(dependency_repositories=[
+                    {
+                        'url':self.repo_one,
+                        'package_name' : 'project',
+                    },
+                    {
+                        'url' : self.repo_two,
+                        'package_name' : 'secondproject',
+                    }
+                ], cachedir=cachedir, remove_cloned_dirs=True))
+            self.assertEquals(2, len([name for name in os.listdir(cachedir) if name.endswith('.git')]))
+        finally:
+            rmtree(cachedir)
+
     def test_computing_meta_version_accepts_branch(self):
         # 0.1.0 is my version (my deps are testomation, but I'm at master!)
         # 1.0.59.2 is first child
@@ -322,6 +506,18 @@ class TestMetaRepository(TestCase):
         self.assertEquals([".git", "second.txt"].sort(), os.listdir(repodir).sort())
         rmtree(dir)
 
+    def test_history_only_fetch_has_no_working_tree(self):
+        dir = mkdtemp()
+        repodir = fetch_repository(repository=self.repo_two, workdir=dir, history_only=True, cache_config_dir=False)
+        self.assertEquals([".git"], os.listdir(repodir))
+        rmtree(dir)
+
+    def test_history_only_fetched_repository_has_same_version(self):
+        dir = mkdtemp()
+        repodir = fetch_repository(repository="file://%s" % self.repo_two, workdir=dir, history_only=True, branch="testomation", cache_config_dir=False)
+        self.assertEquals((2, 0, 13), compute_version(get_git_describe(repository_directory=repodir, fix_environment=True)))
+        rmtree(dir)
+
     def test_fetched_repository_has_same_version(self):
         dir = mkdtemp()
         repodir = fetch_repository(repository=self.repo_two, workdir=dir)
@@ -350,6 +546,35 @@ class TestVersionNumberManipulations(TestCase):
     def test_sum_bad_number_in_first_version(self):
         self.assertRaises(ValueError, sum_versions, (-1, 2, 3), (0, 128, 0))
 
+class TestHighestVersionSelection(TestCase):
+    versions = [(1, 1), (3, 0), (1, 0, 234, 3890), (2, 2, 3), (1, 155)]
+
+    def test_highest_version(self):
+        self.assertEquals((3, 0), get_highest_version(self.versions))
+
+    def test_default_version_for_no_versions(self):
+        self.assertEquals((0, 0), get_highest_version([]))
+
+    def test_longer_version_higher_than_its_prefix(self):
+        self.assertEquals((1, 2, 0), get_highest_version([(1, 2), (1, 2, 0)]))
+
+    def test_top_versions_ordered(self):
+        self.assertEquals([(3, 0), (2, 2, 3), (1, 155)], get_highest_versions(self.versions, count=3))
+
+    def test_duplicates_kept(self):
+        self.assertEquals([(2, 0), (2, 0)], get_highest_versions([(1, 0), (2, 0), (2, 0)], count=2))
+
+    def test_vectorized_selection_same_as_plain(self):
+        try:
+            import numpy
+        except ImportError:
+            raise SkipTest("numpy not installed")
+
+        versions = self.versions + [(1, 2), (1, 2, 0), (3, 0, 0, 1)]
+        self.assertEquals(get_highest_versions(versions, count=1), get_highest_versions(versions, count=1, use_numpy=True))
+        self.assertEquals(get_highest_versions(versions, count=5), get_highest_versions(versions, count=5, use_numpy=True))
+
+
 class TestParsingRevlistOutput(TestCase):
     def test_single_tag_parsed(self):
         self.assertEquals(['repo-1.2'], get_tags_from_line(' (repo-1.2)'))
@@ -363,6 +588,16 @@ class TestParsingRevlistOutput(TestCase):
     def test_multiple_tags_in_alternative_form_or_branches_parsed(self):
         self.assertEquals(['repo-1.2', 'origin/master'], get_tags_from_line(' (tag: repo-1.2, origin/master)'))
 
+    def test_only_annotated_tags_matching_pattern_retrieved(self):
+        revlist = "commit 57242af1e05022103623780b66339346b7be4da9\n (HEAD, master)\n" \
+            "commit 4c0eaacf31f5ad13f56c4c21312f1719b0f04073\n (repo-1.1, branch)\n" \
+            "commit 3f989c837348ffaa5c7ff2fc8ebfef70cd0cf59c\n (tag: repo-1.2, tag: other-1.3, repo-lightweight-1.4)"
+        self.assertEquals(['repo-1.1', 'repo-1.2'], get_tags_from_current_branch(
+            revlist_output=revlist,
+            accepted_tag_pattern='repo-[0-9]*',
+            annotated_tags=set(['repo-1.1', 'repo-1.2', 'other-1.3'])
+        ))
+
 #commit 57242af1e05022103623780b66339346b7be4da9
 # (HEAD, master)
 #commit 4c0eaacf31f5ad13f56c4c21312f1719b0f04073